@@ -0,0 +1,225 @@
+"""
+Re-renders the daily blog posts of a date range with the current template, by replaying the stored history
+and holdings snapshots. The payload has the shape of the plotly_image_update event:
+{"eth_full_history": [[epoch ms, ETH], ...], "all_coin_history": {"epoch ms": [coin rows], ...}}
+and optionally "replaced_rows": {"epoch ms": [[sold row, bought row], ...]}, the replaced_rows of the blog_ind_page
+event which led to the snapshot of that time.
+    python -m media.backfill --start 2021-01-01 --end 2021-05-31 --payload history.json
+Only the posts which exist are regenerated, every post of a day under its own key. Each one is rendered with the
+history, the holdings and the sparklines known at the time in its front matter. A dry run publishes no sparklines
+and renders the posts without them.
+"""
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from media.blog_writer import WebPage, WebPageFactory
+from media.bulk_sync import MAX_PARALLEL_OBJECTS, sync_artifacts
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.compiled_templates import CompiledTemplateLoader
+from media.utils.history import DecodedHistory
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_BATCH_SIZE = 50
+# The "date:" of the front matter of a post, as written by the blog template
+FRONT_MATTER_DATE_PATTERN = re.compile(r"^date:\s*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} [+-]\d{4})\s*$", re.MULTILINE)
+
+# State of each worker process, set once by the initializer instead of being pickled with every task
+_worker_state = {}
+
+
+def _initialize_worker(template_source, eth_full_history, snapshot_timestamps, snapshots, replacements,
+                       with_sparklines):
+    _worker_state["blog_page"] = WebPageFactory().get_webpage_concrete("crypto_update_blog")
+    _worker_state["template"] = CompiledTemplateLoader().get_template(_worker_state["blog_page"].relative_template,
+                                                                      template_source)
+    _worker_state["eth_full_history"] = eth_full_history
+    _worker_state["snapshot_timestamps"] = snapshot_timestamps
+    _worker_state["snapshots"] = snapshots
+    _worker_state["replacements"] = replacements
+    _worker_state["with_sparklines"] = with_sparklines
+
+
+def get_replaced_rows(previous_rows, current_rows):
+    """
+    Approximates the replacements of a snapshot without the pairs of its blog_ind_page event. The coins sold since
+    the previous snapshot are paired with the coins bought in the order of the rows, which need not be the pairing
+    of the event. A coin left without a partner is kept with None in its place
+    :return: list of (sold row or None, bought row or None)
+    """
+    previous_coins = {row["COIN"] for row in previous_rows}
+    current_coins = {row["COIN"] for row in current_rows}
+    sold_rows = [row for row in previous_rows if row["COIN"] not in current_coins]
+    bought_rows = [row for row in current_rows if row["COIN"] not in previous_coins]
+    return list(itertools.zip_longest(sold_rows, bought_rows))
+
+
+def render_post(destination, reference_time):
+    """
+    Renders the blog post with the history and the holdings known at its time
+    :param destination: key of the post
+    :param reference_time: datetime.datetime the post was written at
+    :return: tuple of the destination key and the rendered content, None if nothing was known at that time
+    """
+    reference_ms = reference_time.timestamp() * 1000
+    history_end = int(np.searchsorted(_worker_state["eth_full_history"].timestamps_ms, reference_ms, side="right"))
+    snapshot_index = bisect.bisect_right(_worker_state["snapshot_timestamps"], reference_ms) - 1
+    if history_end == 0 or snapshot_index < 0:
+        return None
+
+    current_rows = _worker_state["snapshots"][snapshot_index]
+    replaced_rows = _worker_state["replacements"].get(_worker_state["snapshot_timestamps"][snapshot_index])
+    if replaced_rows is None:
+        # The coins replaced by the post are approximated by the difference to the holdings of the snapshot before
+        previous_rows = _worker_state["snapshots"][max(snapshot_index - 1, 0)]
+        replaced_rows = get_replaced_rows(previous_rows, current_rows)
+    all_coin_history = None
+    if _worker_state["with_sparklines"]:
+        all_coin_history = {timestamp: rows for timestamp, rows in
+                            zip(_worker_state["snapshot_timestamps"][:snapshot_index + 1],
+                                _worker_state["snapshots"][:snapshot_index + 1])}
+    blog_page = _worker_state["blog_page"]
+    dict_to_replace = blog_page.prepare_dict(current_rows,
+                                             replaced_rows,
+                                             _worker_state["eth_full_history"][:history_end],
+                                             current_rows,
+                                             reference_time=reference_time,
+                                             all_coin_history=all_coin_history)
+    return destination, _worker_state["template"].render(dict_to_replace)
+
+
+def list_existing_posts(blog_page, start_date, end_date):
+    """
+    Lists the posts written from start_date to end_date, both included
+    :return: list of tuples of the key and the datetime.date of each post
+    """
+    post_pattern = re.compile(rf"^{re.escape(blog_page.blog_post_dir)}/(\d{{4}})-(\d{{1,2}})-(\d{{1,2}})-"
+                              rf"{re.escape(blog_page.base_name_for_blog)}\d*\.md$")
+    existing_posts = []
+    for item in S3FileAccessAbstract(file_name=f"{blog_page.blog_post_dir}/").list_files():
+        match = post_pattern.match(item["Key"])
+        if match is None:
+            continue
+        date = datetime.date(*(int(part) for part in match.groups()))
+        if start_date <= date <= end_date:
+            existing_posts.append((item["Key"], date))
+    return existing_posts
+
+
+def get_reference_time_of(destination, date):
+    """
+    Time the post was written at, from the "date:" of its front matter. The end of the day if it has none
+    :return: datetime.datetime
+    """
+    content = S3FileAccessAbstract(file_name=destination).read_bytes().decode("utf-8")
+    match = FRONT_MATTER_DATE_PATTERN.search(content)
+    if match is None:
+        logger.info(f"No date in the front matter of {destination}, rendering it for the end of {date}")
+        return datetime.datetime.combine(date, datetime.time(23, 59, 59))
+    # Naive local time, like the rest of the history
+    return datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S %z").astimezone().replace(tzinfo=None)
+
+
+def upload_posts(pending_uploads):
+    """
+    :return: list of the keys which could not be uploaded
+    """
+    return [result.key for result in sync_artifacts(pending_uploads) if not result.success]
+
+
+def load_payload(payload_path=None, payload_key=None):
+    """Loads the replayed history from a local file or from the storage"""
+    if payload_path is not None:
+        with open(payload_path, "r") as fp:
+            return json.load(fp)
+    with S3FileAccessAbstract(file_name=payload_key) as payload_file:
+        with open(payload_file, "r") as fp:
+            return json.load(fp)
+
+
+def backfill_blog_posts(start_date, end_date, payload, max_workers=None, dry_run=False):
+    """
+    Regenerates the existing blog posts from start_date to end_date, both included. The days without a post
+    are skipped, the bot never wrote one for them
+    :param payload: dict with eth_full_history, in any encoding of the event, all_coin_history and optionally
+    replaced_rows
+    :param max_workers: number of rendering processes, the number of CPUs by default
+    :param dry_run: renders without uploading
+    :return: list of the keys of the regenerated posts
+    :raises RuntimeError: if some of the posts could not be uploaded, after all others were
+    """
+    blog_page = WebPageFactory().get_webpage_concrete("crypto_update_blog")
+    existing_posts = list_existing_posts(blog_page, start_date, end_date)
+    if not existing_posts:
+        logger.info(f"No blog posts between {start_date} and {end_date}")
+        return []
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_OBJECTS) as executor:
+        reference_times = list(executor.map(lambda post: get_reference_time_of(*post), existing_posts))
+
+    template_source = WebPage.get_template_source(blog_page.relative_template)
+    # Pickled once per worker as two arrays, and sliced per post without copies
+    eth_full_history = DecodedHistory.from_payload(payload["eth_full_history"])
+    snapshots_by_time = sorted((int(timestamp), rows) for timestamp, rows in payload["all_coin_history"].items())
+    snapshot_timestamps = [timestamp for timestamp, _ in snapshots_by_time]
+    snapshots = [rows for _, rows in snapshots_by_time]
+    replacements = {int(timestamp): rows for timestamp, rows in payload.get("replaced_rows", {}).items()}
+    if not replacements:
+        logger.info("No replaced_rows in the payload, the replaced coins of the posts are approximated")
+
+    rendered_keys = []
+    failed_keys = []
+    pending_uploads = []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                             initializer=_initialize_worker,
+                             initargs=(template_source, eth_full_history, snapshot_timestamps, snapshots,
+                                       replacements, not dry_run)) as pool:
+        futures = [pool.submit(render_post, destination, reference_time)
+                   for (destination, _), reference_time in zip(existing_posts, reference_times)]
+        for future in as_completed(futures):
+            rendered_post = future.result()
+            if rendered_post is None:
+                continue
+            destination, content = rendered_post
+            rendered_keys.append(destination)
+            pending_uploads.append((destination, content.encode("utf-8")))
+            if len(pending_uploads) >= UPLOAD_BATCH_SIZE and not dry_run:
+                failed_keys.extend(upload_posts(pending_uploads))
+                pending_uploads = []
+    if pending_uploads and not dry_run:
+        failed_keys.extend(upload_posts(pending_uploads))
+    logger.info(f"Regenerated {len(rendered_keys) - len(failed_keys)} of the {len(existing_posts)} blog posts "
+                f"between {start_date} and {end_date}")
+    if failed_keys:
+        raise RuntimeError(f"Could not upload {len(failed_keys)} regenerated blog posts: {sorted(failed_keys)}")
+    return sorted(rendered_keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", type=datetime.date.fromisoformat, required=True)
+    parser.add_argument("--end", type=datetime.date.fromisoformat, required=True)
+    payload_group = parser.add_mutually_exclusive_group(required=True)
+    payload_group.add_argument("--payload", help="local JSON file with the history and the snapshots")
+    payload_group.add_argument("--payload-key", help="key of the JSON payload in the storage")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="render without uploading")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    payload = load_payload(arguments.payload, arguments.payload_key)
+    regenerated = backfill_blog_posts(arguments.start, arguments.end, payload,
+                                      max_workers=arguments.workers, dry_run=arguments.dry_run)
+    print("\n".join(regenerated))
+
+
+if __name__ == "__main__":
+    main()
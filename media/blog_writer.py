@@ -1,11 +1,17 @@
 import datetime
 import logging
-from jinja2 import Template
 from abc import ABC, abstractmethod
 from media.s3_file_access import S3FileAccessAbstract
-from media.utils.postpro import PredictionOperations
+from media.portfolios import get_default_portfolio
+from media.sparklines import SparklineGenerator
+from media.utils.aggregates import AggregatesStore, HoldingAggregates
+from media.utils.compiled_templates import CompiledTemplateLoader
+from media.utils.postpro import PredictionOperations, Projection
+from media.utils.metrics import metrics, timed_stage
 logger = logging.getLogger(__name__)
 
+MAX_POST_PATH_ATTEMPTS = 20
+
 
 class WebPageFactory:
     _creators = {}
@@ -13,11 +19,14 @@ class WebPageFactory:
     def register_format(self, identifier, concrete_class_name):
         self._creators[identifier] = concrete_class_name
 
-    def get_webpage_concrete(self, identifier):
+    def get_webpage_concrete(self, identifier, portfolio=None):
+        """
+        :param portfolio: PortfolioConfig the page is published for, the default portfolio if None
+        """
         creator = self._creators.get(identifier)
         if not creator:
             raise ValueError(identifier)
-        return creator()
+        return creator(portfolio)
 
 
 def add_to_factory(identifier):
@@ -32,8 +41,9 @@ def add_to_factory(identifier):
 
 
 class WebPage(ABC):
-    def __init__(self):
-        self.simulation_start_date = datetime.datetime(2020, 2, 2)
+    def __init__(self, portfolio=None):
+        self.portfolio = portfolio if portfolio is not None else get_default_portfolio()
+        self.simulation_start_date = self.portfolio.start_date
         self.relative_template = ""
         self.file_exists = None
 
@@ -52,37 +62,53 @@ class WebPage(ABC):
     def publish_online(self,
                        *args,
                        **kwargs):
-        dict_to_replace_crypto_update = self.prepare_dict(*args, **kwargs)
+        with metrics.stage("dict_preparation"):
+            dict_to_replace_crypto_update = self.prepare_dict(*args, **kwargs)
         page_path = self.publish_file(
             dict_to_replace_crypto_update)
         return page_path
 
     @staticmethod
+    def get_template_source(relative_template):
+        """Returns the source of the template file"""
+        with S3FileAccessAbstract(file_name=relative_template, cached=True) as main_template_file:
+            with open(main_template_file, 'r') as fp:
+                return fp.read()
+
+    @staticmethod
+    @timed_stage("template_fetch")
     def get_template_file_content(relative_template):
         """Returns the content of the template file"""
-        with S3FileAccessAbstract(file_name=relative_template) as main_template_file:
-            with open(main_template_file, 'r') as fp:
-                template_handle = Template(fp.read())
+        template_source = WebPage.get_template_source(relative_template)
+        template_handle = CompiledTemplateLoader().get_template(relative_template, template_source)
         logger.info(f"Obtained the template from {relative_template}")
         return template_handle
 
     def publish_file(self, dict_to_replace):
         """Update the markdown file the template by replacing the contents in {{ }}"""
         template = self.get_template_file_content(self.relative_template)
-        rendered_file_content = template.render(dict_to_replace)
+        with metrics.stage("render"):
+            rendered_file_content = template.render(dict_to_replace)
+        logger.info(f"rendered file content is available by replacing the dict {dict_to_replace}")
+        return self.write_rendered_content(rendered_file_content)
+
+    def write_rendered_content(self, rendered_file_content):
+        """
+        Writes the rendered page to its destination
+        :return: the destination of the page
+        """
         destination_file = self.get_destination_relative_path()
-        logger.info(f"rendered file content is available by replacing the dict {dict_to_replace}\n"
-                    f"on the file: {destination_file}")
         with S3FileAccessAbstract(file_name=destination_file,
                                   push_back=True,
                                   file_exists=self.file_exists) as templated:
             with open(templated, "w") as fp:
                 fp.write(rendered_file_content)
+        logger.info(f"Wrote the rendered content on the file: {destination_file}")
         return destination_file
 
     @staticmethod
-    def get_percentage_diff_html_format(time_delta, eth_vs_ts_history_full):
-        percent_diff = PredictionOperations().get_percentage_diff_for_history(time_delta, eth_vs_ts_history_full)
+    def get_percentage_diff_html_format(time_delta, aggregates, reference_time=None):
+        percent_diff = aggregates.percentage_change_over(time_delta, reference_time)
         percentage_representation = f"{percent_diff:>3.2f}%"
         logger.info(f"Calculated the percentage difference for {time_delta}")
         if percent_diff >= 0:
@@ -90,29 +116,48 @@ class WebPage(ABC):
         else:
             return f'<font color="red">{percentage_representation}</font>'
 
-    def prepare_general_dict(self, eth_vs_ts_history_full):
-        """Prepare the list of strings to replace the markdowned template"""
-        current_eth_holding = eth_vs_ts_history_full[-1][1]
+    def get_aggregates(self, eth_vs_ts_history_full, reference_time=None):
+        """
+        Aggregates of the history the page is rendered from
+        :param reference_time: datetime.datetime the page is rendered for, now by default. The history is then
+        aggregated on its own, without the persisted aggregates, so past pages can be replayed
+        :return: HoldingAggregates
+        """
+        if reference_time is None:
+            return AggregatesStore(self.portfolio.aggregates_file_name).get_updated(eth_vs_ts_history_full)
+        aggregates = HoldingAggregates()
+        aggregates.extend(eth_vs_ts_history_full)
+        return aggregates
+
+    def prepare_general_dict(self, eth_vs_ts_history_full, reference_time=None, aggregates=None):
+        """
+        Prepare the list of strings to replace the markdowned template
+        :param reference_time: datetime.datetime the page is rendered for, now by default
+        :param aggregates: HoldingAggregates of the history, from get_aggregates if None
+        """
+        if aggregates is None:
+            aggregates = self.get_aggregates(eth_vs_ts_history_full, reference_time)
+        reference_time = reference_time or datetime.datetime.now()
         logger.info("Preparing the general dictionary for the web-pages")
-        # TODO This can be speeded up https://stackoverflow.com/a/12141511/2542835
-        return {"last_updated_on": datetime.datetime.now().astimezone().strftime("%m/%d/%Y, %H:%M:%S %Z"),
-                "current_eth_holding": f"{current_eth_holding:>10.2f} ETH",
+        return {"last_updated_on": reference_time.astimezone().strftime("%m/%d/%Y, %H:%M:%S %Z"),
+                "current_eth_holding": f"{aggregates.last_value:>10.2f} ETH",
                 "overall_eth_percent": self.get_percentage_diff_html_format(datetime.timedelta(weeks=99999),
-                                                                            eth_vs_ts_history_full),
+                                                                            aggregates, reference_time),
                 "change_last_week": self.get_percentage_diff_html_format(datetime.timedelta(days=7),
-                                                                         eth_vs_ts_history_full),
+                                                                         aggregates, reference_time),
                 "change_last_month": self.get_percentage_diff_html_format(datetime.timedelta(days=30),
-                                                                          eth_vs_ts_history_full)
+                                                                          aggregates, reference_time)
                 }
 
 
 @add_to_factory("crypto_update_main")
 class MainWebPage(WebPage):
-    """Responsible for updating the crypto_update.md"""
-    def __init__(self):
-        super().__init__()
-        self.relative_template = "_layouts/template-eth-challenge-main.md"
-        self.file_exists = True
+    """Responsible for updating the crypto_update.md of the portfolio"""
+    def __init__(self, portfolio=None):
+        super().__init__(portfolio)
+        self.relative_template = self.portfolio.main_template
+        # The page of any other portfolio is created by its first update
+        self.file_exists = self.portfolio.is_default
 
     def get_posted_url(self, destination_path):
         """Get the final url where it is going to be posted"""
@@ -120,47 +165,87 @@ class MainWebPage(WebPage):
 
     def get_destination_relative_path(self):
         """Gets the destination path of the file after processing"""
-        return "crypto_update.md"
+        return self.portfolio.main_page_path
 
     def prepare_dict(self, eth_vs_ts_history_full):
         """Prepare the dict specific to the crypto_update.md template"""
-        parent_dict = self.prepare_general_dict(eth_vs_ts_history_full)
-        current_eth_holding = eth_vs_ts_history_full[-1][1]
-        parent_dict.update({"predicted_value_end_of_year": self.predict_end_of_year_value(current_eth_holding)})
+        aggregates = self.get_aggregates(eth_vs_ts_history_full)
+        parent_dict = self.prepare_general_dict(eth_vs_ts_history_full, aggregates=aggregates)
+        now = datetime.datetime.now()
+        projection = self.predict_value_at(datetime.datetime(now.year, 12, 31), aggregates)
+        parent_dict.update({"predicted_value_end_of_year": f"{projection.value:>10.2f} ETH",
+                            "predicted_range_end_of_year": f"{projection.lower:.2f} - {projection.upper:.2f} ETH"})
         return parent_dict
 
-    def predict_end_of_year_value(self, current_holding):
-        """Predicts the end of year value of ETH holding based on the past record.
-        # TODO Make a compound prediction. Not a linear prediction"""
-        expected_change = PredictionOperations.predict_end_of_year_value(current_holding,
-                                                                         start_date=self.simulation_start_date,
-                                                                         starting_value=10)
-        return f"{expected_change:>10.2f} ETH"
+    def predict_value_at(self, target_time, aggregates):
+        """
+        Predicts the ETH holding at the target time by the compound growth of the whole history
+        :param target_time: datetime.datetime
+        :param aggregates: HoldingAggregates of the history
+        :return: Projection with the 95% bounds
+        """
+        projection = aggregates.growth.project(target_time)
+        if projection is None:
+            # Too short a history for a fit, the linear trend from the start of the challenge
+            expected_value = PredictionOperations.predict_end_of_year_value(
+                aggregates.last_value,
+                start_date=self.simulation_start_date,
+                starting_value=self.portfolio.starting_value)
+            return Projection(expected_value, expected_value, expected_value)
+        logger.info(f"Projected {projection} at {target_time}, "
+                    f"{aggregates.growth.daily_growth_percentage:.3f} % per day")
+        return projection
 
 
 @add_to_factory("crypto_update_blog")
 class BlogWebPage(WebPage):
-    def __init__(self):
-        super().__init__()
-        self.base_name_for_blog = "10-eth-challenge"
-        self.relative_template = "_layouts/template-eth-challenge-blog.md"
+    def __init__(self, portfolio=None):
+        super().__init__(portfolio)
+        self.base_name_for_blog = self.portfolio.portfolio_id
+        self.blog_post_dir = self.portfolio.blog_post_dir
+        self.relative_template = self.portfolio.blog_template
         self.file_exists = False
 
+    def get_first_post_path_of(self, date):
+        """Path of the first blog post written on the date, the one without a numbered suffix"""
+        return self.get_post_path_of(date, 0)
+
+    def get_post_path_of(self, date, post_index):
+        """Path of the post_index-th post of the date, the first one has no numbered suffix"""
+        suffix = "" if post_index == 0 else post_index
+        return f"{self.blog_post_dir}/{date.year}-{date.month}-{date.day}-{self.base_name_for_blog}{suffix}.md"
+
+    def get_number_of_posts_of(self, date):
+        """Number of posts already written on the date"""
+        files_in_dir = S3FileAccessAbstract(file_name=self.blog_post_dir).list_files(
+            prefix_add=f"/{date.year}-{date.month}-{date.day}-{self.base_name_for_blog}"
+        )
+        return len(files_in_dir)
+
     def get_destination_relative_path(self):
         """Produces the destination of the renderer taking into account account if a
-        blog already was written that date
-        :return pathlib.Path object to the destination file
+        blog already was written that date. Another invocation may still take it before this one writes
+        :return the key of the destination file
         """
-        now = datetime.datetime.now()
-        date_string = f"{now.year}-{now.month}-{now.day}"
-        blog_post_dir = "_posts/crypto"
-        files_in_dir = S3FileAccessAbstract(file_name=blog_post_dir).list_files(
-            prefix_add=f"/{now.year}-{now.month}-{now.day}"
-        )
-        file_names_in_dir = [f['Key'] for f in files_in_dir]
-        same_date_file_list = [item for item in file_names_in_dir if date_string in item]
-        suffix = "" if len(same_date_file_list) == 0 else len(same_date_file_list)
-        return f"{blog_post_dir}/{date_string}-{self.base_name_for_blog}{suffix}.md"
+        today = datetime.date.today()
+        return self.get_post_path_of(today, self.get_number_of_posts_of(today))
+
+    def write_rendered_content(self, rendered_file_content):
+        """
+        Creates the post under the first free path of the day. The path is only taken by a create-if-absent
+        write, so concurrent invocations never overwrite each other but move on to the next suffix
+        :return: the destination of the post
+        """
+        today = datetime.date.today()
+        first_post_index = self.get_number_of_posts_of(today)
+        content = rendered_file_content.encode("utf-8")
+        for post_index in range(first_post_index, first_post_index + MAX_POST_PATH_ATTEMPTS):
+            destination_file = self.get_post_path_of(today, post_index)
+            if S3FileAccessAbstract(file_name=destination_file).put_if_absent(content):
+                logger.info(f"Wrote the rendered content on the file: {destination_file}")
+                return destination_file
+            logger.info(f"{destination_file} was taken by a concurrent invocation, trying the next suffix")
+        raise RuntimeError(f"No free path for the blog post of {today} after {MAX_POST_PATH_ATTEMPTS} attempts")
 
     def get_posted_url(self, destination_path):
         """Get the final url where it is going to be posted"""
@@ -173,9 +258,17 @@ class BlogWebPage(WebPage):
 
     @staticmethod
     def get_replaced_coins_string(replaced_rows):
-        """Produces the string which does the replacing. Returns empty string if nothing to replace"""
+        """
+        Produces the string which does the replacing. Returns empty string if nothing to replace.
+        A side of a replacement may be None, eg. a coin sold without a coin bought in its place
+        """
         replaced_string = ""
         for orig_dict, new_dict in replaced_rows:
+            if orig_dict is None or new_dict is None:
+                replaced_string += "".join(f"{action}: {row['COIN']}, quantity: {row['QUANTITY']:12.2f}<br>"
+                                           for action, row in (("Sold", orig_dict), ("Bought", new_dict))
+                                           if row is not None)
+                continue
             price_of_sold_coin = new_dict['QUANTITY'] * new_dict['COIN_ETH_VALUE'] / orig_dict['QUANTITY']
 
             replaced_string += f"Sold: {orig_dict['COIN']}, quantity: {orig_dict['QUANTITY']:12.2f}, " \
@@ -184,21 +277,30 @@ class BlogWebPage(WebPage):
                              f"price: {new_dict['COIN_ETH_VALUE']:12.8f}<br>"
         return replaced_string
 
-    def prepare_dict(self, list_of_coin_dicts, replaced_rows, eth_vs_time_history_full, new_rows):
+    def prepare_dict(self, list_of_coin_dicts, replaced_rows, eth_vs_time_history_full, new_rows,
+                     reference_time=None, all_coin_history=None):
         """
         Creates the dict used by the jinja2 renderer to replace text
         :param list_of_coin_dicts: list of coin dicts which contain information to be printed
         :param replaced_rows: list of tuples of replaced coins and new coins
         :param eth_vs_time_history_full: Full history of what has happened with the ETH vs time
+        :param reference_time: datetime.datetime the post is written for, now by default
+        :param all_coin_history: dict of epoch ms: coin rows. If given, the table gets a sparkline of each coin
         :return: a dict which is going to be used to replace in the renderer
         """
-        dict_to_return = self.prepare_general_dict(eth_vs_time_history_full)
+        dict_to_return = self.prepare_general_dict(eth_vs_time_history_full, reference_time)
+        reference_time = reference_time or datetime.datetime.now()
+        sparkline_keys = None
+        if all_coin_history:
+            sparkline_keys = SparklineGenerator().generate(all_coin_history,
+                                                           [coin_dict["COIN"] for coin_dict in list_of_coin_dicts])
         dict_to_return.update(
-            {"table_content": self.table_format_vertical_current_holding(list_of_coin_dicts, new_rows),
-             "title_date": datetime.datetime.now().strftime('%d %b %Y'),
-             "detailed_date_time": datetime.datetime.now().astimezone().strftime("%m/%d/%Y, %H:%M:%S %Z"),
+            {"table_content": self.table_format_vertical_current_holding(list_of_coin_dicts, new_rows,
+                                                                         sparkline_keys),
+             "title_date": reference_time.strftime('%d %b %Y'),
+             "detailed_date_time": reference_time.astimezone().strftime("%m/%d/%Y, %H:%M:%S %Z"),
              "changes_in_coins_held": self.get_replaced_coins_string(replaced_rows),
-             "date_time_format_yaml": datetime.datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S %z")},)
+             "date_time_format_yaml": reference_time.astimezone().strftime("%Y-%m-%d %H:%M:%S %z")},)
         return dict_to_return
 
     @staticmethod
@@ -223,7 +325,7 @@ class BlogWebPage(WebPage):
         return joined_string
 
     @staticmethod
-    def table_format_vertical_current_holding(list_of_coin_dicts, new_rows):
+    def table_format_vertical_current_holding(list_of_coin_dicts, new_rows, sparkline_keys=None):
         """Formats the table vertically as
         Current holdings from the ETH Challenge
         Coin ticker 	Quantity 	Sell target
@@ -238,18 +340,20 @@ class BlogWebPage(WebPage):
         TNB 	191782.49 	0.00000807 	22 Apr 2020
         AE 	824.96 	0.00066780 	30 Apr 2020
         MTH 	23240.5 	0.00004304 	16 Apr 2020
+        With sparkline_keys (dict of coin: key of the image) a trend column is added
         """
-        joined_string = "|Coin ticker|Quantity|Sell target<br>coin/ETH|Eqv ETH<br>value|Sell latest by|\n" \
-                        "|-----------|--------|-----------|-----------|--------------|\n"
+        joined_string = "|Coin ticker|Quantity|Sell target<br>coin/ETH|Eqv ETH<br>value|Sell latest by|"
+        joined_string += "Trend|\n" if sparkline_keys is not None else "\n"
+        joined_string += "|-----------|--------|-----------|-----------|--------------|"
+        joined_string += "-----|\n" if sparkline_keys is not None else "\n"
         for coin_dict, new_row in zip(list_of_coin_dicts, new_rows):
             joined_string += f"{coin_dict['COIN']}|{coin_dict['QUANTITY']}|" \
                 f"{coin_dict['SELL_TARGET']:12.8f}|" \
                 f"{float(coin_dict['QUANTITY']) * new_row['COIN_ETH_VALUE']:.2f}|" \
-                f"{datetime.datetime.fromtimestamp(coin_dict['SELL_BY']/1000).strftime('%d %b %Y')}|\n"
+                f"{datetime.datetime.fromtimestamp(coin_dict['SELL_BY']/1000).strftime('%d %b %Y')}|"
+            if sparkline_keys is not None:
+                sparkline_key = sparkline_keys.get(coin_dict['COIN'])
+                joined_string += f"![{coin_dict['COIN']}](/{sparkline_key})|" if sparkline_key else "|"
+            joined_string += "\n"
         logger.info("Generated the table for printing")
         return joined_string
-
-
-
-
-
@@ -0,0 +1,65 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from media.storage_backends import get_storage_backend
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_PARALLEL_OBJECTS = 8
+
+
+class SyncResult:
+    """Outcome of the upload of one artifact"""
+    def __init__(self, key, size=None, seconds=None, error=None):
+        self.key = key
+        self.size = size
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.success else f"failed: {self.error}"
+        return f"SyncResult({self.key}, {status})"
+
+
+def _upload_item(backend, key, source):
+    start = time.perf_counter()
+    try:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            backend.upload_bytes(bytes(source), key)
+            size = len(source)
+        else:
+            backend.upload_file(source, key)
+            size = os.path.getsize(source)
+    except Exception as error:
+        logger.error(f"Could not upload {key}: {error}")
+        return SyncResult(key, seconds=time.perf_counter() - start, error=error)
+    return SyncResult(key, size=size, seconds=time.perf_counter() - start)
+
+
+def sync_artifacts(items, backend=None, max_workers=MAX_PARALLEL_OBJECTS):
+    """
+    Uploads several artifacts in parallel. Large objects are additionally uploaded in parallel parts by the
+    backend, so a whole cycle costs about the time of the largest object
+    :param items: iterable of (key, bytes or local path)
+    :param backend: StorageBackend, the configured one by default
+    :param max_workers: number of objects uploaded at once
+    :return: list of SyncResult in the order of the items
+    """
+    backend = backend if backend is not None else get_storage_backend()
+    items = list(items)
+    if not items:
+        return []
+    with metrics.stage("upload"):
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            results = list(executor.map(lambda item: _upload_item(backend, *item), items))
+    failed = [result.key for result in results if not result.success]
+    logger.info(f"Synced {len(results) - len(failed)} of {len(results)} artifacts"
+                + (f", failed: {failed}" if failed else ""))
+    return results
@@ -0,0 +1,101 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ExportSpec:
+    """Format and size of one static image exported from a figure"""
+    def __init__(self, image_format="png", width=None, height=None, scale=1):
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.scale = scale
+
+    @property
+    def name(self):
+        if self.width is None or self.height is None:
+            return self.image_format
+        return f"{self.width}x{self.height}.{self.image_format}"
+
+    @classmethod
+    def from_path(cls, path):
+        """Spec of the default size whose format is taken from the file extension"""
+        return cls(image_format=str(path).rsplit(".", 1)[-1].lower())
+
+
+class FigureExportWorker:
+    """
+    Long-lived thread which owns a single kaleido scope, so the Chromium subprocess starts once per container
+    and stays warm across invocations. Figures are queued and each request can export several formats and sizes
+    """
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="figure-export-worker", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        try:
+            import plotly
+            from kaleido.scopes.plotly import PlotlyScope
+            # Same plotly.js as the one of the installed plotly, like plotly's own write_image
+            scope = PlotlyScope(plotlyjs=os.path.join(os.path.dirname(plotly.__file__),
+                                                      "package_data", "plotly.min.js"))
+            scope_error = None
+        except Exception as error:
+            scope, scope_error = None, error
+            logger.error(f"Could not start the kaleido scope: {error}")
+        while True:
+            figure_dict, specs, future = self.requests.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if scope_error is not None:
+                future.set_exception(scope_error)
+                continue
+            try:
+                start = time.perf_counter()
+                exported_images = {spec.name: scope.transform(figure_dict,
+                                                              format=spec.image_format,
+                                                              width=spec.width,
+                                                              height=spec.height,
+                                                              scale=spec.scale)
+                                   for spec in specs}
+                logger.info(f"Exported {list(exported_images)} in {time.perf_counter() - start:.3f}s")
+                future.set_result(exported_images)
+            except Exception as error:
+                future.set_exception(error)
+
+    def submit(self, figure, specs):
+        """
+        Queues the export of the figure
+        :param figure: plotly.graph_objects.Figure or its dict
+        :param specs: list of ExportSpec
+        :return: concurrent.futures.Future of the dict of spec name: image bytes
+        """
+        self._ensure_started()
+        figure_dict = figure if isinstance(figure, dict) else figure.to_dict()
+        future = concurrent.futures.Future()
+        self.requests.put((figure_dict, list(specs), future))
+        return future
+
+    def export(self, figure, specs, timeout=None):
+        """Exports the figure and waits for the images"""
+        return self.submit(figure, specs).result(timeout=timeout)
+
+
+_export_worker = FigureExportWorker()
+
+
+def get_export_worker():
+    """Returns the export worker shared by the container"""
+    return _export_worker
@@ -0,0 +1,157 @@
+"""
+Remembers the results of the events carrying an idempotency key, so that retried and duplicate deliveries
+return the first result instead of posting or publishing again. The records are small JSON files on the
+storage layer, valid for VC_IDEMPOTENCY_TTL_HOURS (24 by default). Every write of a record is conditional on the
+version read. The expired records are deleted by the lifecycle rule of the bucket, which
+scripts/configure_bucket_lifecycle.py sets up
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_DIR = "db/idempotency"
+# Longest run of a lambda invocation, a claim older than that belongs to an invocation which died
+IN_PROGRESS_LEASE_SECONDS = 15 * 60
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+
+class IdempotencyInProgressError(Exception):
+    """Another invocation is handling the same key right now. Raised so that the delivery is retried later"""
+
+
+class IdempotencyStore:
+    def __init__(self, directory=IDEMPOTENCY_DIR, ttl_seconds=None):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            float(os.environ.get("VC_IDEMPOTENCY_TTL_HOURS", "24")) * 3600
+
+    def get_record_key_of(self, idempotency_key):
+        # Hashed, the keys of the events may contain anything
+        return f"{self.directory}/{hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()}.json"
+
+    def _read_versioned(self, idempotency_key):
+        """
+        :return: tuple of the stored record, expired or not, and its version. (None, None) if there is none
+        """
+        content, version = S3FileAccessAbstract(file_name=self.get_record_key_of(idempotency_key)).read_versioned()
+        if content is None:
+            return None, None
+        return json.loads(content), version
+
+    def is_expired(self, record):
+        return time.time() - record["stored_at"] > self.ttl_seconds
+
+    def read_record(self, idempotency_key):
+        """
+        :return: dict of the stored record, None if there is none or if it expired
+        """
+        record, _ = self._read_versioned(idempotency_key)
+        if record is None or self.is_expired(record):
+            return None
+        return record
+
+    def write_record(self, idempotency_key, status, result=None, version=None):
+        """
+        Writes the record only if the stored one is still the version read, as a single atomic step
+        :param version: version of the stored record, None to only create the record
+        :return: the version written, None if the stored record changed in between
+        """
+        record = {"key": idempotency_key, "status": status, "result": result, "stored_at": time.time()}
+        content = json.dumps(record).encode("utf-8")
+        return S3FileAccessAbstract(file_name=self.get_record_key_of(idempotency_key)).write_if_version(content,
+                                                                                                      version)
+
+    def store_result(self, idempotency_key, result):
+        """
+        Records the result of work done outside of run_once, eg. a posted tweet. A record of an earlier run is
+        replaced
+        :return: True if the record was written, False if a concurrent writer replaced it first
+        """
+        if self.write_record(idempotency_key, STATUS_COMPLETED, result) is not None:
+            return True
+        _, version = self._read_versioned(idempotency_key)
+        return self.write_record(idempotency_key, STATUS_COMPLETED, result, version=version) is not None
+
+    def _claim(self, idempotency_key, version):
+        """
+        Marks the key as being handled by this invocation. Expired, failed or abandoned records are taken over
+        only if they are unchanged since they were read, so of concurrent retries a single one wins
+        :param version: version of the record read, None if there was none
+        :return: version of the claim
+        """
+        claimed_version = self.write_record(idempotency_key, STATUS_IN_PROGRESS, version=version)
+        if claimed_version is None:
+            metrics.increment("idempotency_lost_race")
+            raise IdempotencyInProgressError(f"{idempotency_key} was claimed by a concurrent invocation")
+        return claimed_version
+
+    def _finish(self, idempotency_key, status, claimed_version, result=None):
+        """Stores the outcome, unless another invocation took the key over once the lease of the claim ran out"""
+        if self.write_record(idempotency_key, status, result, version=claimed_version) is None:
+            logger.warning(f"{idempotency_key} was taken over by another invocation, its {status} record is kept")
+
+    def claim(self, idempotency_key):
+        """
+        Claims the key for this invocation unless it was already handled
+        :return: tuple of the version of the claim, None if the key was already handled, and the stored result
+        :raises IdempotencyInProgressError: if another invocation is handling the key
+        """
+        record, version = self._read_versioned(idempotency_key)
+        if record is not None and not self.is_expired(record):
+            if record["status"] == STATUS_COMPLETED:
+                metrics.increment("idempotency_hit")
+                logger.info(f"{idempotency_key} was already handled, returning the stored result")
+                return None, record["result"]
+            if record["status"] == STATUS_IN_PROGRESS and time.time() - record["stored_at"] < IN_PROGRESS_LEASE_SECONDS:
+                raise IdempotencyInProgressError(f"{idempotency_key} is being handled by another invocation")
+        metrics.increment("idempotency_miss")
+        return self._claim(idempotency_key, version), None
+
+    def complete(self, idempotency_key, claimed_version, result):
+        """Stores the result of the claimed key, retried deliveries return it"""
+        self._finish(idempotency_key, STATUS_COMPLETED, claimed_version, result)
+
+    def fail(self, idempotency_key, claimed_version):
+        """Frees the claimed key for the retry of the delivery"""
+        self._finish(idempotency_key, STATUS_FAILED, claimed_version)
+
+    def run_once(self, idempotency_key, handler):
+        """
+        Runs the handler unless the key was already handled
+        :param idempotency_key: key of the event
+        :param handler: callable without arguments, its result has to be JSON serializable
+        :return: result of the handler, or the stored result of the first run
+        """
+        claimed_version, stored_result = self.claim(idempotency_key)
+        if claimed_version is None:
+            return stored_result
+        try:
+            result = handler()
+        except Exception:
+            self.fail(idempotency_key, claimed_version)
+            raise
+        self.complete(idempotency_key, claimed_version, result)
+        return result
+
+
+def get_idempotency_key_of(event, event_type):
+    """
+    Key of the event in the store, the events of a portfolio other than the default one have their own keys
+    :return: str, None if the event carries no "idempotency_key"
+    """
+    idempotency_key = event.get("idempotency_key")
+    if idempotency_key is None:
+        return None
+    if "portfolio_id" in event:
+        idempotency_key = f"{event['portfolio_id']}/{idempotency_key}"
+    return f"{event_type}/{idempotency_key}"
@@ -0,0 +1,122 @@
+import io
+import logging
+import math
+import time
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Twitter refuses images above 5 MB
+TWITTER_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+DEFAULT_MAX_PIXELS = 3840 * 2160
+
+
+class EncodedImage:
+    """Result of the encoding stage"""
+    def __init__(self, data, image_format, size, encode_seconds):
+        self.data = data
+        self.image_format = image_format
+        self.size = size
+        self.encode_seconds = encode_seconds
+
+    @property
+    def extension(self):
+        return {"png": ".png", "png-palette": ".png", "jpeg": ".jpg"}[self.image_format]
+
+    @property
+    def mime_type(self):
+        return "image/jpeg" if self.image_format == "jpeg" else "image/png"
+
+
+class ImageEncoder:
+    """
+    Encodes the rendered RGBA buffer into the smallest image which fits into the byte and pixel budget.
+    The candidates are a palette-quantized PNG, an optimized PNG and a high-quality JPEG
+    """
+    def __init__(self,
+                 max_bytes=TWITTER_MAX_IMAGE_BYTES,
+                 max_pixels=DEFAULT_MAX_PIXELS,
+                 jpeg_quality=90,
+                 max_downscale_steps=3):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.max_downscale_steps = max_downscale_steps
+
+    @staticmethod
+    def _encode_palette_png(image):
+        buffer = io.BytesIO()
+        image.quantize(colors=256, method=Image.FASTOCTREE).save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _encode_optimized_png(image):
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+    def _encode_jpeg(self, image):
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=self.jpeg_quality, optimize=True, subsampling=0)
+        return buffer.getvalue()
+
+    def fit_to_pixel_budget(self, image):
+        """Downscales the image keeping the aspect ratio if it has more pixels than the budget"""
+        width, height = image.size
+        if width * height <= self.max_pixels:
+            return image
+        scale = math.sqrt(self.max_pixels / (width * height))
+        new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        logger.info(f"Downscaling the image from {image.size} to {new_size} to fit the pixel budget")
+        return image.resize(new_size, Image.LANCZOS)
+
+    def encode_candidates(self, image):
+        """
+        Encodes the image with all the candidate formats
+        :param image: PIL image
+        :return: list of (format, bytes, seconds taken)
+        """
+        candidates = []
+        for image_format, encoder in (("png-palette", self._encode_palette_png),
+                                      ("png", self._encode_optimized_png),
+                                      ("jpeg", self._encode_jpeg)):
+            start = time.perf_counter()
+            data = encoder(image)
+            candidates.append((image_format, data, time.perf_counter() - start))
+        return candidates
+
+    def encode(self, rgba_buffer):
+        """
+        Produces the smallest image within the budget
+        :param rgba_buffer: numpy array of shape (height, width, 4) with the rendered figure
+        :return: EncodedImage
+        """
+        start = time.perf_counter()
+        rgba_array = np.asarray(rgba_buffer)
+        image = Image.fromarray(rgba_array)
+        # Matplotlib renders an opaque background, the alpha channel then only inflates the encodings
+        if bool(np.all(rgba_array[..., 3] == 255)):
+            image = image.convert("RGB")
+        image = self.fit_to_pixel_budget(image)
+
+        for _ in range(self.max_downscale_steps + 1):
+            candidates = self.encode_candidates(image)
+            image_format, data, format_seconds = min(candidates, key=lambda candidate: len(candidate[1]))
+            if len(data) <= self.max_bytes:
+                break
+            logger.info(f"Smallest candidate {image_format} has {len(data)} bytes, "
+                        f"more than the budget of {self.max_bytes} bytes")
+            image = image.resize((max(1, image.size[0] // 2), max(1, image.size[1] // 2)), Image.LANCZOS)
+        else:
+            raise ValueError(f"Could not encode the image within {self.max_bytes} bytes")
+
+        encoded_image = EncodedImage(data, image_format, image.size, time.perf_counter() - start)
+        logger.info(f"Encoded the image as {image_format} of {image.size} with {len(data)} bytes. "
+                    f"Encoding took {format_seconds:.3f}s, the whole stage {encoded_image.encode_seconds:.3f}s")
+        return encoded_image
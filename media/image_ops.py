@@ -1,10 +1,16 @@
+import contextlib
 import datetime
 import functools
 import logging
+import math
 import operator
+import os
 import pathlib
+import threading
 from typing import List, Dict, Tuple
 
+# Sets up the shipped font cache and matplotlibrc, has to precede the matplotlib imports
+import media.utils.mpl_config  # noqa: F401
 import chart_studio
 import numpy as np
 import plotly.graph_objects as go
@@ -12,8 +18,14 @@ from matplotlib import dates as mdates
 from matplotlib import pyplot as plt
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 
-from media.utils.postpro import PredictionOperations
+from media.export_worker import ExportSpec, get_export_worker
+from media.image_encoding import DEFAULT_MAX_PIXELS, ImageEncoder
+from media.bulk_sync import sync_artifacts
+from media.static_chart_export import StaticChartExporter
+from media.utils.aggregates import AggregatesStore
 from media.utils.general import get_parameter_from_ssm, alternate_sort_by_key
+from media.utils.history import DecodedHistory
+from media.utils.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -23,13 +35,14 @@ class GeneralGraph:
     def sanitize_data_for_plotting(data_from_db):
         """
         Converts the data obtained from the DB into printable format
-        :param data_from_db: list of 2-item tuples which are to be plotted
-        :return: Separated lists which should be plotted
+        :param data_from_db: DecodedHistory or list of 2-item tuples which are to be plotted
+        :return: Separated arrays of matplotlib dates and values which should be plotted
         """
-        epoch_time_milliseconds, values = zip(*data_from_db)
-        epoch_time_seconds = tuple(epoch_time / 1000 for epoch_time in epoch_time_milliseconds)
-        x_axis_date = mdates.epoch2num(epoch_time_seconds)
-        return x_axis_date, values
+        history = DecodedHistory.from_payload(data_from_db)
+        # matplotlib dates are days since its epoch, so the conversion is a single vectorized operation
+        epoch_offset_days = mdates.date2num(datetime.datetime(1970, 1, 1))
+        x_axis_date = history.timestamps_ms / 86400000 + epoch_offset_days
+        return x_axis_date, history.values
 
     @staticmethod
     def flatten_all_history_to_coin_name_quantity(raw_dict_all_coin_history):
@@ -64,10 +77,20 @@ class CryptoCoinImage:
         return pathlib.Path(self.image_root / directory / "color" / f"{coin.lower()}.png")
 
 
+@functools.lru_cache(maxsize=None)
+def read_icon(icon_path):
+    """Icons are read once per container"""
+    return plt.imread(icon_path, format='png')
+
+
 class MatplotlibGraph(GeneralGraph):
     """
-    Involved in generating the graphs and the twitter pictures
+    Involved in generating the graphs and the twitter pictures.
+    The axes and their styling are static, the artists drawing the data are tracked so that reset_data
+    removes them and the same figure renders the next image
     """
+    _template = None
+    _template_lock = threading.Lock()
 
     def __init__(self):
         self.ratio_multiplier = 5
@@ -80,36 +103,80 @@ class MatplotlibGraph(GeneralGraph):
         self.table_border_color = "k"
         self.table_header_color = '#40466e'
         self.row_colors = ['#f1f1f2', 'w']
+        self.data_artists = []
+        self.apply_static_style()
 
-    def format_the_graph(self):
+    @classmethod
+    @contextlib.contextmanager
+    def reusing_template(cls):
         """
-        Sets the format for the graph ticks and what not
-        :return:Nothing
+        Lends the styled figure of the container, built on first use. Its data is removed once it is returned
+        :return: MatplotlibGraph
         """
+        with cls._template_lock:
+            if cls._template is None:
+                cls._template = cls()
+                logger.info("Built the figure template of the tweet image")
+            try:
+                yield cls._template
+            finally:
+                cls._template.reset_data()
+
+    def _track(self, *artists):
+        self.data_artists.extend(artists)
+
+    def reset_data(self):
+        """Removes the artists drawing the data, the styling of the figure stays"""
+        for artist in self.data_artists:
+            artist.remove()
+        self.data_artists = []
+        # The pie and the fill took colors from the cycles, the next image starts over from the first color
+        self.main_axis.set_prop_cycle(None)
+        self.pie_axis.set_prop_cycle(None)
+        # Forgets the limits of the removed data, the next data is autoscaled again
+        self.main_axis.relim()
+        self.main_axis.set_autoscale_on(True)
+
+    def apply_static_style(self):
+        """Styles the figure independently of the data"""
+        self.fig.set_size_inches(16 * self.ratio_multiplier,
+                                 9 * self.ratio_multiplier)
         date_fmt = '%d-%b-%y'
         date_formatter = mdates.DateFormatter(date_fmt)
         self.main_axis.xaxis.set_major_formatter(date_formatter)
-        self.main_axis.tick_params(axis='both', which='major', pad=10 * self.ratio_multiplier)
+        self.main_axis.tick_params(axis='both', which='major', pad=10 * self.ratio_multiplier,
+                                   labelsize=self.font_size)
         self.main_axis.set_xlabel('Time', fontsize=self.font_size, labelpad=10*self.ratio_multiplier)
         self.main_axis.set_ylabel('Total value [in ETH/Ξ]', fontsize=self.font_size, labelpad=10*self.ratio_multiplier)
-        self.main_axis.set_ylim(bottom=10)
         self.main_axis.grid(True)
         self.main_axis.grid(linewidth=2, linestyle="--")
         locator = mdates.AutoDateLocator(minticks=3, maxticks=7)
         self.main_axis.xaxis.set_major_locator(locator)
-        plt.setp(self.main_axis.get_xticklabels(), fontsize=self.font_size)
-        plt.setp(self.main_axis.get_yticklabels(), fontsize=self.font_size)
+
+    def format_the_graph(self, starting_value=10):
+        """
+        Sets the format of the graph which depends on the data
+        :param starting_value: ETH held at the start of the portfolio, the bottom of the graph
+        :return:Nothing
+        """
+        self.main_axis.set_ylim(bottom=starting_value)
 
     def generate_history_graph(self,
-                               eth_vs_ts_history_full: List[Dict]):
+                               eth_vs_ts_history_full: List[Dict],
+                               aggregates=None,
+                               starting_value=10):
         """
         Generates the graph and formats it accordingly
         :param eth_vs_ts_history_full: data from the DB rows
+        :param aggregates: HoldingAggregates of the history, the persisted aggregates by default
+        :param starting_value: ETH held at the start of the portfolio, the area is filled down to it
         :return: Nothing
         """
-        x_axis_data, y_axis_data = self.sanitize_data_for_plotting(eth_vs_ts_history_full)
-        self.main_axis.fill_between(x_axis_data, y_axis_data, y2=10, alpha=0.4)
-        self.format_the_graph()
+        aggregates = aggregates or AggregatesStore().get_updated(eth_vs_ts_history_full)
+        hourly_overview = DecodedHistory(*aggregates.series("hourly"))
+        x_axis_data, y_axis_data = self.sanitize_data_for_plotting(hourly_overview)
+        self._track(self.main_axis.fill_between(x_axis_data, y_axis_data, y2=starting_value, alpha=0.4))
+        self.format_the_graph(starting_value)
 
     def generate_donut_chart(self,
                              coin_rows: List[Dict]):
@@ -125,6 +192,7 @@ class MatplotlibGraph(GeneralGraph):
                                          startangle=90,
                                          textprops={"fontsize": self.font_size/1.5}
                                          )
+        self._track(*wedges, *text)
         self.annotate_text_and_icons_to_wedges(wedges, coins)
 
     def generate_inner_text(self,
@@ -138,52 +206,48 @@ class MatplotlibGraph(GeneralGraph):
             operator.add,
             map(lambda x: x["TOTAL_ETH_EQUIVALENT"], coin_overall_rows)
         )
-        self.pie_axis.text(0, 0.09,
-                           f"{total_eth:.2f} Ξ",
-                           ha="center",
-                           color="white",
-                           fontsize=self.font_size)
+        self._track(self.pie_axis.text(0, 0.09,
+                                       f"{total_eth:.2f} Ξ",
+                                       ha="center",
+                                       color="white",
+                                       fontsize=self.font_size))
 
     def generate_inner_circle(self,
                               coin_overall_rows: [Dict],
-                              eth_vs_ts_history_full: List[Tuple]):
+                              eth_vs_ts_history_full: List[Tuple],
+                              aggregates=None):
         """
         Generates the inner-circle with some text on the ETH and the percentage
         :param coin_overall_rows: All the coin rows in the form of a list of dicts
         :param eth_vs_ts_history_full: The history of the coin in list of tuple
+        :param aggregates: HoldingAggregates of the history, the persisted aggregates by default
         """
         self.generate_inner_text(coin_overall_rows)
 
-        prediction = PredictionOperations()
-        monthly_change = prediction.get_percentage_diff_for_history(
-            datetime.timedelta(days=30),
-            eth_vs_ts_history_full
-        )
-        weekly_change = prediction.get_percentage_diff_for_history(
-            datetime.timedelta(days=7),
-            eth_vs_ts_history_full
-        )
-        self.pie_axis.text(0, -0.05,
-                           f"week: {weekly_change:.2f} %",
-                           ha="center",
-                           color="white",
-                           fontsize=self.font_size/2)
-        self.pie_axis.text(0, -0.15,
-                           f"month: {monthly_change:.2f} %",
-                           ha="center",
-                           color="white",
-                           fontsize=self.font_size/2)
+        aggregates = aggregates or AggregatesStore().get_updated(eth_vs_ts_history_full)
+        monthly_change = aggregates.percentage_change_over(datetime.timedelta(days=30))
+        weekly_change = aggregates.percentage_change_over(datetime.timedelta(days=7))
+        self._track(self.pie_axis.text(0, -0.05,
+                                       f"week: {weekly_change:.2f} %",
+                                       ha="center",
+                                       color="white",
+                                       fontsize=self.font_size/2),
+                    self.pie_axis.text(0, -0.15,
+                                       f"month: {monthly_change:.2f} %",
+                                       ha="center",
+                                       color="white",
+                                       fontsize=self.font_size/2))
 
         if (monthly_change > 0) or (weekly_change > 0):
             color = "green"
         else:
             color = "red"
 
-        self.pie_axis.add_artist(plt.Circle((0, 0),
-                                            (1-self.width_of_donut)/2,
-                                            facecolor=color,
-                                            alpha=0.5,
-                                            edgecolor="None"))
+        self._track(self.pie_axis.add_artist(plt.Circle((0, 0),
+                                                        (1-self.width_of_donut)/2,
+                                                        facecolor=color,
+                                                        alpha=0.5,
+                                                        edgecolor="None")))
 
     def annotate_text_and_icons_to_wedges(self,
                                           wedges: List,
@@ -205,11 +269,11 @@ class MatplotlibGraph(GeneralGraph):
             horizontalalignment = {-1: "right", 1: "left"}[int(np.sign(x))]
             connectionstyle = "angle,angleA=0,angleB={}".format(ang)
             kw["arrowprops"].update({"connectionstyle": connectionstyle})
-            self.pie_axis.annotate(coin,
-                                   xy=(x, y),
-                                   xytext=(0.75 * np.sign(x), 1.4 * y),
-                                   horizontalalignment=horizontalalignment,
-                                   **kw)
+            self._track(self.pie_axis.annotate(coin,
+                                               xy=(x, y),
+                                               xytext=(0.75 * np.sign(x), 1.4 * y),
+                                               horizontalalignment=horizontalalignment,
+                                               **kw))
             self.insert_symbol_into_annotation(coin, position=(x, y))
 
     def insert_symbol_into_annotation(self,
@@ -222,38 +286,80 @@ class MatplotlibGraph(GeneralGraph):
         """
         image_location = CryptoCoinImage()
         if image_location.get_icon_image_of(coin).exists():
-            im = plt.imread(image_location.get_icon_image_of(coin).__str__(), format='png')
+            im = read_icon(image_location.get_icon_image_of(coin).__str__())
             imagebox = OffsetImage(im, zoom=1)
             imagebox.image.axes = self.pie_axis
             ab = AnnotationBbox(imagebox,
                                 (0.65 * np.sign(position[0]), 1.4 * position[1]),
                                 bboxprops={"edgecolor": "None"})
-            self.pie_axis.add_artist(ab)
+            self._track(self.pie_axis.add_artist(ab))
 
-    def save_image(self, image_path):
+    def save_image(self, destination, image_format="png"):
         """
-        Saves the image into the path specified
-        :param image_path: path of the image (str/pathlib.Path)
+        Saves the image into the path or the buffer specified
+        :param destination: path of the image (str/pathlib.Path) or a binary file-like object, eg. io.BytesIO
+        :param image_format: format of the image written into a file-like object
         :return: Nothing
         """
-        if pathlib.Path(image_path).exists() is True:
-            figure = plt.gcf()  # get current figure
-            figure.set_size_inches(16 * self.ratio_multiplier,
-                                   9 * self.ratio_multiplier)
-            plt.savefig(image_path)
-        else:
-            raise IOError(f"Image path does not exist at {image_path}")
+        is_buffer = hasattr(destination, "write")
+        if not is_buffer and not pathlib.Path(destination).parent.is_dir():
+            raise IOError(f"Image directory does not exist for {destination}")
+        self.fig.savefig(destination, format=image_format if is_buffer else None)
+
+    def fit_dpi_to_pixel_budget(self, max_pixels):
+        """Sets the resolution of the figure to the largest one within the pixel budget, the layout is kept"""
+        width, height = self.fig.get_size_inches()
+        dpi = math.floor(math.sqrt(max_pixels / (width * height)) * 100) / 100
+        if self.fig.get_dpi() != dpi:
+            self.fig.set_dpi(dpi)
+
+    def render_rgba(self, max_pixels=DEFAULT_MAX_PIXELS):
+        """
+        Renders the figure into memory, at the resolution of the pixel budget so no pixel is rendered to be thrown
+        away by the encoder
+        :return: numpy array of shape (height, width, 4)
+        """
+        self.fit_dpi_to_pixel_budget(max_pixels)
+        self.fig.canvas.draw()
+        return np.asarray(self.fig.canvas.buffer_rgba())
+
+    def encode_image(self, encoder=None):
+        """
+        Renders the figure and encodes it into the smallest image within the budget of the encoder. The drawing is
+        timed as the render stage, only the encoding as the encode stage
+        :param encoder: ImageEncoder, uses the twitter budget by default
+        :return: EncodedImage
+        """
+        encoder = encoder if encoder is not None else ImageEncoder()
+        with metrics.stage("render"):
+            rgba_buffer = self.render_rgba(encoder.max_pixels)
+        with metrics.stage("encode"):
+            return encoder.encode(rgba_buffer)
+
+    def close(self):
+        """Releases the figure and its canvas buffers, pyplot holds on to them until the figure is closed"""
+        plt.close(self.fig)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class PyplotGraph(GeneralGraph):
     """Pyplot graph for the blog"""
     def __init__(self):
         self.fig = go.Figure()
+        logger.info("Generated the plotly object")
+
+    @staticmethod
+    def login_to_chart_studio():
         username = get_parameter_from_ssm('PLOTLY_USERNAME')
         api_key = get_parameter_from_ssm('PLOTLY_API_KEY')
         chart_studio.tools.set_credentials_file(username=username,
                                                 api_key=api_key)
-        logger.info("Generated the plotly object and logged in with the credentials")
+        logger.info("Logged in to chart_studio with the credentials")
 
     def format_xlabel(self):
         self.fig.update_layout(xaxis={"type": "date"})
@@ -289,14 +395,17 @@ class PyplotGraph(GeneralGraph):
         logger.info("Modified the general format of the plotly graph")
 
     def generate_graph(self, entire_history_dict, dict_each_coin_timestamped):
-        # TODO Use datetime object. But plotly does not plot smooth graph
-        date_plot_list = [datetime.datetime.fromtimestamp(x[0] / 1000) for x in dict_each_coin_timestamped]
-        eth_value_list = [x[1] for x in dict_each_coin_timestamped]
+        """
+        Plots the history. The trace data stays in float64 arrays of epoch milliseconds and values,
+        which the date x-axis shows as dates, instead of lists of datetime objects
+        """
+        history = DecodedHistory.from_payload(dict_each_coin_timestamped)
         flattened_coin_history_dict = self.flatten_all_history_to_coin_name_quantity(entire_history_dict)
-        coin_name_list = [flattened_coin_history_dict.get(ts[0], "") for ts in dict_each_coin_timestamped]
+        coin_name_list = [flattened_coin_history_dict.get(timestamp, "")
+                          for timestamp in history.timestamps_ms.tolist()]
         self.fig.add_trace(go.Scatter(
-            x=date_plot_list,
-            y=eth_value_list,
+            x=history.timestamps_ms.astype(np.float64),
+            y=history.values,
             mode="lines",
             name="Lines",
             hovertext=coin_name_list,
@@ -308,26 +417,69 @@ class PyplotGraph(GeneralGraph):
 
     @staticmethod
     def save_image_to_location(figure_handle, path_to_write):
-        save_result = figure_handle.write_image(path_to_write)
-        return save_result
+        """Exports the figure through the warm export worker, in the format of the extension of the path"""
+        spec = ExportSpec.from_path(path_to_write)
+        exported_images = get_export_worker().export(figure_handle, [spec])
+        with open(path_to_write, "wb") as fp:
+            fp.write(exported_images[spec.name])
+        return path_to_write
+
+    @staticmethod
+    def publish_static_images(figure_handle,
+                              specs,
+                              destination_stem="assets/charts/eth-challenge"):
+        """
+        Exports the figure in all the specs with a single request to the export worker and publishes the images
+        :param specs: list of ExportSpec
+        :param destination_stem: key of the images without the extension
+        :return: list of the keys of the published images
+        """
+        exported_images = get_export_worker().export(figure_handle, specs)
+        sync_results = sync_artifacts((f"{destination_stem}.{spec_name}", image_content)
+                                      for spec_name, image_content in exported_images.items())
+        published_keys = [result.key for result in sync_results if result.success]
+        logger.info(f"Published the static images {published_keys}")
+        return published_keys
 
     @staticmethod
     def upload_image_to_server(fig,
                                ):
+        """
+        Uploads the figure to chart_studio. Its payload keeps plain JSON lists: chart_studio validates the figure
+        with the plotly 4 validators, which reject typed arrays, and renders it with a plotly.js that can not decode
+        them. The compact typed arrays of figure_to_compact_json are only used by the pages published by the service
+        """
         logger.info("Attempting to load the graph on the chart_studio")
-        chart_studio.plotly.plot(fig,
-                                 auto_open=False,
-                                 )
+        with metrics.stage("upload"):
+            chart_studio.plotly.plot(fig,
+                                     auto_open=False,
+                                     )
 
     @classmethod
     def publish_image_overall(cls,
                               entire_coin_history_vs_timestamp,
-                              eth_vs_timestamp_history_full):
+                              eth_vs_timestamp_history_full,
+                              export_mode=None):
+        """
+        Publishes the history graph
+        :param export_mode: "chart_studio" uploads to chart_studio, "static" publishes a standalone HTML page
+        through the storage layer. Defaults to VC_PLOTLY_EXPORT_MODE or chart_studio.
+        The static images listed in VC_PLOTLY_IMAGE_FORMATS (eg. "png,svg") are published in both modes
+        :return: key of the published page in the static mode
+        """
+        export_mode = export_mode or os.environ.get("VC_PLOTLY_EXPORT_MODE", "chart_studio")
+        if export_mode not in ("chart_studio", "static"):
+            raise ValueError(f"Unknown plotly export mode {export_mode}")
         plotly_graph_handle = PyplotGraph()
-        figure = plotly_graph_handle.generate_graph(entire_coin_history_vs_timestamp,
-                                                    eth_vs_timestamp_history_full)
+        with metrics.stage("render"):
+            figure = plotly_graph_handle.generate_graph(entire_coin_history_vs_timestamp,
+                                                        eth_vs_timestamp_history_full)
+        image_formats = os.environ.get("VC_PLOTLY_IMAGE_FORMATS", "")
+        if image_formats:
+            plotly_graph_handle.publish_static_images(figure, [ExportSpec(image_format=image_format.strip())
+                                                               for image_format in image_formats.split(",")])
+        if export_mode == "static":
+            return StaticChartExporter().publish(figure)
+        plotly_graph_handle.login_to_chart_studio()
         plotly_graph_handle.upload_image_to_server(figure,
                                                    )
-
-
-
@@ -0,0 +1,164 @@
+"""
+Handles the events of many portfolios in a single invocation. The tweet images, the CPU bound part, are rendered
+in worker processes. Everything reading or writing the storage, or posting, stays in the invoking process, so the
+portfolios share its templates, storage and twitter clients and the posting limit. The idempotency key of each
+event is claimed first, so a retried batch neither renders nor updates the aggregates of the events already handled
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from media.idempotency import IdempotencyStore, get_idempotency_key_of
+from media.portfolios import DEFAULT_PORTFOLIO_ID, get_portfolio_of
+from media.tweet_ops import encode_the_image_for_twitter
+from media.utils.aggregates import AggregatesStore
+from media.utils.general import MediaEnum
+from media.utils.history import decode_event
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PORTFOLIO_EVENT_TYPES = (MediaEnum.tweet, MediaEnum.blog_main_page, MediaEnum.blog_ind_page)
+
+
+def render_tweet_image(eth_full_history, new_rows, aggregates, starting_value):
+    """
+    Renders and encodes the tweet image of a portfolio. Runs in the worker processes, each one reuses its own
+    figure template and the fonts and icons it loaded for the previous portfolios
+    :param starting_value: ETH held at the start of the portfolio
+    :return: EncodedImage
+    """
+    return encode_the_image_for_twitter(eth_full_history, new_rows, aggregates, starting_value)
+
+
+class PortfolioBatch:
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    @staticmethod
+    def _get_result_of(future):
+        try:
+            return future.result()
+        except Exception:
+            logger.exception("Rendering a tweet image of the batch failed, its event renders it again")
+            return None
+
+    def _render_all(self, render_inputs):
+        """
+        Renders in a process pool, or one after the other where processes are unavailable (eg. lambda)
+        :return: list of EncodedImage, None for the images which failed
+        """
+        if len(render_inputs) > 1 and (self.max_workers or os.cpu_count() or 1) > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                    futures = [pool.submit(render_tweet_image, *render_input) for render_input in render_inputs]
+                    return [self._get_result_of(future) for future in futures]
+            except (OSError, NotImplementedError) as error:
+                logger.info(f"Rendering the tweet images sequentially, no process pool: {error}")
+        encoded_images = []
+        for render_input in render_inputs:
+            try:
+                encoded_images.append(render_tweet_image(*render_input))
+            except Exception:
+                logger.exception("Rendering a tweet image of the batch failed, its event renders it again")
+                encoded_images.append(None)
+        return encoded_images
+
+    def render_tweet_images(self, events):
+        """
+        Renders the images of the tweet events. The aggregates are updated here, so the workers never touch
+        the storage
+        :param events: decoded events of the batch
+        :return: dict of the index of the event: EncodedImage, the events whose image failed are left out
+        """
+        tweet_indexes, render_inputs = [], []
+        for index, event in enumerate(events):
+            if event["type"] != MediaEnum.tweet.value:
+                continue
+            try:
+                portfolio = get_portfolio_of(event)
+                aggregates = AggregatesStore(portfolio.aggregates_file_name).get_updated(event["eth_full_history"])
+            except Exception:
+                logger.exception(f"No aggregates for the tweet image of {event.get('portfolio_id')}")
+                continue
+            tweet_indexes.append(index)
+            render_inputs.append((event["eth_full_history"], event["new_rows"], aggregates, portfolio.starting_value))
+        if not render_inputs:
+            return {}
+        with metrics.stage("batch_render"):
+            encoded_images = self._render_all(render_inputs)
+        return {index: encoded_image for index, encoded_image in zip(tweet_indexes, encoded_images)
+                if encoded_image is not None}
+
+    @staticmethod
+    def _claim(store, event, outcome):
+        """
+        Claims the idempotency key of the event, if it has one
+        :return: tuple of whether the event is to be handled and the claim, a tuple of the key and its version
+        """
+        idempotency_key = get_idempotency_key_of(event, event["type"])
+        if idempotency_key is None:
+            return True, None
+        try:
+            claimed_version, stored_result = store.claim(idempotency_key)
+        except Exception as error:
+            logger.info(f"Skipped the {event['type']} event of {outcome['portfolio_id']}: {error}")
+            outcome["error"] = str(error)
+            return False, None
+        if claimed_version is None:
+            outcome["result"] = stored_result
+            return False, None
+        return True, (idempotency_key, claimed_version)
+
+    def run(self, events, handle_event):
+        """
+        Handles the events of the portfolios in their order. A failing portfolio does not stop the others
+        :param events: list of the events of the portfolios, each one with its "type" and "portfolio_id"
+        :param handle_event: callable of the event and the EncodedImage rendered for it (None for the pages),
+        handles a single event of the batch
+        :return: list of dicts with the portfolio_id, the type and either the result or the error of each event
+        """
+        for event in events:
+            if MediaEnum(event["type"]) not in PORTFOLIO_EVENT_TYPES:
+                raise ValueError(f"{event['type']} events can not be batched")
+        store = IdempotencyStore()
+        results, pending = [], []
+        for event in events:
+            outcome = {"portfolio_id": event.get("portfolio_id", DEFAULT_PORTFOLIO_ID), "type": event["type"]}
+            results.append(outcome)
+            to_handle, claim = self._claim(store, event, outcome)
+            if to_handle:
+                pending.append((event, outcome, claim))
+        try:
+            with metrics.stage("decode"):
+                pending_events = [decode_event(event) for event, _, _ in pending]
+            encoded_images = self.render_tweet_images(pending_events)
+        except Exception as error:
+            # Frees the claimed keys, the retried batch handles the events again
+            for _, outcome, claim in pending:
+                self._finish(store, claim, {"error": str(error)})
+            raise
+        for position, (event, (_, outcome, claim)) in enumerate(zip(pending_events, pending)):
+            try:
+                outcome["result"] = handle_event(event, encoded_images.get(position))
+            except Exception as error:
+                logger.exception(f"The {event['type']} event of {outcome['portfolio_id']} failed")
+                metrics.increment("portfolio_failed")
+                outcome["error"] = str(error)
+            self._finish(store, claim, outcome)
+        logger.info(f"Handled {len(pending)} of the {len(events)} events of the batch, "
+                    f"{sum('error' in outcome for outcome in results)} failed")
+        return results
+
+    @staticmethod
+    def _finish(store, claim, outcome):
+        """Stores the result of the claimed event, or frees its key for a retry if it failed"""
+        if claim is None:
+            return
+        try:
+            if "error" in outcome:
+                store.fail(*claim)
+            else:
+                store.complete(*claim, outcome["result"])
+        except Exception:
+            logger.exception(f"Could not store the outcome of {claim[0]}")
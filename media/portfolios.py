@@ -0,0 +1,186 @@
+"""
+Configuration of the portfolios published by the service. The original "10 ETH Challenge" is the default
+portfolio and keeps its paths, every other portfolio gets paths derived from its id unless its config sets them.
+The configs are read from db/portfolios.json, a dict of portfolio id: config, and the events may override them.
+The default portfolio is built in, its events need neither. The keys a portfolio writes stay under its own
+prefixes, so no config reaches the DB or the keys of another portfolio
+"""
+import datetime
+import json
+import logging
+import re
+
+from media.read_cache import ReadThroughCache
+from media.s3_file_access import S3FileAccessAbstract
+
+logger = logging.getLogger(__name__)
+
+PORTFOLIOS_FILE_NAME = "db/portfolios.json"
+DEFAULT_PORTFOLIO_ID = "10-eth-challenge"
+PORTFOLIO_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]*$")
+PATH_KEYS = ("main_page_path", "blog_post_dir", "aggregates_file_name")
+TEMPLATE_DIR = "_layouts"
+
+DEFAULT_PORTFOLIO_CONFIG = {"name": "10 ETH Challenge",
+                            "start_date": "2020-02-02",
+                            "starting_value": 10,
+                            "started_on_label": "10-Feb-2020",
+                            "hashtag": "#10ETHChallenge",
+                            "main_page_path": "crypto_update.md",
+                            "blog_post_dir": "_posts/crypto",
+                            "aggregates_file_name": "db/eth_holding_aggregates.json"}
+
+
+def is_below(path, directory):
+    """Whether the path is the directory or below it, and can not escape it, eg. with .. or an absolute path"""
+    parts = path.split("/")
+    return (path == directory or path.startswith(directory + "/")) and "\\" not in path and \
+        all(part not in ("", ".", "..") for part in parts)
+
+
+class PortfolioConfig:
+    """Everything which differs between the portfolios: the start of the simulation, the texts and the paths"""
+    def __init__(self,
+                 portfolio_id,
+                 name=None,
+                 start_date="2020-02-02",
+                 starting_value=10,
+                 started_on_label=None,
+                 hashtag=None,
+                 main_page_path=None,
+                 blog_post_dir=None,
+                 main_template="_layouts/template-eth-challenge-main.md",
+                 blog_template="_layouts/template-eth-challenge-blog.md",
+                 aggregates_file_name=None):
+        """
+        :param portfolio_id: lowercase letters, digits and dashes, it is part of the keys of the portfolio
+        :param start_date: "YYYY-MM-DD" or datetime.datetime the simulation started on
+        :param starting_value: ETH held at the start
+        """
+        if not PORTFOLIO_ID_PATTERN.match(portfolio_id):
+            raise ValueError(f"Invalid portfolio id {portfolio_id!r}")
+        # The posts of the default portfolio are named after its id plus a number, eg. 10-eth-challenge1
+        if portfolio_id != DEFAULT_PORTFOLIO_ID and portfolio_id.startswith(DEFAULT_PORTFOLIO_ID):
+            raise ValueError(f"The portfolio id {portfolio_id!r} collides with the default portfolio")
+        self.portfolio_id = portfolio_id
+        self.name = name or portfolio_id
+        self.start_date = start_date if isinstance(start_date, datetime.datetime) else \
+            datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        self.starting_value = starting_value
+        self.started_on_label = started_on_label or self.start_date.strftime("%d-%b-%Y")
+        self.hashtag = hashtag or "#" + "".join(part.capitalize() for part in portfolio_id.split("-"))
+        self.main_page_path = main_page_path or f"crypto_update-{portfolio_id}.md"
+        self.blog_post_dir = blog_post_dir or f"_posts/crypto/{portfolio_id}"
+        self.main_template = main_template
+        self.blog_template = blog_template
+        self.aggregates_file_name = aggregates_file_name or f"db/portfolios/{portfolio_id}/eth_holding_aggregates.json"
+        self.validate_paths()
+
+    @property
+    def is_default(self):
+        return self.portfolio_id == DEFAULT_PORTFOLIO_ID
+
+    def get_path_prefixes(self):
+        """
+        :return: dict of the path key: directory of the portfolio the path has to be, or to be below
+        """
+        return {"main_page_path": f"crypto_update-{self.portfolio_id}",
+                "blog_post_dir": f"_posts/crypto/{self.portfolio_id}",
+                "aggregates_file_name": f"db/portfolios/{self.portfolio_id}"}
+
+    def validate_paths(self):
+        """
+        The default portfolio keeps its paths, any other one writes only below its own prefixes
+        :raises ValueError: for a path outside of them
+        """
+        for template in (self.main_template, self.blog_template):
+            if not is_below(template, TEMPLATE_DIR) or template == TEMPLATE_DIR:
+                raise ValueError(f"The template {template!r} of {self.portfolio_id} is not in {TEMPLATE_DIR}")
+        if self.is_default:
+            changed_keys = [key for key in PATH_KEYS if getattr(self, key) != DEFAULT_PORTFOLIO_CONFIG[key]]
+            if changed_keys:
+                raise ValueError(f"The paths {changed_keys} of the default portfolio can not be changed")
+            return
+        for key, prefix in self.get_path_prefixes().items():
+            path = getattr(self, key)
+            # The main page may also sit next to the directory, as crypto_update-<portfolio id>.md
+            if not (is_below(path, prefix) or key == "main_page_path" and path == f"{prefix}.md"):
+                raise ValueError(f"The {key} {path!r} of {self.portfolio_id} is not below {prefix}")
+
+    def to_dict(self):
+        return {"portfolio_id": self.portfolio_id,
+                "name": self.name,
+                "start_date": self.start_date.strftime("%Y-%m-%d"),
+                "starting_value": self.starting_value,
+                "started_on_label": self.started_on_label,
+                "hashtag": self.hashtag,
+                "main_page_path": self.main_page_path,
+                "blog_post_dir": self.blog_post_dir,
+                "main_template": self.main_template,
+                "blog_template": self.blog_template,
+                "aggregates_file_name": self.aggregates_file_name}
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(**content)
+
+    def __repr__(self):
+        return f"PortfolioConfig({self.portfolio_id!r})"
+
+
+class PortfolioRegistry:
+    """
+    Reads the configs of db/portfolios.json through the local read cache for every event, so a changed file is used
+    by the next event. The parsed configs are kept per version of the file
+    """
+    _parsed_configs = {}
+
+    def __init__(self, file_name=PORTFOLIOS_FILE_NAME):
+        self.file_name = file_name
+
+    def get_stored_configs(self):
+        """
+        :return: dict of portfolio id: config dict
+        """
+        file_access = S3FileAccessAbstract(file_name=self.file_name, cached=True)
+        cache_key = (file_access.backend.location, self.file_name)
+        try:
+            with file_access as portfolios_file:
+                version = ReadThroughCache().get_cached_version(file_access.backend, self.file_name)
+                parsed = PortfolioRegistry._parsed_configs.get(cache_key)
+                if version is None or parsed is None or parsed[0] != version:
+                    with open(portfolios_file, "r") as fp:
+                        parsed = (version, json.load(fp))
+                    PortfolioRegistry._parsed_configs[cache_key] = parsed
+        except FileNotFoundError:
+            logger.info(f"No portfolio configs at {self.file_name}, only the defaults are known")
+            return {}
+        return parsed[1]
+
+    def get(self, portfolio_id=DEFAULT_PORTFOLIO_ID, overrides=None):
+        """
+        Builds the config of the portfolio from its defaults, the stored config and the overrides, in that order
+        :param overrides: dict of the config values given by the event
+        :return: PortfolioConfig
+        """
+        content = dict(DEFAULT_PORTFOLIO_CONFIG) if portfolio_id == DEFAULT_PORTFOLIO_ID else {}
+        content.update(self.get_stored_configs().get(portfolio_id, {}))
+        content.update(overrides or {})
+        content["portfolio_id"] = portfolio_id
+        return PortfolioConfig.from_dict(content)
+
+
+def get_default_portfolio():
+    return PortfolioConfig.from_dict(dict(DEFAULT_PORTFOLIO_CONFIG, portfolio_id=DEFAULT_PORTFOLIO_ID))
+
+
+def get_portfolio_of(event):
+    """
+    Config of the portfolio the event is for. Events without a "portfolio_id" are for the default portfolio
+    :param event: dict with the optional keys "portfolio_id" and "portfolio_config"
+    :return: PortfolioConfig
+    """
+    portfolio_id = event.get("portfolio_id", DEFAULT_PORTFOLIO_ID)
+    if portfolio_id == DEFAULT_PORTFOLIO_ID and not event.get("portfolio_config"):
+        return get_default_portfolio()
+    return PortfolioRegistry().get(portfolio_id, event.get("portfolio_config"))
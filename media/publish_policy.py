@@ -0,0 +1,69 @@
+import gzip
+import mimetypes
+import re
+
+mimetypes.add_type("text/markdown", ".md")
+mimetypes.add_type("image/svg+xml", ".svg")
+
+TEXT_CONTENT_TYPES = {"application/javascript", "application/json", "image/svg+xml"}
+# Sources of the Jekyll build, eg. _posts/, _layouts/, _config.yml and the Markdown pages. The build reads them as
+# they are stored, so they are never compressed
+SITE_SOURCE_PATTERN = re.compile(r"^_|\.(md|markdown)$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ArtifactPolicy:
+    """Content type, content encoding and cache lifetime of a published artifact"""
+    def __init__(self, content_type, cache_control, compress):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.compress = compress
+
+    @property
+    def content_encoding(self):
+        return "gzip" if self.compress else None
+
+    def encode(self, content):
+        """Returns the payload to store for the raw content"""
+        # mtime=0 keeps the payload, and thereby the ETag, stable for unchanged content
+        return gzip.compress(content, mtime=0) if self.compress else content
+
+    def extra_args(self):
+        """Metadata of the object as the ExtraArgs of boto3"""
+        extra_args = {"ContentType": self.content_type, "CacheControl": self.cache_control}
+        if self.content_encoding is not None:
+            extra_args["ContentEncoding"] = self.content_encoding
+        return extra_args
+
+
+# (pattern of the key, cache control, whether text is compressed). The first match wins
+ARTIFACT_RULES = [
+    (re.compile(r"^db/"), "no-store", False),
+    (re.compile(r"^crypto_update(-[a-z0-9-]+)?\.md$"), "public, max-age=300", False),
+    # The sparklines are named after the hash of their input, their content never changes
+    (re.compile(r"^assets/images/sparklines/[^/]+-[0-9a-f]{12}\.png$"), IMMUTABLE_CACHE_CONTROL, True),
+    (re.compile(r"^assets/js/plotly-[0-9.]+\.min\.js$"), IMMUTABLE_CACHE_CONTROL, True),
+    (re.compile(r"^assets/charts/"), "public, max-age=300", True),
+    (re.compile(r"^_posts/"), "public, max-age=3600", False),
+    (re.compile(r""), "public, max-age=3600", True),
+]
+
+
+def is_text_content_type(content_type):
+    return content_type.startswith("text/") or content_type in TEXT_CONTENT_TYPES
+
+
+def get_artifact_policy(key):
+    """
+    Returns the policy of the artifact stored at key
+    :param key: key of the artifact, eg. crypto_update.md
+    """
+    content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    if content_type.startswith("text/"):
+        content_type += "; charset=utf-8"
+    for pattern, cache_control, compress_text in ARTIFACT_RULES:
+        if pattern.search(key):
+            return ArtifactPolicy(content_type=content_type,
+                                  cache_control=cache_control,
+                                  compress=compress_text and is_text_content_type(content_type) and
+                                  not SITE_SOURCE_PATTERN.search(key))
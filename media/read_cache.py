@@ -0,0 +1,201 @@
+"""
+Read-through cache of the stored objects in the local /tmp of the container, shared by the threads and the
+processes of the container. An object read again within VC_READ_CACHE_TTL_SECONDS (0 by default) costs no request,
+afterwards its validator (the ETag on S3) is compared with a HEAD request and it is only downloaded if it changed.
+The least recently used objects are evicted above VC_READ_CACHE_MAX_MB (256 by default).
+    VC_READ_CACHE_DIR: directory of the cache, <tmp>/vc_read_cache by default
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pathlib
+import tempfile
+import time
+
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReadThroughCache:
+    def __init__(self, directory=None, max_bytes=None, ttl_seconds=None):
+        self.directory = pathlib.Path(directory or os.environ.get(
+            "VC_READ_CACHE_DIR", pathlib.Path(tempfile.gettempdir()) / "vc_read_cache"))
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            int(float(os.environ.get("VC_READ_CACHE_MAX_MB", "256")) * 1024 * 1024)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            float(os.environ.get("VC_READ_CACHE_TTL_SECONDS", "0"))
+
+    def _entry_name_of(self, backend, key):
+        return hashlib.sha256(f"{backend.location}/{key}".encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def _locked(self, entry_name, blocking=True, shared=False):
+        """
+        Lock of the entry. flock locks the open file, so it excludes the other threads of the process as well as the
+        other processes. The lock files stay, removing them would let two holders lock different files
+        :param shared: takes a shared lock, held by the readers together, instead of an exclusive one
+        :return: the locked file, False if it was locked by another holder and blocking is False
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / f"{entry_name}.lock", "a") as lock_file:
+            operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            try:
+                fcntl.flock(lock_file, operation | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield lock_file
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_metadata(self, entry_name):
+        try:
+            with open(self.directory / f"{entry_name}.json", "r") as fp:
+                metadata = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        return metadata if (self.directory / f"{entry_name}.data").is_file() else None
+
+    def _write_atomically(self, destination, write):
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as fp:
+            write(fp)
+        # Readers holding the previous file, or a memory map of it, keep reading the previous content
+        os.replace(fp.name, destination)
+
+    def _write_metadata(self, entry_name, metadata):
+        self._write_atomically(self.directory / f"{entry_name}.json",
+                               lambda fp: fp.write(json.dumps(metadata).encode("utf-8")))
+
+    def _download(self, backend, key, entry_name):
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as fp:
+            pass
+        try:
+            backend.download_file(key, fp.name)
+        except Exception:
+            os.remove(fp.name)
+            raise
+        os.replace(fp.name, self.directory / f"{entry_name}.data")
+
+    def _validate(self, backend, key, entry_name):
+        """
+        Checks whether the cached copy is up to date, which costs at most a HEAD request. Holding the shared lock
+        of the entry is enough
+        :return: tuple of whether the copy is up to date and the version of the object, None if it was not asked for
+        """
+        metadata = self._read_metadata(entry_name)
+        now = time.time()
+        if metadata is not None and now - metadata["validated_at"] < self.ttl_seconds:
+            metrics.increment("read_cache_hit")
+            return True, metadata["version"]
+        version = backend.get_version(key)
+        if metadata is None or version is None or version != metadata["version"]:
+            return False, version
+        metrics.increment("read_cache_revalidated")
+        self._write_metadata(entry_name, dict(metadata, validated_at=now))
+        return True, version
+
+    def _replace(self, backend, key, entry_name, version):
+        """
+        Downloads the object unless another reader did while the lock was converted, the caller holds the exclusive
+        lock of the entry
+        :return: True if the object was downloaded
+        """
+        metadata = self._read_metadata(entry_name)
+        if metadata is not None and version is not None and version == metadata["version"]:
+            return False
+        metrics.increment("read_cache_miss")
+        self._download(backend, key, entry_name)
+        self._write_metadata(entry_name, {"key": key, "location": backend.location, "version": version,
+                                          "validated_at": time.time()})
+        logger.info(f"Cached {key} as {self.directory / f'{entry_name}.data'}")
+        return True
+
+    @contextlib.contextmanager
+    def reading(self, backend, key):
+        """
+        Makes sure the cached copy of the object is up to date and keeps it while the context is open. The readers
+        share the lock of the entry, only replacing the copy takes it exclusively
+        :param backend: StorageBackend the object is stored in
+        :param key: key of the object
+        :return: pathlib.Path of the cached copy, which must only be read
+        """
+        entry_name = self._entry_name_of(backend, key)
+        data_path = self.directory / f"{entry_name}.data"
+        downloaded = False
+        with self._locked(entry_name, shared=True) as lock_file:
+            while True:
+                is_up_to_date, version = self._validate(backend, key, entry_name)
+                if not is_up_to_date:
+                    # Converting the lock is not atomic, another reader may replace the copy in between
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    downloaded = self._replace(backend, key, entry_name, version) or downloaded
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                # The modification time of the copy is the last use, the least recently used copies are evicted
+                # first. An eviction while the lock was converted makes the copy be fetched again
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(data_path)
+                    break
+            if downloaded:
+                self.evict(keep=entry_name)
+            yield data_path
+
+    def open_mmap(self, backend, key):
+        """
+        Memory-maps the cached copy of the object. The map stays valid when the copy is replaced or evicted
+        :return: read-only mmap.mmap, to be closed by the caller. b"" for an empty object, which can not be mapped
+        """
+        with self.reading(backend, key) as data_path:
+            with open(data_path, "rb") as fp:
+                if os.fstat(fp.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_cached_version(self, backend, key):
+        """
+        Version of the cached copy of the object, it does not change while a reading context of the object is open
+        :return: str, None if the object is not cached or its backend has no validators
+        """
+        metadata = self._read_metadata(self._entry_name_of(backend, key))
+        return metadata["version"] if metadata is not None else None
+
+    def invalidate(self, backend, key):
+        """Drops the cached copy, eg. after the object was written"""
+        entry_name = self._entry_name_of(backend, key)
+        with self._locked(entry_name):
+            self._remove_entry(entry_name)
+
+    def _remove_entry(self, entry_name):
+        for suffix in (".data", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.directory / f"{entry_name}{suffix}")
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used copies until the cache fits its size. Copies locked by a reader are skipped
+        :param keep: name of an entry which is never evicted, eg. the one just added
+        """
+        copies = []
+        for data_path in self.directory.glob("*.data"):
+            with contextlib.suppress(FileNotFoundError):
+                stat_result = data_path.stat()
+                copies.append((stat_result.st_mtime, stat_result.st_size, data_path.stem))
+        total_bytes = sum(size for _, size, _ in copies)
+        for _, size, entry_name in sorted(copies):
+            if total_bytes <= self.max_bytes:
+                break
+            if entry_name == keep:
+                continue
+            with self._locked(entry_name, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                self._remove_entry(entry_name)
+            total_bytes -= size
+            metrics.increment("read_cache_evicted")
+        if total_bytes > self.max_bytes:
+            logger.info(f"The read cache holds {total_bytes} bytes, above its {self.max_bytes} bytes")
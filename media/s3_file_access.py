@@ -1,41 +1,115 @@
 import os
-import boto3
+import shutil
 import tempfile
 
+from media.read_cache import ReadThroughCache
+from media.storage_backends import DEFAULT_BUCKET_NAME, get_storage_backend
+from media.utils.metrics import metrics
+
 
 class S3FileAccessAbstract:
     def __init__(self,
-                 bucket_name="vikramaditya91.github.io",
+                 bucket_name=DEFAULT_BUCKET_NAME,
                  push_back=False,
                  file_name=None,
-                 file_exists=True):
-        self.s3 = boto3.resource("s3")
+                 file_exists=True,
+                 backend=None,
+                 cached=False):
+        """
+        :param cached: reads through the local read cache. Without push_back the context then gives the path of
+        the cached copy, which must only be read
+        """
+        self.backend = backend if backend is not None else get_storage_backend(bucket_name)
         self.bucket = bucket_name
         self.push_back = push_back
         self.file_name = file_name
         self.file_exists = file_exists
+        self.cached = cached
+        self.tempfile_name = None
+        self.cache_reading = None
 
     def __enter__(self):
+        if self.cached and self.file_exists and not self.push_back:
+            self.cache_reading = ReadThroughCache().reading(self.backend, self.file_name)
+            return str(self.cache_reading.__enter__())
         with tempfile.NamedTemporaryFile(mode="wb", delete=False) as fp:
             self.tempfile_name = fp.name
-            if self.file_exists:
-                self.s3.Bucket(self.bucket).download_file(self.file_name, fp.name)
-            return fp.name
+        if self.file_exists and self.cached:
+            with ReadThroughCache().reading(self.backend, self.file_name) as cached_path:
+                shutil.copyfile(cached_path, self.tempfile_name)
+        elif self.file_exists:
+            self.backend.download_file(self.file_name, self.tempfile_name)
+        return self.tempfile_name
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.cache_reading is not None:
+            self.cache_reading.__exit__(exc_type, exc_val, exc_tb)
+            self.cache_reading = None
+            return
         if self.push_back:
-            self.s3.Bucket(self.bucket).upload_file(self.tempfile_name, self.file_name)
+            with metrics.stage("upload"):
+                self.backend.upload_file(self.tempfile_name, self.file_name)
+            if self.cached:
+                ReadThroughCache().invalidate(self.backend, self.file_name)
         os.remove(self.tempfile_name)
 
+    def read_mmap(self):
+        """
+        Memory-maps the file through the local read cache
+        :return: read-only mmap.mmap, to be closed by the caller. b"" for an empty file
+        """
+        return ReadThroughCache().open_mmap(self.backend, self.file_name)
+
+    def read_bytes(self):
+        """Returns the content of the file without a temporary copy"""
+        return self.backend.download_bytes(self.file_name)
+
+    def write_bytes(self, content):
+        """Stores the bytes as the file without a temporary copy"""
+        with metrics.stage("upload"):
+            self.backend.upload_bytes(content, self.file_name)
+
+    def put_if_absent(self, content):
+        """
+        Creates the file with the bytes unless it already exists
+        :return: True if the file was created
+        """
+        with metrics.stage("upload"):
+            return self.backend.put_if_absent(content, self.file_name)
+
+    def read_versioned(self):
+        """
+        Returns the content of the file together with its version, for a later write_if_version
+        :return: tuple of the bytes and the version, (None, None) if the file does not exist
+        """
+        return self.backend.read_versioned(self.file_name)
+
+    def write_if_version(self, content, version):
+        """
+        Stores the bytes as the file only if it is still the version read
+        :param version: version returned by read_versioned, None to only create the file
+        :return: the version written, None if the file changed in between
+        """
+        with metrics.stage("upload"):
+            written_version = self.backend.write_if_version(content, self.file_name, version)
+        if self.cached and written_version is not None:
+            ReadThroughCache().invalidate(self.backend, self.file_name)
+        return written_version
+
+    def delete(self):
+        """Removes the file, if it exists"""
+        self.backend.delete_file(self.file_name)
+        if self.cached:
+            ReadThroughCache().invalidate(self.backend, self.file_name)
+
     def list_files(self, prefix_add=None):
-        all_objects = boto3.client('s3').list_objects(Bucket=self.bucket, Prefix=f"{self.file_name}{prefix_add}")
-        if "Contents" not in all_objects:
-            return []
-        return all_objects['Contents']
+        return self.backend.list_files(f"{self.file_name}{prefix_add or ''}")
 
 
 class DBFileAccess(S3FileAccessAbstract):
+    """The DB is read through the local read cache, it is only downloaded again once it changed"""
     def __init__(self,
                  *args, **kwargs):
+        kwargs.setdefault("cached", True)
         super(DBFileAccess, self).__init__(*args, **kwargs)
         self.file_name = "db/coin_prediction.db"
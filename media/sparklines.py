@@ -0,0 +1,127 @@
+import hashlib
+import io
+import logging
+
+import numpy as np
+
+from media.bulk_sync import sync_artifacts
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SPARKLINE_DIRECTORY = "assets/images/sparklines"
+# The sparkline shows the last SPARKLINE_DAYS of the coin, sampled at the ends of the buckets of
+# SPARKLINE_BUCKET_MS. The samples only move once a bucket is over, so the key of an unchanged coin stays
+SPARKLINE_DAYS = 32
+SPARKLINE_BUCKET_MS = 12 * 3600 * 1000
+SPARKLINE_POINTS = SPARKLINE_DAYS * 24 * 3600 * 1000 // SPARKLINE_BUCKET_MS + 1
+# Part of the input hash, bump it whenever the drawing below changes
+SPARKLINE_STYLE_VERSION = 1
+
+
+def render_sparkline(values):
+    """
+    Draws the sparkline of the values
+    :param values: downsampled numpy array of the coin/ETH value
+    :return: PNG bytes
+    """
+    import media.utils.mpl_config  # noqa: F401
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(1.6, 0.4), dpi=100)
+    FigureCanvasAgg(figure)
+    axis = figure.add_axes((0, 0, 1, 1))
+    color = "green" if values[-1] >= values[0] else "red"
+    axis.plot(values, color=color, linewidth=1)
+    axis.fill_between(range(len(values)), values, values.min(), color=color, alpha=0.15)
+    axis.set_axis_off()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", transparent=True)
+    return buffer.getvalue()
+
+
+def downsample(timestamps, values, points=SPARKLINE_POINTS, bucket_ms=SPARKLINE_BUCKET_MS):
+    """
+    Resamples the series at the ends of the last buckets, up to the start of the bucket of its last point. A point
+    added within the current bucket changes no sample, the times before the first point take its value
+    :param timestamps: sorted epoch ms of the values
+    :return: float32 numpy array of the points samples, the oldest first
+    """
+    window_end = timestamps[-1] // bucket_ms * bucket_ms
+    sample_times = window_end - bucket_ms * np.arange(points - 1, -1, -1, dtype=np.float64)
+    return np.interp(sample_times, timestamps, values).astype(np.float32)
+
+
+def get_coin_series(all_coin_history, coins):
+    """
+    Extracts the COIN_ETH_VALUE of every coin from the coin history
+    :param all_coin_history: dict of epoch ms: list of coin rows
+    :param coins: coins whose series are required
+    :return: dict of coin: (timestamps array, values array)
+    """
+    required_coins = set(coins)
+    series = {coin: ([], []) for coin in required_coins}
+    for timestamp in sorted(all_coin_history, key=float):
+        for coin_row in all_coin_history[timestamp]:
+            if coin_row["COIN"] in required_coins:
+                series[coin_row["COIN"]][0].append(float(timestamp))
+                series[coin_row["COIN"]][1].append(coin_row["COIN_ETH_VALUE"])
+    return {coin: (np.asarray(timestamps), np.asarray(values, dtype=np.float64))
+            for coin, (timestamps, values) in series.items() if timestamps}
+
+
+class SparklineGenerator:
+    """
+    Generates the sparklines of the held coins. Each sparkline is stored under the hash of its input,
+    so unchanged coins are neither redrawn nor uploaded again
+    """
+    _known_keys = set()
+
+    def __init__(self, directory=SPARKLINE_DIRECTORY):
+        self.directory = directory
+
+    def get_key_of(self, coin, downsampled_values):
+        input_hash = hashlib.sha1(downsampled_values.tobytes() + bytes([SPARKLINE_STYLE_VERSION])).hexdigest()
+        return f"{self.directory}/{coin}-{input_hash[:12]}.png"
+
+    @staticmethod
+    def _is_stored(key):
+        """Checks the single key with a HEAD request, the sparkline directory only grows and is never listed"""
+        file_access = S3FileAccessAbstract(file_name=key)
+        try:
+            file_access.backend.get_version(key)
+        except FileNotFoundError:
+            return False
+        SparklineGenerator._known_keys.add(key)
+        return True
+
+    def generate(self, all_coin_history, coins):
+        """
+        Makes sure the sparklines of the coins are published. The handful of sparklines of a post is drawn in the
+        invoking process, a process pool would cost more than the drawing
+        :param all_coin_history: dict of epoch ms: list of coin rows
+        :param coins: list of coins
+        :return: dict of coin: key of its sparkline
+        """
+        coin_series = get_coin_series(all_coin_history, coins)
+        sparkline_keys = {}
+        to_render = {}
+        for coin, (timestamps, values) in coin_series.items():
+            downsampled_values = downsample(timestamps, values)
+            sparkline_keys[coin] = self.get_key_of(coin, downsampled_values)
+            to_render[sparkline_keys[coin]] = downsampled_values
+
+        missing_keys = [key for key in to_render
+                        if key not in SparklineGenerator._known_keys and not self._is_stored(key)]
+        metrics.increment("sparkline_cache_hit", len(to_render) - len(missing_keys))
+        metrics.increment("sparkline_cache_miss", len(missing_keys))
+        if missing_keys:
+            with metrics.stage("render"):
+                rendered_images = [render_sparkline(to_render[key]) for key in missing_keys]
+            sync_results = sync_artifacts(zip(missing_keys, rendered_images))
+            SparklineGenerator._known_keys.update(result.key for result in sync_results if result.success)
+        logger.info(f"Sparklines of {len(sparkline_keys)} coins, {len(missing_keys)} redrawn")
+        # A sparkline which failed to upload is left out rather than linked broken
+        return {coin: key for coin, key in sparkline_keys.items() if key in SparklineGenerator._known_keys}
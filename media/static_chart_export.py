@@ -0,0 +1,73 @@
+import html
+import logging
+
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.plotly_encoding import figure_to_compact_json
+
+logger = logging.getLogger(__name__)
+
+CHART_DESTINATION = "assets/charts/eth-challenge.html"
+PLOTLYJS_DIRECTORY = "assets/js"
+
+# Decodes the base64 typed arrays of figure_to_compact_json into JS typed arrays before plotting
+STATIC_CHART_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title><script src="{plotlyjs_url}"></script></head>
+<body style="margin:0"><div id="chart" style="width:100%;height:100vh"></div><script>
+var TYPES={{f8:Float64Array,f4:Float32Array,i4:Int32Array,u4:Uint32Array,i2:Int16Array,u2:Uint16Array,i1:Int8Array,u1:Uint8Array}};
+function decode(v){{if(v&&typeof v==="object"){{if(v.bdata!==undefined&&TYPES[v.dtype]){{var s=atob(v.bdata),b=new Uint8Array(s.length);
+for(var i=0;i<s.length;i++)b[i]=s.charCodeAt(i);return new TYPES[v.dtype](b.buffer);}}
+for(var k in v)v[k]=decode(v[k]);}}return v;}}
+var figure=decode({figure_json});
+Plotly.newPlot("chart",figure.data,figure.layout,{{responsive:true}});
+</script></body></html>
+"""
+
+
+class StaticChartExporter:
+    """
+    Publishes the plotly figure as a minimal standalone HTML page through the storage layer.
+    The page references a plotly.js bundle uploaded once to the bucket, so a refresh is a single small upload
+    and needs no chart_studio credentials
+    """
+    _uploaded_bundles = set()
+
+    def __init__(self, destination=CHART_DESTINATION, plotlyjs_directory=PLOTLYJS_DIRECTORY):
+        self.destination = destination
+        self.plotlyjs_key = f"{plotlyjs_directory}/plotly-{get_plotlyjs_version()}.min.js"
+
+    def ensure_plotlyjs_bundle(self):
+        """Uploads the plotly.js bundle of the installed plotly unless the bucket already has it"""
+        if self.plotlyjs_key in StaticChartExporter._uploaded_bundles:
+            return
+        file_access = S3FileAccessAbstract(file_name=self.plotlyjs_key, push_back=True, file_exists=False)
+        if not any(item["Key"] == self.plotlyjs_key for item in file_access.list_files()):
+            logger.info(f"Uploading the plotly.js bundle to {self.plotlyjs_key}")
+            with file_access as bundle_file:
+                with open(bundle_file, "w", encoding="utf-8") as fp:
+                    fp.write(get_plotlyjs())
+        StaticChartExporter._uploaded_bundles.add(self.plotlyjs_key)
+
+    def render_html(self, figure):
+        """Renders the standalone page of the figure"""
+        title = figure.layout.title.text or "Chart"
+        # Keeps a "</script>" inside the figure strings from closing the script element
+        figure_json = figure_to_compact_json(figure).replace("</", "<\\/")
+        return STATIC_CHART_TEMPLATE.format(title=html.escape(title),
+                                            plotlyjs_url=f"/{self.plotlyjs_key}",
+                                            figure_json=figure_json)
+
+    def publish(self, figure):
+        """
+        Publishes the figure
+        :param figure: plotly.graph_objects.Figure
+        :return: key of the published page
+        """
+        self.ensure_plotlyjs_bundle()
+        html_content = self.render_html(figure)
+        with S3FileAccessAbstract(file_name=self.destination, push_back=True, file_exists=False) as chart_file:
+            with open(chart_file, "w", encoding="utf-8") as fp:
+                fp.write(html_content)
+        logger.info(f"Published the static chart with {len(html_content)} characters to {self.destination}")
+        return self.destination
@@ -0,0 +1,431 @@
+import contextlib
+import fcntl
+import functools
+import gzip
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from media.publish_policy import get_artifact_policy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKET_NAME = "vikramaditya91.github.io"
+# Objects above 8 MB are uploaded in parts, several parts at once
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=10,
+                                 use_threads=True)
+
+_backend_classes = {}
+
+
+def register_backend(identifier):
+    """Responsible for adding the storage backends to the registry whenever decorated"""
+    def middle_decorator(class_name):
+        _backend_classes[identifier] = class_name
+        return class_name
+
+    return middle_decorator
+
+
+class StorageBackend(ABC):
+    """Key-value storage of the site artifacts, templates and the DB"""
+
+    @abstractmethod
+    def download_file(self, key, local_path):
+        """Copies the object stored at key to the local path"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload_file(self, local_path, key):
+        """Stores the content of the local path at key"""
+        raise NotImplementedError
+
+    def download_bytes(self, key):
+        """Returns the content stored at key. Backends override it when they can skip the temporary file"""
+        with tempfile.NamedTemporaryFile() as fp:
+            self.download_file(key, fp.name)
+            return fp.read()
+
+    def upload_bytes(self, content, key):
+        """Stores the bytes at key. Backends override it when they can skip the temporary file"""
+        with tempfile.NamedTemporaryFile(delete=False) as fp:
+            fp.write(content)
+        try:
+            self.upload_file(fp.name, key)
+        finally:
+            os.remove(fp.name)
+
+    @property
+    def location(self):
+        """Identifies where the objects are stored, the local read cache keeps the objects of each apart"""
+        return type(self).__name__
+
+    def get_version(self, key):
+        """
+        Returns a validator of the object stored at key which changes whenever the object changes, eg. the ETag.
+        Costs at most a HEAD request
+        :return: str, or None if the backend has no validators
+        """
+        return None
+
+    @abstractmethod
+    def put_if_absent(self, content, key):
+        """
+        Stores the bytes at key only if no object exists there yet, as a single atomic step
+        :return: True if the object was created, False if the key was already taken
+        """
+        raise NotImplementedError
+
+    def read_versioned(self, key):
+        """
+        Returns the content stored at key together with its version, for a later write_if_version
+        :return: tuple of the bytes and the version, (None, None) if no object is stored at key
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no conditional writes")
+
+    def write_if_version(self, content, key, version):
+        """
+        Stores the bytes at key only if the stored object is still the version read, as a single atomic step
+        :param version: version returned by read_versioned, None to only create the object
+        :return: the version written, None if the object changed since it was read
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no conditional writes")
+
+    def delete_file(self, key):
+        """Removes the object stored at key, if there is one"""
+        raise NotImplementedError(f"{type(self).__name__} can not delete")
+
+    @abstractmethod
+    def list_files(self, prefix):
+        """
+        Lists the objects whose key starts with prefix
+        :param prefix: prefix of the keys
+        :return: list of dicts with at least the "Key" of each object
+        """
+        raise NotImplementedError
+
+
+@register_backend("s3")
+class S3StorageBackend(StorageBackend):
+    """Objects stored in an S3 bucket"""
+    def __init__(self, bucket_name=DEFAULT_BUCKET_NAME):
+        self.bucket_name = bucket_name
+        # Clients, unlike resources, are safe to share between the upload threads
+        self.client = boto3.client("s3")
+
+    @staticmethod
+    def _body_of(response):
+        body = response["Body"]
+        # The text artifacts are stored precompressed, the readers get the original content
+        if response.get("ContentEncoding") == "gzip":
+            body = gzip.GzipFile(fileobj=body)
+        return body
+
+    def _get_body(self, key):
+        return self._body_of(self.client.get_object(Bucket=self.bucket_name, Key=key))
+
+    def download_file(self, key, local_path):
+        with open(local_path, "wb") as fp:
+            shutil.copyfileobj(self._get_body(key), fp)
+
+    def download_bytes(self, key):
+        return self._get_body(key).read()
+
+    def upload_file(self, local_path, key):
+        policy = get_artifact_policy(key)
+        if not policy.compress:
+            self.client.upload_file(str(local_path), self.bucket_name, key,
+                                    ExtraArgs=policy.extra_args(), Config=TRANSFER_CONFIG)
+            return
+        with open(local_path, "rb") as fp:
+            self.upload_bytes(fp.read(), key)
+
+    def upload_bytes(self, content, key):
+        policy = get_artifact_policy(key)
+        self.client.upload_fileobj(io.BytesIO(policy.encode(content)), self.bucket_name, key,
+                                   ExtraArgs=policy.extra_args(), Config=TRANSFER_CONFIG)
+
+    @property
+    def location(self):
+        return f"s3://{self.bucket_name}"
+
+    def get_version(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=key)["ETag"]
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(f"{key} does not exist in {self.bucket_name}")
+            raise
+
+    def put_if_absent(self, content, key):
+        policy = get_artifact_policy(key)
+        try:
+            # Conditional write of S3, the request fails if the key exists or is being created concurrently
+            self.client.put_object(Bucket=self.bucket_name, Key=key, Body=policy.encode(content),
+                                   IfNoneMatch="*", **policy.extra_args())
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+    def read_versioned(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None, None
+            raise
+        return self._body_of(response).read(), response["ETag"]
+
+    def write_if_version(self, content, key, version):
+        policy = get_artifact_policy(key)
+        condition = {"IfNoneMatch": "*"} if version is None else {"IfMatch": version}
+        try:
+            response = self.client.put_object(Bucket=self.bucket_name, Key=key, Body=policy.encode(content),
+                                              **condition, **policy.extra_args())
+        except ClientError as error:
+            # NoSuchKey: the object was deleted since it was read
+            if error.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "NoSuchKey"):
+                return None
+            raise
+        return response["ETag"]
+
+    def delete_file(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def list_files(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        all_objects = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            all_objects.extend(page.get("Contents", []))
+        return all_objects
+
+
+@register_backend("local")
+class LocalStorageBackend(StorageBackend):
+    """Objects stored as files below a root directory, eg. a locally checked-out Jekyll site"""
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def _path_of(self, key):
+        return self.root / key
+
+    def download_file(self, key, local_path):
+        source = self._path_of(key)
+        if not source.is_file():
+            raise FileNotFoundError(f"{key} does not exist below {self.root}")
+        shutil.copyfile(source, local_path)
+
+    def download_bytes(self, key):
+        source = self._path_of(key)
+        if not source.is_file():
+            raise FileNotFoundError(f"{key} does not exist below {self.root}")
+        return source.read_bytes()
+
+    def upload_file(self, local_path, key):
+        destination = self._path_of(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # Writing to a sibling and renaming keeps the readers from seeing partially written files
+        with tempfile.NamedTemporaryFile(dir=destination.parent, delete=False) as fp:
+            with open(local_path, "rb") as source:
+                shutil.copyfileobj(source, fp)
+        # The temporary file is only readable by the owner, the site is served to everyone
+        os.chmod(fp.name, 0o644)
+        os.replace(fp.name, destination)
+
+    @property
+    def location(self):
+        return self.root.resolve().as_uri()
+
+    def get_version(self, key):
+        source = self._path_of(key)
+        if not source.is_file():
+            raise FileNotFoundError(f"{key} does not exist below {self.root}")
+        stat_result = source.stat()
+        return f"{stat_result.st_mtime_ns}-{stat_result.st_size}"
+
+    def put_if_absent(self, content, key):
+        destination = self._path_of(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=destination.parent, delete=False) as fp:
+            fp.write(content)
+        os.chmod(fp.name, 0o644)
+        try:
+            # Linking fails if the destination exists, unlike O_EXCL it never exposes a partially written file
+            os.link(fp.name, destination)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(fp.name)
+        return True
+
+    @contextlib.contextmanager
+    def _locked(self, key):
+        """
+        Exclusive lock of the conditional writes of the key, shared with the other processes. The lock files are
+        kept in the temporary directory, out of the served site
+        """
+        lock_dir = pathlib.Path(tempfile.gettempdir()) / "vc_storage_locks"
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_name = hashlib.sha256(str(self._path_of(key).resolve()).encode("utf-8")).hexdigest()
+        with open(lock_dir / f"{lock_name}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_versioned(self, key):
+        source = self._path_of(key)
+        try:
+            content = source.read_bytes()
+        except FileNotFoundError:
+            return None, None
+        # The content itself is the version, the file is replaced as a whole
+        return content, hashlib.sha1(content).hexdigest()
+
+    def write_if_version(self, content, key, version):
+        if version is None:
+            return hashlib.sha1(content).hexdigest() if self.put_if_absent(content, key) else None
+        with self._locked(key):
+            if self.read_versioned(key)[1] != version:
+                return None
+            self.upload_bytes(content, key)
+        return hashlib.sha1(content).hexdigest()
+
+    def delete_file(self, key):
+        self._path_of(key).unlink(missing_ok=True)
+
+    def list_files(self, prefix):
+        prefixed_path = self._path_of(prefix)
+        search_dir = prefixed_path if prefixed_path.is_dir() else prefixed_path.parent
+        if not search_dir.is_dir():
+            return []
+        all_objects = []
+        for path in sorted(search_dir.rglob("*")):
+            key = path.relative_to(self.root).as_posix()
+            if path.is_file() and key.startswith(prefix):
+                all_objects.append({"Key": key, "Size": path.stat().st_size})
+        return all_objects
+
+
+@register_backend("memory")
+class InMemoryStorageBackend(StorageBackend):
+    """Objects stored in a dict of the process. Used for local render loops and throughput tests"""
+    def __init__(self):
+        # Payloads as S3 would store them, ie. compressed according to the publish policy
+        self.objects = {}
+        # Metadata S3 would store for the object, eg. ContentType and CacheControl
+        self.metadata = {}
+        self.lock = threading.Lock()
+
+    def _store(self, content, key):
+        """Stores the payload and the metadata of the content, the caller holds the lock"""
+        policy = get_artifact_policy(key)
+        self.objects[key] = policy.encode(bytes(content))
+        self.metadata[key] = policy.extra_args()
+
+    def _decode(self, key):
+        """Returns the original content of the stored payload, the caller holds the lock"""
+        if self.metadata[key].get("ContentEncoding") == "gzip":
+            return gzip.decompress(self.objects[key])
+        return self.objects[key]
+
+    def download_file(self, key, local_path):
+        content = self.download_bytes(key)
+        with open(local_path, "wb") as fp:
+            fp.write(content)
+
+    def download_bytes(self, key):
+        with self.lock:
+            if key not in self.objects:
+                raise FileNotFoundError(f"{key} does not exist in the in-memory storage")
+            return self._decode(key)
+
+    def upload_file(self, local_path, key):
+        with open(local_path, "rb") as fp:
+            self.upload_bytes(fp.read(), key)
+
+    def upload_bytes(self, content, key):
+        with self.lock:
+            self._store(content, key)
+
+    @property
+    def location(self):
+        # The objects only live as long as the process
+        return f"memory://{os.getpid()}-{id(self)}"
+
+    def get_version(self, key):
+        with self.lock:
+            if key not in self.objects:
+                raise FileNotFoundError(f"{key} does not exist in the in-memory storage")
+            return hashlib.sha1(self.objects[key]).hexdigest()
+
+    def put_if_absent(self, content, key):
+        with self.lock:
+            if key in self.objects:
+                return False
+            self._store(content, key)
+        return True
+
+    def read_versioned(self, key):
+        with self.lock:
+            if key not in self.objects:
+                return None, None
+            return self._decode(key), hashlib.sha1(self.objects[key]).hexdigest()
+
+    def write_if_version(self, content, key, version):
+        with self.lock:
+            current_version = hashlib.sha1(self.objects[key]).hexdigest() if key in self.objects else None
+            if current_version != version:
+                return None
+            self._store(content, key)
+            return hashlib.sha1(self.objects[key]).hexdigest()
+
+    def delete_file(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+            self.metadata.pop(key, None)
+
+    def list_files(self, prefix):
+        with self.lock:
+            return [{"Key": key, "Size": len(content)}
+                    for key, content in sorted(self.objects.items()) if key.startswith(prefix)]
+
+
+@functools.lru_cache(maxsize=None)
+def _create_backend(identifier, bucket_name, root):
+    backend_class = _backend_classes.get(identifier)
+    if backend_class is None:
+        raise ValueError(f"Unknown storage backend {identifier}, available: {list(_backend_classes)}")
+    logger.info(f"Created the {identifier} storage backend")
+    if identifier == "s3":
+        return backend_class(bucket_name=bucket_name)
+    if identifier == "local":
+        return backend_class(root=root)
+    return backend_class()
+
+
+def get_storage_backend(bucket_name=DEFAULT_BUCKET_NAME):
+    """
+    Returns the storage backend chosen by the configuration. The instances are shared within the process
+    VC_STORAGE_BACKEND: s3 (default), local or memory
+    VC_STORAGE_ROOT: root directory of the local backend
+    :param bucket_name: bucket used by the s3 backend
+    """
+    identifier = os.environ.get("VC_STORAGE_BACKEND", "s3")
+    root = os.environ.get("VC_STORAGE_ROOT", str(pathlib.Path.cwd()))
+    return _create_backend(identifier, bucket_name, root)
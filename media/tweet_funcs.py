@@ -1,11 +1,44 @@
+import io
 import logging
 import twitter
 import pathlib
 import json
+from media.portfolios import get_default_portfolio
 from media.utils.general import get_parameter_from_ssm
+from media.utils.metrics import metrics
+from media.tweet_queue import split_into_thread
 
 logger = logging.getLogger(__name__)
 
+# Larger images are uploaded in chunks, which survive slow connections better than a single request
+CHUNKED_MEDIA_UPLOAD_THRESHOLD = 1024 * 1024
+IMAGE_SIGNATURES = {b"\x89PNG": ".png", b"\xff\xd8": ".jpg", b"GIF8": ".gif", b"RIFF": ".webp"}
+
+
+def get_media_buffer(media):
+    """
+    Copies the image into the file-like object python-twitter uploads from: a binary buffer with a name
+    whose extension gives the media type, and the mode "rb"
+    :param media: bytes, EncodedImage or a binary file-like object
+    :return: io.BytesIO
+    """
+    extension = None
+    if hasattr(media, "read"):
+        # A file-like object, eg. a plain io.BytesIO, may lack the name and the mode python-twitter reads
+        content = media.read()
+        extension = pathlib.Path(str(getattr(media, "name", ""))).suffix or None
+    elif hasattr(media, "data"):
+        content, extension = media.data, media.extension
+    else:
+        content = bytes(media)
+    if extension is None:
+        extension = next((extension for signature, extension in IMAGE_SIGNATURES.items()
+                          if content.startswith(signature)), ".png")
+    media_buffer = io.BytesIO(content)
+    media_buffer.name = f"eth-challenge{extension}"
+    media_buffer.mode = "rb"
+    return media_buffer
+
 
 class Twitter(object):
     """Responsible for performing actions related to Twitter"""
@@ -22,42 +55,94 @@ class Twitter(object):
             map_of_twitter_handle = json.load(json_file)
         return map_of_twitter_handle.get(coin, [])
 
-    def tweet_status_eth_challenge(self, tweet_message, media):
-        if media is not None:
-            assert pathlib.Path(media).exists(), f"Media unavailable from {media}"
-        # TODO Generate seperate tweets if this happens
-        tweet_message = tweet_message[-279:]
-        tweet_info = self.api.PostUpdate(tweet_message, media=media)
+    def upload_media(self, media):
+        """
+        Uploads the image from memory
+        :param media: bytes, EncodedImage or a binary file-like object
+        :return: id of the uploaded media
+        """
+        media_buffer = get_media_buffer(media)
+        media_buffer.seek(0, io.SEEK_END)
+        media_size = media_buffer.tell()
+        media_buffer.seek(0)
+        if media_size > CHUNKED_MEDIA_UPLOAD_THRESHOLD:
+            media_id = self.api.UploadMediaChunked(media_buffer, media_category="tweet_image")
+        else:
+            media_id = self.api.UploadMediaSimple(media_buffer, media_category="tweet_image")
+        logger.info(f"Uploaded the media of {media_size} bytes as {media_id}")
+        return media_id
+
+    def tweet_status_eth_challenge(self, tweet_message, media, in_reply_to_status_id=None):
+        """
+        Posts a single tweet. Longer messages are split into a thread by the tweet queue beforehand
+        :param media: image as bytes, EncodedImage or a binary file-like object, a local path or None
+        :param in_reply_to_status_id: id of the previous tweet of the thread
+        """
+        with metrics.stage("post"):
+            if isinstance(media, (str, pathlib.Path)):
+                assert pathlib.Path(media).exists(), f"Media unavailable from {media}"
+                media = str(media)
+            elif media is not None:
+                media = self.upload_media(media)
+            tweet_info = self.api.PostUpdate(tweet_message, media=media,
+                                             in_reply_to_status_id=in_reply_to_status_id,
+                                             auto_populate_reply_metadata=in_reply_to_status_id is not None)
         return tweet_info
 
 
-def generate_tweet_text_for_eth_challenge(replaced_rows, total_eth_holding):
+def generate_replacement_announcement(replacement_instance, hashtag="#10ETHChallenge"):
+    """
+    Generates the part of the tweet announcing one replaced coin
+    :param replacement_instance: tuple of the sold and the bought row
+    :param hashtag: hashtag of the portfolio
+    :return: str
+    """
+    original_dict, new_dict = replacement_instance
+    price_of_sold_coin = new_dict['QUANTITY'] * new_dict['COIN_ETH_VALUE'] / original_dict['QUANTITY']
+    announcement = f"#SELL ${original_dict['COIN']}, qty: {original_dict['QUANTITY']:.0f}, " \
+                   f"at {price_of_sold_coin} ETH\n" \
+                   f"#BUY ${new_dict['COIN']}, qty: {new_dict['QUANTITY']:.0f}, " \
+                   f"at {new_dict['COIN_ETH_VALUE']} ETH\n"
+
+    for item in Twitter.map_coin_to_handle(original_dict['COIN']):
+        announcement += f"@{item} "
+
+    for item in Twitter.map_coin_to_handle(new_dict['COIN']):
+        announcement += f"@{item} "
+
+    if (Twitter.map_coin_to_handle(original_dict['COIN']) == "") and \
+        (Twitter.map_coin_to_handle(new_dict['COIN']) != ""):
+        announcement += f"#Crypto {hashtag} $ETH #cryptotrade #bitcoin"
+    return announcement
+
+
+def generate_tweet_footer_for_eth_challenge(total_eth_holding, portfolio=None):
+    portfolio = portfolio or get_default_portfolio()
+    return f"\n{portfolio.starting_value:g} $ETH on {portfolio.started_on_label} is now {total_eth_holding:.2f}\n " \
+           f"$ETH $BTC #cryptotrade #cryptobot"
+
+
+def generate_tweet_text_for_eth_challenge(replaced_rows, total_eth_holding, portfolio=None):
     """
     Generates the tweet text for the ETH challenge
     :param replaced_rows: The rows which were replaced by this run of the bot
     :param total_eth_holding: Total ETH held by the ETH challenge now
+    :param portfolio: PortfolioConfig of the portfolio, the default portfolio if None
     :return: str, twitter text
     """
-    tweet_message = ""
-    twitter_instance = Twitter()
-    for replacement_instance in replaced_rows:
-        original_dict, new_dict = replacement_instance
-        price_of_sold_coin = new_dict['QUANTITY'] * new_dict['COIN_ETH_VALUE'] / original_dict['QUANTITY']
-        tweet_message += f"#SELL ${original_dict['COIN']}, qty: {original_dict['QUANTITY']:.0f}, " \
-                         f"at {price_of_sold_coin} ETH\n" \
-                         f"#BUY ${new_dict['COIN']}, qty: {new_dict['QUANTITY']:.0f}, " \
-                         f"at {new_dict['COIN_ETH_VALUE']} ETH\n"
-
-        for item in twitter_instance.map_coin_to_handle(original_dict['COIN']):
-            tweet_message += f"@{item} "
-
-        for item in twitter_instance.map_coin_to_handle(new_dict['COIN']):
-            tweet_message += f"@{item} "
-
-        if (twitter_instance.map_coin_to_handle(original_dict['COIN']) == "") and \
-            (twitter_instance.map_coin_to_handle(new_dict['COIN']) != ""):
-            tweet_message += f"#Crypto #10ETHChallenge $ETH #cryptotrade #bitcoin"
-
-    tweet_message += f"\n10 $ETH on 10-Feb-2020 is now {total_eth_holding:.2f}\n $ETH $BTC " \
-                     f"#cryptotrade #cryptobot"
-    return tweet_message
+    portfolio = portfolio or get_default_portfolio()
+    tweet_message = "".join(generate_replacement_announcement(replacement_instance, portfolio.hashtag)
+                            for replacement_instance in replaced_rows)
+    return tweet_message + generate_tweet_footer_for_eth_challenge(total_eth_holding, portfolio)
+
+
+def generate_tweet_thread_for_eth_challenge(replaced_rows, total_eth_holding, portfolio=None):
+    """
+    Generates the thread for the ETH challenge, several replaced coins share a tweet as long as they fit
+    :param portfolio: PortfolioConfig of the portfolio, the default portfolio if None
+    :return: list of the texts of the thread
+    """
+    portfolio = portfolio or get_default_portfolio()
+    return split_into_thread([generate_replacement_announcement(replacement_instance, portfolio.hashtag)
+                              for replacement_instance in replaced_rows],
+                             generate_tweet_footer_for_eth_challenge(total_eth_holding, portfolio))
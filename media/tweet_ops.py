@@ -1,42 +1,80 @@
-import tempfile
 from media import tweet_funcs, image_ops
+from media.portfolios import get_default_portfolio
+from media.tweet_queue import publish_thread
+from media.utils.aggregates import AggregatesStore
 from media.utils.general import get_total_holding_from_rows
+from media.utils.metrics import metrics
 
 
-def generate_the_image_for_twitter(time_stamp_eth_holding_rows, overall_rows):
-    """Generates the image that will be posted on twitter"""
-    twitter_image_generator = image_ops.MatplotlibGraph()
-    twitter_image_generator.generate_history_graph(time_stamp_eth_holding_rows)
-    twitter_image_generator.generate_donut_chart(overall_rows)
-    twitter_image_generator.generate_inner_circle(overall_rows, time_stamp_eth_holding_rows)
+def generate_the_image_for_twitter(time_stamp_eth_holding_rows, overall_rows, twitter_image_generator=None,
+                                   aggregates=None, starting_value=10):
+    """
+    Generates the image that will be posted on twitter
+    :param twitter_image_generator: MatplotlibGraph to draw on, eg. the template of the container. A new figure
+    by default, which the caller closes once done with it, eg. by using the returned graph as a context manager
+    :param aggregates: HoldingAggregates of the history, the persisted aggregates of the default portfolio if None
+    :param starting_value: ETH held at the start of the portfolio, the baseline of the history graph
+    :return: MatplotlibGraph with the image drawn
+    """
+    with metrics.stage("render"):
+        if twitter_image_generator is None:
+            twitter_image_generator = image_ops.MatplotlibGraph()
+        twitter_image_generator.generate_history_graph(time_stamp_eth_holding_rows, aggregates, starting_value)
+        twitter_image_generator.generate_donut_chart(overall_rows)
+        twitter_image_generator.generate_inner_circle(overall_rows, time_stamp_eth_holding_rows, aggregates)
     return twitter_image_generator
 
 
-def post_the_eth_challenge_tweet(twitter_image_handle, tweet_message):
+def encode_the_image_for_twitter(time_stamp_eth_holding_rows, overall_rows, aggregates=None, starting_value=10):
+    """
+    Draws the image on the figure template of the container and encodes it. Only the data is drawn per event,
+    the figure, the axes and their styling are built once
+    :param aggregates: HoldingAggregates of the history, the persisted aggregates of the default portfolio if None
+    :param starting_value: ETH held at the start of the portfolio, the baseline of the history graph
+    :return: EncodedImage
+    """
+    with image_ops.MatplotlibGraph.reusing_template() as twitter_image_generator:
+        generate_the_image_for_twitter(time_stamp_eth_holding_rows, overall_rows, twitter_image_generator,
+                                       aggregates, starting_value)
+        return twitter_image_generator.encode_image()
+
+
+def post_the_eth_challenge_tweet(encoded_image, tweet_thread):
     """
-    Posts the tweet for the ETH challenge
-    :param twitter_image_handle: handle to the image that was generated (but not saved yet)
-    :param tweet_message: str, text to tweet
-    :return: information of the tweet
+    Posts the thread for the ETH challenge, or queues it when an outbound tweet queue is configured
+    :param encoded_image: EncodedImage of the tweet
+    :param tweet_thread: list of str, texts of the thread
+    :return: id of the first tweet, or of the queued message
     """
-    twitter_instance = tweet_funcs.Twitter()
-    with tempfile.NamedTemporaryFile(suffix=".png") as tmp_file:
-        twitter_image_handle.save_image(tmp_file.name)
-        tweet_info = twitter_instance.tweet_status_eth_challenge(tweet_message, media=tmp_file.name)
-    return tweet_info
+    return publish_thread(tweet_thread, encoded_image)
 
 
-def build_tweet_text_image_and_post(substituted_rows, all_new_rows, time_stamp_eth_holding_rows):
+def build_tweet_thread(substituted_rows, all_new_rows, portfolio=None):
+    """
+    :return: list of the texts of the thread of the portfolio
+    """
+    total_eth_holding = get_total_holding_from_rows(all_new_rows)
+    with metrics.stage("dict_preparation"):
+        return tweet_funcs.generate_tweet_thread_for_eth_challenge(substituted_rows,
+                                                                   total_eth_holding,
+                                                                   portfolio)
+
+
+def build_tweet_text_image_and_post(substituted_rows, all_new_rows, time_stamp_eth_holding_rows, portfolio=None,
+                                    encoded_image=None):
     """
 
     :param substituted_rows: List of rows that were substituted. Used for twitter text
     :param all_new_rows: All new rows for the image which has the table
     :param time_stamp_eth_holding_rows: Full history of the timestamp vs eth-holding
-    :return: tweet_info
+    :param portfolio: PortfolioConfig of the tweet, the default portfolio if None
+    :param encoded_image: EncodedImage rendered beforehand, eg. by a worker of a portfolio batch
+    :return: id of the first tweet, or of the queued message
     """
-    total_eth_holding = get_total_holding_from_rows(all_new_rows)
-    tweet_message = tweet_funcs.generate_tweet_text_for_eth_challenge(substituted_rows,
-                                                                      total_eth_holding)
-    twitter_image_handle = generate_the_image_for_twitter(time_stamp_eth_holding_rows, all_new_rows)
-    tweet_info = post_the_eth_challenge_tweet(twitter_image_handle, tweet_message)
-    return tweet_info
+    portfolio = portfolio or get_default_portfolio()
+    tweet_thread = build_tweet_thread(substituted_rows, all_new_rows, portfolio)
+    if encoded_image is None:
+        aggregates = AggregatesStore(portfolio.aggregates_file_name).get_updated(time_stamp_eth_holding_rows)
+        encoded_image = encode_the_image_for_twitter(time_stamp_eth_holding_rows, all_new_rows, aggregates,
+                                                     portfolio.starting_value)
+    return post_the_eth_challenge_tweet(encoded_image, tweet_thread)
@@ -0,0 +1,553 @@
+"""
+Outbound queue of the tweets. The handler queues the thread and returns, a drain posts the queued threads
+within the posting limit of Twitter, with jittered backoff when Twitter rate-limits or fails.
+VC_TWEET_QUEUE: direct (default, posts within the handler), local (a directory queue, VC_TWEET_QUEUE_DIR)
+or sqs (VC_TWEET_QUEUE_URL)
+VC_TWEET_RATE: posting limit as tweets/seconds, 300/10800 by default. The drains share a token bucket on the
+storage, the direct posts only keep one per container and never touch the storage
+"""
+import json
+import logging
+import os
+import pathlib
+import random
+import tempfile
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+import boto3
+import requests
+from botocore.exceptions import ClientError, ConnectionError as StorageConnectionError, HTTPClientError
+from twitter.error import TwitterError
+
+from media.idempotency import IDEMPOTENCY_DIR, IdempotencyStore
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TWEET_LENGTH_LIMIT = 280
+MEDIA_DIR = "db/tweet_media"
+RATE_LIMIT_FILE_NAME = "db/tweet_rate_limit.json"
+# Ids of the posted tweets by their text, a tweet Twitter rejects as a duplicate gets the id of the first one
+POSTED_STATUS_DIR = f"{IDEMPOTENCY_DIR}/tweet_status"
+# Conditional writes of the token bucket before the tweet is retried later
+RATE_LIMIT_ATTEMPTS = 5
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_CAP_SECONDS = 3600
+# Retries of the tweets posted within the handler, bounded by the timeout of the lambda
+DIRECT_MAX_ATTEMPTS = 3
+DIRECT_BACKOFF_CAP_SECONDS = 30
+# Longest wait for the rate limit within the handler, a longer one fails the invocation instead
+DIRECT_MAX_WAIT_SECONDS = 30
+# Queued threads are claimed for this long, a drain which dies leaves them to the next one
+VISIBILITY_TIMEOUT_SECONDS = 15 * 60
+# Over capacity, internal error, rate limit and daily limit
+RETRYABLE_TWITTER_CODES = {88, 130, 131, 185}
+DUPLICATE_STATUS_CODE = 187
+# Throttled or failing storage, the request may succeed later
+RETRYABLE_STORAGE_CODES = {"SlowDown", "InternalError", "ServiceUnavailable", "RequestTimeout", "RequestTimeTooSkewed"}
+
+_queue_classes = {}
+
+
+def split_into_thread(announcements, footer, limit=TWEET_LENGTH_LIMIT):
+    """
+    Packs the announcements into as few tweets as possible, the footer closes the last one.
+    An announcement is never split, one longer than the limit is cut at its end
+    :param announcements: list of str, eg. one per replaced coin
+    :param footer: str appended to the last tweet
+    :return: list of the texts of the thread
+    """
+    thread = []
+    current_text = ""
+    for announcement in announcements:
+        announcement = announcement[:limit]
+        if current_text and len(current_text) + len(announcement) > limit:
+            thread.append(current_text)
+            current_text = ""
+        current_text += announcement
+    if current_text and len(current_text) + len(footer) > limit:
+        thread.append(current_text)
+        current_text = ""
+    thread.append((current_text + footer)[:limit])
+    return [text.strip() for text in thread]
+
+
+def get_backoff_seconds(attempts):
+    """Exponential backoff with full jitter, so that retried threads do not hit Twitter together"""
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempts))
+
+
+class RateLimitConflictError(Exception):
+    """Concurrent senders kept taking the tokens of the bucket first, the tweet is retried later"""
+
+
+class RateLimitExceededError(Exception):
+    """The rate limit allows the next tweet only after longer than a handler may wait"""
+
+
+def is_retryable(error):
+    """Whether posting may succeed later, eg. after a rate limit or an outage of Twitter or of the storage"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, RateLimitConflictError,
+                          StorageConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Code"] in RETRYABLE_STORAGE_CODES or \
+            error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    if not isinstance(error, TwitterError):
+        return False
+    details = error.message
+    if isinstance(details, list):
+        return any(item.get("code") in RETRYABLE_TWITTER_CODES for item in details)
+    return isinstance(details, dict) and details.get("message") in ("Capacity Error", "Technical Error",
+                                                                    "Exceeded connection limit for user")
+
+
+def is_duplicate(error):
+    return isinstance(error, TwitterError) and isinstance(error.message, list) and \
+        any(item.get("code") == DUPLICATE_STATUS_CODE for item in error.message)
+
+
+class TokenBucket:
+    """Tokens refill continuously up to the capacity, every tweet takes one"""
+    def __init__(self, capacity, refill_per_second, tokens=None, updated_at=None):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity if tokens is None else tokens
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    @classmethod
+    def from_rate(cls, rate):
+        """:param rate: str, tweets/seconds, eg. 300/10800"""
+        tweets, seconds = rate.split("/")
+        return cls(capacity=int(tweets), refill_per_second=int(tweets) / float(seconds))
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise the seconds until the next token
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.refill_per_second
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "refill_per_second": self.refill_per_second,
+                "tokens": self.tokens, "updated_at": self.updated_at}
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(**content)
+
+
+class RateLimitStore:
+    """
+    Keeps the token bucket on the storage, so that the limit holds across the invocations. Every token is taken
+    by a write conditional on the version of the bucket read, so concurrent senders never take the same token
+    """
+    def __init__(self, file_name=RATE_LIMIT_FILE_NAME):
+        self.file_name = file_name
+        self.rate = os.environ.get("VC_TWEET_RATE", "300/10800")
+
+    def load(self):
+        """
+        :return: tuple of the TokenBucket and its version, None if the bucket is not stored yet
+        """
+        configured_bucket = TokenBucket.from_rate(self.rate)
+        content, version = S3FileAccessAbstract(file_name=self.file_name).read_versioned()
+        if content is None:
+            return configured_bucket, None
+        bucket = TokenBucket.from_dict(json.loads(content))
+        # A changed VC_TWEET_RATE applies right away
+        bucket.capacity, bucket.refill_per_second = configured_bucket.capacity, configured_bucket.refill_per_second
+        return bucket, version
+
+    def try_acquire(self):
+        """
+        Takes a token of the stored bucket, with a single read and a single write unless another sender
+        took a token in between
+        :return: 0 if a token was taken, otherwise the seconds until the next token
+        """
+        for _ in range(RATE_LIMIT_ATTEMPTS):
+            bucket, version = self.load()
+            wait_seconds = bucket.try_acquire()
+            if wait_seconds > 0:
+                return wait_seconds
+            content = json.dumps(bucket.to_dict()).encode("utf-8")
+            if S3FileAccessAbstract(file_name=self.file_name).write_if_version(content, version) is not None:
+                return 0
+            metrics.increment("rate_limit_conflict")
+        raise RateLimitConflictError(f"The token bucket kept changing, no token after {RATE_LIMIT_ATTEMPTS} attempts")
+
+
+class InMemoryRateLimit:
+    """Token bucket of the container, shared by its threads. It costs no request but does not hold across containers"""
+    _buckets = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.rate = os.environ.get("VC_TWEET_RATE", "300/10800")
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise the seconds until the next token
+        """
+        with InMemoryRateLimit._lock:
+            if self.rate not in InMemoryRateLimit._buckets:
+                InMemoryRateLimit._buckets[self.rate] = TokenBucket.from_rate(self.rate)
+            return InMemoryRateLimit._buckets[self.rate].try_acquire()
+
+
+class OutboundTweet:
+    """A thread to post. The ids of the tweets already posted let a retry continue where the last attempt failed"""
+    def __init__(self, texts, media_key=None, posted_ids=None, attempts=0, message_id=None):
+        self.texts = texts
+        self.media_key = media_key
+        self.posted_ids = posted_ids or []
+        self.attempts = attempts
+        self.message_id = message_id or uuid.uuid4().hex
+
+    @property
+    def is_complete(self):
+        return len(self.posted_ids) >= len(self.texts)
+
+    def to_dict(self):
+        return {"texts": self.texts, "media_key": self.media_key, "posted_ids": self.posted_ids,
+                "attempts": self.attempts, "message_id": self.message_id}
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(**content)
+
+
+def register_queue(identifier):
+    """Responsible for adding the tweet queues to the registry whenever decorated"""
+    def middle_decorator(class_name):
+        _queue_classes[identifier] = class_name
+        return class_name
+
+    return middle_decorator
+
+
+class TweetQueue(ABC):
+    @abstractmethod
+    def send(self, tweet, delay_seconds=0):
+        """Queues the tweet, visible to the drains after the delay"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def receive(self, max_messages):
+        """
+        Claims up to max_messages visible tweets
+        :return: list of (receipt, OutboundTweet)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, receipt):
+        """Removes a claimed tweet"""
+        raise NotImplementedError
+
+    def requeue(self, receipt, tweet, delay_seconds):
+        """Queues the claimed tweet again with its progress, visible after the delay"""
+        self.send(tweet, delay_seconds)
+        self.delete(receipt)
+
+    def dead_letter(self, receipt, tweet):
+        """Gives up on a claimed tweet"""
+        logger.error(f"Dropped the tweet {tweet.message_id} after {tweet.attempts} attempts: {tweet.texts}")
+        self.delete(receipt)
+
+
+@register_queue("local")
+class LocalTweetQueue(TweetQueue):
+    """
+    Stand-in for SQS: one JSON file per queued tweet in a directory. A tweet is claimed by renaming its file,
+    which is atomic, so several drains of the machine never post the same tweet
+    """
+    def __init__(self, directory=None):
+        self.directory = pathlib.Path(directory or os.environ.get(
+            "VC_TWEET_QUEUE_DIR", pathlib.Path(tempfile.gettempdir()) / "vigilant-tweet-queue"))
+        for sub_directory in ("ready", "claimed", "dead"):
+            (self.directory / sub_directory).mkdir(parents=True, exist_ok=True)
+
+    def send(self, tweet, delay_seconds=0):
+        visible_at = time.time() + delay_seconds
+        destination = self.directory / "ready" / f"{visible_at:017.6f}-{tweet.message_id}.json"
+        staging_path = self.directory / f".{destination.name}"
+        with open(staging_path, "w") as fp:
+            json.dump(tweet.to_dict(), fp)
+        os.replace(staging_path, destination)
+
+    def _release_abandoned_claims(self):
+        for claimed_path in (self.directory / "claimed").glob("*.json"):
+            try:
+                if time.time() - claimed_path.stat().st_mtime > VISIBILITY_TIMEOUT_SECONDS:
+                    os.replace(claimed_path, self.directory / "ready" / claimed_path.name)
+            except FileNotFoundError:
+                continue
+
+    def receive(self, max_messages):
+        self._release_abandoned_claims()
+        claimed = []
+        # The names start with the time the tweets become visible, sorting them gives the order of the queue
+        for ready_path in sorted((self.directory / "ready").glob("*.json")):
+            if len(claimed) >= max_messages or float(ready_path.name.split("-")[0]) > time.time():
+                break
+            claimed_path = self.directory / "claimed" / ready_path.name
+            try:
+                os.replace(ready_path, claimed_path)
+            except FileNotFoundError:
+                # Claimed by another drain
+                continue
+            os.utime(claimed_path)
+            with open(claimed_path, "r") as fp:
+                claimed.append((claimed_path, OutboundTweet.from_dict(json.load(fp))))
+        return claimed
+
+    def delete(self, receipt):
+        pathlib.Path(receipt).unlink(missing_ok=True)
+
+    def dead_letter(self, receipt, tweet):
+        logger.error(f"Moved the tweet {tweet.message_id} to the dead letters after {tweet.attempts} attempts")
+        os.replace(receipt, self.directory / "dead" / pathlib.Path(receipt).name)
+
+    def __len__(self):
+        return len(list((self.directory / "ready").glob("*.json")))
+
+
+@register_queue("sqs")
+class SQSTweetQueue(TweetQueue):
+    # Largest delay SQS accepts on a message
+    MAX_DELAY_SECONDS = 900
+
+    def __init__(self, queue_url=None):
+        self.queue_url = queue_url or os.environ["VC_TWEET_QUEUE_URL"]
+        self.dead_letter_queue_url = os.environ.get("VC_TWEET_DEAD_LETTER_QUEUE_URL")
+        self.client = boto3.client("sqs")
+
+    def send(self, tweet, delay_seconds=0):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(tweet.to_dict()),
+                                 DelaySeconds=int(min(delay_seconds, self.MAX_DELAY_SECONDS)))
+
+    def receive(self, max_messages):
+        response = self.client.receive_message(QueueUrl=self.queue_url,
+                                               MaxNumberOfMessages=min(max_messages, 10),
+                                               VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS)
+        return [(message["ReceiptHandle"], OutboundTweet.from_dict(json.loads(message["Body"])))
+                for message in response.get("Messages", [])]
+
+    def delete(self, receipt):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+    def dead_letter(self, receipt, tweet):
+        if self.dead_letter_queue_url is not None:
+            self.client.send_message(QueueUrl=self.dead_letter_queue_url, MessageBody=json.dumps(tweet.to_dict()))
+        super().dead_letter(receipt, tweet)
+
+
+def get_tweet_queue():
+    """Returns the queue chosen by VC_TWEET_QUEUE, None when the tweets are posted directly"""
+    identifier = os.environ.get("VC_TWEET_QUEUE", "direct")
+    if identifier == "direct":
+        return None
+    queue_class = _queue_classes.get(identifier)
+    if queue_class is None:
+        raise ValueError(f"Unknown tweet queue {identifier}, available: direct, {', '.join(_queue_classes)}")
+    return queue_class()
+
+
+def store_media(encoded_image, message_id):
+    """
+    Stores the image of a queued tweet until it is posted
+    :param encoded_image: EncodedImage
+    :param message_id: id of the queued tweet, the image is deleted once the tweet is posted
+    :return: key of the stored image
+    """
+    media_key = f"{MEDIA_DIR}/{message_id}{encoded_image.extension}"
+    S3FileAccessAbstract(file_name=media_key).write_bytes(encoded_image.data)
+    return media_key
+
+
+class TweetSender:
+    """Posts the threads within the posting limit"""
+    # Client of the container, shared by the senders so that the credentials are fetched once
+    _shared_twitter_instance = None
+
+    def __init__(self, twitter_instance=None, rate_limit_store=None, remember_statuses=True):
+        """
+        :param rate_limit_store: RateLimitStore by default, any object with a try_acquire
+        :param remember_statuses: stores the id of every posted tweet, so a duplicate of it gets the id back
+        """
+        self._twitter_instance = twitter_instance
+        self.rate_limit_store = rate_limit_store or RateLimitStore()
+        self.posted_statuses = IdempotencyStore(directory=POSTED_STATUS_DIR) if remember_statuses else None
+
+    @property
+    def twitter_instance(self):
+        # The credentials are only fetched once there is something to post
+        if self._twitter_instance is None:
+            if TweetSender._shared_twitter_instance is None:
+                from media.tweet_funcs import Twitter
+                TweetSender._shared_twitter_instance = Twitter()
+            self._twitter_instance = TweetSender._shared_twitter_instance
+        return self._twitter_instance
+
+    @staticmethod
+    def _get_status_key_of(text):
+        return f"status/{text}"
+
+    def _remember_status(self, text, status_id):
+        if self.posted_statuses is None:
+            return
+        try:
+            self.posted_statuses.store_result(self._get_status_key_of(text), status_id)
+        except Exception as error:
+            # The tweet is posted, only a later duplicate of it would miss its id
+            logger.warning(f"Could not record the id of the posted tweet {status_id}: {error}")
+
+    def _recall_status(self, text):
+        """:return: id of the tweet posted earlier with the text, None if it is not known"""
+        if self.posted_statuses is None:
+            return None
+        record = self.posted_statuses.read_record(self._get_status_key_of(text))
+        return None if record is None else record["result"]
+
+    def _post_remaining(self, tweet, media):
+        """
+        Posts the tweets of the thread not posted yet, as replies to the previous one
+        :return: 0 if the thread is complete, otherwise the seconds until the next token
+        """
+        while not tweet.is_complete:
+            wait_seconds = self.rate_limit_store.try_acquire()
+            if wait_seconds > 0:
+                return wait_seconds
+            position = len(tweet.posted_ids)
+            text = tweet.texts[position]
+            in_reply_to = next((status_id for status_id in reversed(tweet.posted_ids) if status_id), None)
+            try:
+                tweet_info = self.twitter_instance.tweet_status_eth_challenge(
+                    text,
+                    media=media if position == 0 else None,
+                    in_reply_to_status_id=in_reply_to)
+            except TwitterError as error:
+                if not is_duplicate(error):
+                    raise
+                status_id = self._recall_status(text)
+                logger.info(f"Tweet {position} of {tweet.message_id} was already posted as {status_id}")
+                tweet.posted_ids.append(status_id)
+                continue
+            tweet.posted_ids.append(tweet_info.id)
+            self._remember_status(text, tweet_info.id)
+        return 0
+
+    def post(self, tweet, media=None):
+        """
+        Posts the whole thread right away. Waits a little for the rate limit and retries the retryable errors a
+        few times within the invocation
+        :param media: image of the first tweet, eg. an EncodedImage
+        :return: id of the first tweet of the thread, also when it had been posted before and its id is remembered
+        :raises RateLimitExceededError: if the rate limit allows the next tweet only after DIRECT_MAX_WAIT_SECONDS
+        """
+        while True:
+            try:
+                wait_seconds = self._post_remaining(tweet, media)
+            except Exception as error:
+                tweet.attempts += 1
+                if not is_retryable(error) or tweet.attempts >= DIRECT_MAX_ATTEMPTS:
+                    raise
+                wait_seconds = min(get_backoff_seconds(tweet.attempts), DIRECT_BACKOFF_CAP_SECONDS)
+                logger.warning(f"Posting failed, retrying in {wait_seconds:.1f}s: {error}")
+            else:
+                if wait_seconds > DIRECT_MAX_WAIT_SECONDS:
+                    raise RateLimitExceededError(f"The next tweet of {tweet.message_id} is allowed in "
+                                                 f"{wait_seconds:.0f}s, queue the tweets to post them later")
+            if wait_seconds == 0:
+                break
+            logger.info(f"Waiting {wait_seconds:.1f}s to post")
+            time.sleep(wait_seconds)
+        return tweet.posted_ids[0]
+
+    @staticmethod
+    def _delete_media(tweet):
+        try:
+            S3FileAccessAbstract(file_name=tweet.media_key).delete()
+        except Exception as error:
+            # The lifecycle rule of the bucket removes it later
+            logger.warning(f"Could not delete the media {tweet.media_key} of the posted {tweet.message_id}: {error}")
+
+    def _handle_claimed(self, queue, receipt, tweet):
+        """
+        :return: tuple of whether the thread was completed and whether the rate limit was hit
+        """
+        try:
+            media = S3FileAccessAbstract(file_name=tweet.media_key).read_bytes() if tweet.media_key else None
+            wait_seconds = self._post_remaining(tweet, media)
+        except Exception as error:
+            tweet.attempts += 1
+            if not is_retryable(error) or tweet.attempts >= MAX_ATTEMPTS:
+                logger.error(f"Posting {tweet.message_id} failed: {error}")
+                queue.dead_letter(receipt, tweet)
+                return False, False
+            backoff_seconds = get_backoff_seconds(tweet.attempts)
+            logger.warning(f"Posting {tweet.message_id} failed, retrying in {backoff_seconds:.0f}s: {error}")
+            queue.requeue(receipt, tweet, backoff_seconds)
+            return False, False
+        if wait_seconds > 0:
+            logger.info(f"Rate limited, {tweet.message_id} is retried in {wait_seconds:.0f}s")
+            queue.requeue(receipt, tweet, wait_seconds)
+            return False, True
+        queue.delete(receipt)
+        if tweet.media_key:
+            self._delete_media(tweet)
+        return True, False
+
+    def drain(self, queue, max_messages=50, time_budget_seconds=60):
+        """
+        Posts the queued threads until the queue is empty, the rate limit is hit or the time budget is spent
+        :return: number of threads completed
+        """
+        deadline = time.time() + time_budget_seconds
+        completed = 0
+        rate_limited = False
+        while completed < max_messages and time.time() < deadline and not rate_limited:
+            claimed = queue.receive(min(10, max_messages - completed))
+            if not claimed:
+                break
+            for receipt, tweet in claimed:
+                with metrics.stage("post"):
+                    thread_completed, thread_rate_limited = self._handle_claimed(queue, receipt, tweet)
+                completed += thread_completed
+                rate_limited = rate_limited or thread_rate_limited
+        logger.info(f"Posted {completed} queued threads")
+        return completed
+
+
+def publish_thread(texts, encoded_image=None):
+    """
+    Queues the thread, or posts it when there is no queue. The direct posts stay within the rate limit of the
+    container and write nothing to the storage, a retried event is already caught by its idempotency key
+    :param texts: list of the texts of the thread
+    :param encoded_image: EncodedImage attached to the first tweet
+    :return: id of the queued message, or the id of the first tweet when posted directly
+    """
+    queue = get_tweet_queue()
+    if queue is None:
+        sender = TweetSender(rate_limit_store=InMemoryRateLimit(), remember_statuses=False)
+        return sender.post(OutboundTweet(texts), media=encoded_image)
+    tweet = OutboundTweet(texts)
+    if encoded_image is not None:
+        tweet.media_key = store_media(encoded_image, tweet.message_id)
+    queue.send(tweet)
+    logger.info(f"Queued the thread {tweet.message_id} of {len(texts)} tweets")
+    return tweet.message_id
@@ -0,0 +1,247 @@
+import bisect
+import datetime
+import json
+import logging
+
+from media.s3_file_access import S3FileAccessAbstract
+from media.utils.metrics import metrics
+from media.utils.postpro import CompoundGrowthPredictor
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES_FILE_NAME = "db/eth_holding_aggregates.json"
+# Persisted aggregates of another version are rebuilt from the history
+AGGREGATES_VERSION = 2
+# Conditional writes of the aggregates before giving up on persisting them
+SAVE_ATTEMPTS = 5
+RESOLUTIONS_MS = {"hourly": 3600 * 1000,
+                  "daily": 24 * 3600 * 1000}
+
+
+class OHLCBucket:
+    """Open, high, low, close and the running total of the points within one time bucket"""
+    __slots__ = ("start_ms", "open", "high", "low", "close", "count", "total")
+
+    def __init__(self, start_ms, open_value, high=None, low=None, close=None, count=0, total=0.0):
+        self.start_ms = start_ms
+        self.open = open_value
+        self.high = open_value if high is None else high
+        self.low = open_value if low is None else low
+        self.close = open_value if close is None else close
+        self.count = count
+        self.total = total
+
+    def update(self, value):
+        self.high = max(self.high, value)
+        self.low = min(self.low, value)
+        self.close = value
+        self.count += 1
+        self.total += value
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    def to_list(self):
+        return [self.start_ms, self.open, self.high, self.low, self.close, self.count, self.total]
+
+    @classmethod
+    def from_list(cls, items):
+        return cls(*items)
+
+
+class HoldingAggregates:
+    """
+    Hourly and daily OHLC buckets plus the running totals of the ETH holding history.
+    Every new point of the history updates them in O(1), so the consumers do not walk the raw history again
+    """
+    def __init__(self):
+        self.buckets = {resolution: {} for resolution in RESOLUTIONS_MS}
+        # Bucket starts in ascending order, the history only grows at the end
+        self.bucket_starts = {resolution: [] for resolution in RESOLUTIONS_MS}
+        self.first_timestamp = None
+        self.first_value = None
+        self.last_timestamp = None
+        self.last_value = None
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.growth = CompoundGrowthPredictor()
+
+    def update(self, timestamp_ms, value):
+        """
+        Adds a point of the history. Points which are not newer than the last one are already aggregated
+        :param timestamp_ms: epoch time in milliseconds
+        :param value: ETH holding at that time
+        :return: True if the point was added
+        """
+        if self.last_timestamp is not None and timestamp_ms <= self.last_timestamp:
+            return False
+        value = float(value)
+        for resolution, resolution_ms in RESOLUTIONS_MS.items():
+            start_ms = timestamp_ms - timestamp_ms % resolution_ms
+            bucket = self.buckets[resolution].get(start_ms)
+            if bucket is None:
+                bucket = OHLCBucket(start_ms, value)
+                self.buckets[resolution][start_ms] = bucket
+                self.bucket_starts[resolution].append(start_ms)
+            bucket.update(value)
+        if self.first_timestamp is None:
+            self.first_timestamp, self.first_value = timestamp_ms, value
+            self.minimum = self.maximum = value
+        self.last_timestamp, self.last_value = timestamp_ms, value
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.growth.update(timestamp_ms, value)
+        return True
+
+    def extend(self, eth_vs_ts_history_full):
+        """
+        Adds the points of the history newer than the last aggregated one, walking back only over the new points
+        :param eth_vs_ts_history_full: DecodedHistory or list of (epoch ms, ETH holding) in ascending time
+        :return: number of points added
+        """
+        first_new_index = len(eth_vs_ts_history_full)
+        while first_new_index > 0 and (self.last_timestamp is None or
+                                       eth_vs_ts_history_full[first_new_index - 1][0] > self.last_timestamp):
+            first_new_index -= 1
+        added = 0
+        for timestamp_ms, value in eth_vs_ts_history_full[first_new_index:]:
+            added += self.update(int(timestamp_ms), value)
+        return added
+
+    def closest_bucket(self, timestamp_ms, resolution="hourly"):
+        """Returns the bucket whose start is the closest to the timestamp"""
+        starts = self.bucket_starts[resolution]
+        position = bisect.bisect_left(starts, timestamp_ms)
+        neighbours = starts[max(position - 1, 0):position + 1]
+        closest_start = min(neighbours, key=lambda start: abs(start - timestamp_ms))
+        return self.buckets[resolution][closest_start]
+
+    def value_at(self, timestamp_ms, resolution="hourly"):
+        """Value of the holding at the time, from the close of the closest bucket"""
+        if timestamp_ms <= self.first_timestamp:
+            return self.first_value
+        return self.closest_bucket(timestamp_ms, resolution).close
+
+    def percentage_change_over(self, time_delta, reference_time=None):
+        """
+        Percentage change of the current holding compared to time_delta before the reference_time
+        :param time_delta: datetime.timedelta of the horizon
+        :param reference_time: datetime.datetime, now by default
+        """
+        reference_time = reference_time or datetime.datetime.now()
+        x_time_ago_ms = (reference_time.timestamp() - time_delta.total_seconds()) * 1000
+        original_value = self.value_at(x_time_ago_ms)
+        return (self.last_value - original_value) * 100 / original_value
+
+    def series(self, resolution="hourly"):
+        """
+        Overview of the history
+        :return: tuple of bucket starts in epoch ms and the close values
+        """
+        starts = self.bucket_starts[resolution]
+        return starts, [self.buckets[resolution][start].close for start in starts]
+
+    def best_and_worst_day(self):
+        """
+        :return: tuple of the daily buckets with the largest and the smallest change from open to close
+        """
+        daily_buckets = self.buckets["daily"].values()
+        change_of = lambda bucket: (bucket.close - bucket.open) / bucket.open
+        return max(daily_buckets, key=change_of), min(daily_buckets, key=change_of)
+
+    def to_dict(self):
+        return {"version": AGGREGATES_VERSION,
+                "count": self.count,
+                "total": self.total,
+                "minimum": self.minimum,
+                "maximum": self.maximum,
+                "first": [self.first_timestamp, self.first_value],
+                "last": [self.last_timestamp, self.last_value],
+                "growth": self.growth.to_dict(),
+                "buckets": {resolution: [self.buckets[resolution][start].to_list() for start in starts]
+                            for resolution, starts in self.bucket_starts.items()}}
+
+    @classmethod
+    def from_dict(cls, content):
+        aggregates = cls()
+        aggregates.count = content["count"]
+        aggregates.total = content["total"]
+        aggregates.minimum = content["minimum"]
+        aggregates.maximum = content["maximum"]
+        aggregates.first_timestamp, aggregates.first_value = content["first"]
+        aggregates.last_timestamp, aggregates.last_value = content["last"]
+        aggregates.growth = CompoundGrowthPredictor.from_dict(content["growth"])
+        for resolution, bucket_lists in content["buckets"].items():
+            for bucket_list in bucket_lists:
+                bucket = OHLCBucket.from_list(bucket_list)
+                aggregates.buckets[resolution][bucket.start_ms] = bucket
+                aggregates.bucket_starts[resolution].append(bucket.start_ms)
+        return aggregates
+
+
+class AggregatesStore:
+    """
+    Keeps the aggregates of the container in memory and persists them next to the raw history. They are only
+    persisted once a bucket was added, the points of the open bucket are aggregated again from the history after
+    a load. The writes are conditional on the version read, so concurrent events never overwrite each other
+    """
+    # file name: tuple of the HoldingAggregates, the version persisted and the count of its hourly buckets
+    _aggregates = {}
+
+    def __init__(self, file_name=AGGREGATES_FILE_NAME):
+        self.file_name = file_name
+
+    def _load(self):
+        """
+        :return: tuple of the persisted HoldingAggregates, their version and the count of their hourly buckets
+        """
+        content, version = S3FileAccessAbstract(file_name=self.file_name).read_versioned()
+        if content is None:
+            logger.info(f"No aggregates at {self.file_name}, building them from the history")
+            return HoldingAggregates(), None, 0
+        content = json.loads(content)
+        if content.get("version") != AGGREGATES_VERSION:
+            logger.info(f"The aggregates at {self.file_name} are outdated, building them from the history")
+            return HoldingAggregates(), version, 0
+        aggregates = HoldingAggregates.from_dict(content)
+        return aggregates, version, len(aggregates.bucket_starts["hourly"])
+
+    def _save(self, aggregates, version):
+        """
+        :return: the version written, None if the persisted aggregates changed since the version was read
+        """
+        content = json.dumps(aggregates.to_dict()).encode("utf-8")
+        return S3FileAccessAbstract(file_name=self.file_name).write_if_version(content, version)
+
+    def get_updated(self, eth_vs_ts_history_full):
+        """
+        Returns the aggregates including every point of the history. Only the points not yet aggregated are
+        walked. When another event persisted the aggregates in between, they are loaded again and extended
+        :param eth_vs_ts_history_full: list of (epoch ms, ETH holding) in ascending time
+        """
+        if self.file_name not in AggregatesStore._aggregates:
+            AggregatesStore._aggregates[self.file_name] = self._load()
+        for _ in range(SAVE_ATTEMPTS):
+            aggregates, version, persisted_buckets = AggregatesStore._aggregates[self.file_name]
+            added = aggregates.extend(eth_vs_ts_history_full)
+            if added > 0:
+                logger.info(f"Added {added} points to the aggregates")
+            bucket_count = len(aggregates.bucket_starts["hourly"])
+            if bucket_count == persisted_buckets:
+                return aggregates
+            written_version = self._save(aggregates, version)
+            if written_version is not None:
+                AggregatesStore._aggregates[self.file_name] = (aggregates, written_version, bucket_count)
+                return aggregates
+            metrics.increment("aggregates_conflict")
+            logger.info(f"The aggregates at {self.file_name} were persisted by another event, loading them again")
+            AggregatesStore._aggregates[self.file_name] = self._load()
+        # The history has every point, the next event persists the buckets
+        logger.warning(f"The aggregates at {self.file_name} kept changing, not persisted after {SAVE_ATTEMPTS} "
+                       f"attempts")
+        return aggregates
@@ -0,0 +1,99 @@
+"""
+Jinja templates compiled ahead of time into Python modules, shipped in media/resources/compiled_templates by
+scripts/build_compiled_templates.py. The directory is git-ignored, the deploy workflow builds it before zipping the
+package. A compiled template is only used while the hash of its source matches the template fetched at runtime and
+the installed Jinja is the one which compiled it, otherwise the source is compiled at runtime.
+Disabled with VC_COMPILED_TEMPLATES=0
+"""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+import jinja2
+from jinja2 import Environment, ModuleLoader, Template
+
+logger = logging.getLogger(__name__)
+
+COMPILED_TEMPLATES_DIR = pathlib.Path(__file__).parents[1] / "resources" / "compiled_templates"
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def get_source_hash(source):
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def compile_templates(sources, destination_dir=COMPILED_TEMPLATES_DIR):
+    """
+    Compiles the templates into importable modules and writes the manifest of their source hashes
+    :param sources: dict of template name (its key in the storage): template source
+    :param destination_dir: directory of the compiled modules
+    :return: path of the manifest
+    """
+    destination_dir = pathlib.Path(destination_dir)
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    for stale_module in destination_dir.glob("tmpl_*.py"):
+        stale_module.unlink()
+    environment = Environment(loader=jinja2.DictLoader(sources))
+    environment.compile_templates(str(destination_dir), zip=None, ignore_errors=False)
+    manifest = {"jinja2": jinja2.__version__,
+                "templates": {name: get_source_hash(source) for name, source in sorted(sources.items())}}
+    manifest_path = destination_dir / MANIFEST_FILE_NAME
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest_path
+
+
+class CompiledTemplateLoader:
+    """Returns the Template of a source, from the compiled modules when they are up-to-date"""
+    # Templates of the container, by the hash of their source
+    _templates = {}
+
+    def __init__(self, compiled_dir=COMPILED_TEMPLATES_DIR):
+        self.compiled_dir = pathlib.Path(compiled_dir)
+        self.enabled = os.environ.get("VC_COMPILED_TEMPLATES", "1") != "0"
+
+    def _read_manifest(self):
+        manifest_path = self.compiled_dir / MANIFEST_FILE_NAME
+        if not manifest_path.is_file():
+            return None
+        with open(manifest_path, "r") as fp:
+            return json.load(fp)
+
+    def _load_compiled(self, name, source_hash):
+        manifest = self._read_manifest()
+        if manifest is None:
+            logger.info(f"No compiled templates in {self.compiled_dir}")
+            return None
+        if manifest["jinja2"] != jinja2.__version__:
+            logger.info(f"The templates were compiled by Jinja {manifest['jinja2']}, not {jinja2.__version__}")
+            return None
+        if manifest["templates"].get(name) != source_hash:
+            logger.info(f"The compiled template of {name} is outdated")
+            return None
+        environment = Environment(loader=ModuleLoader(str(self.compiled_dir)))
+        return environment.get_template(name)
+
+    def get_template(self, name, source):
+        """
+        :param name: name of the template, its key in the storage
+        :param source: current source of the template
+        :return: jinja2.Template
+        """
+        source_hash = get_source_hash(source)
+        template = CompiledTemplateLoader._templates.get(source_hash)
+        if template is not None:
+            return template
+        if self.enabled:
+            try:
+                template = self._load_compiled(name, source_hash)
+            except Exception as error:
+                logger.warning(f"Could not load the compiled template of {name}: {error}")
+        if template is None:
+            template = Template(source)
+            logger.info(f"Compiled {name} at runtime")
+        else:
+            logger.info(f"Loaded the compiled template of {name}")
+        CompiledTemplateLoader._templates[source_hash] = template
+        return template
@@ -3,18 +3,23 @@ from typing import List, Dict
 
 import boto3
 
+from media.utils.metrics import timed_stage
+
 
 class MediaEnum(Enum):
     tweet = "tweet"
     blog_main_page = "blog_main_page"
     blog_ind_page = "blog_ind_page"
     plotly_image_update = "plotly_image_update"
+    tweet_queue_drain = "tweet_queue_drain"
+    portfolio_batch = "portfolio_batch"
 
 
 def get_total_holding_from_rows(rows: List[Dict]):
     return sum([row['COIN_ETH_VALUE'] * row['QUANTITY'] for row in rows])
 
 
+@timed_stage("credential_fetch")
 def get_parameter_from_ssm(key):
     client = boto3.client("ssm")
     return client.get_parameter(Name=key)['Parameter']['Value']
@@ -0,0 +1,82 @@
+import logging
+
+import numpy as np
+
+from media.utils.plotly_encoding import decode_typed_array
+
+logger = logging.getLogger(__name__)
+
+
+class DecodedHistory:
+    """
+    History of the ETH holding as two contiguous arrays of epoch ms and values. It behaves like the list of
+    (epoch ms, ETH holding) of the event, so the consumers index, slice and iterate it as before,
+    while the array consumers use timestamps_ms and values directly. Slices are views, not copies
+    """
+    def __init__(self, timestamps_ms, values):
+        self.timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        if self.timestamps_ms.shape != self.values.shape:
+            raise ValueError(f"{len(self.timestamps_ms)} timestamps but {len(self.values)} values in the history")
+
+    @classmethod
+    def from_rows(cls, rows):
+        """:param rows: sequence of (epoch ms, ETH holding)"""
+        rows_array = np.asarray(rows, dtype=np.float64).reshape(-1, 2)
+        # Epoch milliseconds are exact in float64
+        return cls(rows_array[:, 0].astype(np.int64), rows_array[:, 1])
+
+    @staticmethod
+    def _column_of(column):
+        if isinstance(column, dict):
+            return decode_typed_array(column)
+        return column
+
+    @classmethod
+    def from_payload(cls, payload):
+        """
+        Decodes eth_full_history in any of the encodings of the producer, sorted in ascending time
+        rows: [[epoch ms, ETH], ...]
+        columnar: {"timestamps": [epoch ms, ...], "values": [ETH, ...]}
+        binary: the columns as base64 typed arrays, eg. {"timestamps": {"dtype": "i8", "bdata": ".."}, ...}
+        """
+        if isinstance(payload, cls):
+            return payload
+        if isinstance(payload, dict):
+            history = cls(cls._column_of(payload["timestamps"]), cls._column_of(payload["values"]))
+        else:
+            history = cls.from_rows(payload)
+        return history.sorted_by_time()
+
+    def sorted_by_time(self):
+        if np.all(self.timestamps_ms[1:] >= self.timestamps_ms[:-1]):
+            return self
+        order = np.argsort(self.timestamps_ms, kind="stable")
+        return DecodedHistory(self.timestamps_ms[order], self.values[order])
+
+    def __len__(self):
+        return len(self.timestamps_ms)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DecodedHistory(self.timestamps_ms[index], self.values[index])
+        return int(self.timestamps_ms[index]), float(self.values[index])
+
+    def __iter__(self):
+        return zip(self.timestamps_ms.tolist(), self.values.tolist())
+
+    def __repr__(self):
+        return f"DecodedHistory({len(self)} points)"
+
+
+def decode_event(event):
+    """
+    Decodes the history of the event once, at the entry of the handler
+    :return: shallow copy of the event whose eth_full_history is a DecodedHistory
+    """
+    if "eth_full_history" not in event:
+        return event
+    decoded_event = dict(event)
+    decoded_event["eth_full_history"] = DecodedHistory.from_payload(event["eth_full_history"])
+    logger.info(f"Decoded the history of {len(decoded_event['eth_full_history'])} points")
+    return decoded_event
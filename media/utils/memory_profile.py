@@ -0,0 +1,90 @@
+import contextlib
+import gc
+import logging
+import resource
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+TRACEBACK_FRAMES = 10
+TOP_ALLOCATIONS = 10
+
+
+def get_current_rss_kb():
+    """Resident set size of the process right now, the peak RSS where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            resident_pages = int(fp.read().split()[1])
+        return resident_pages * resource.getpagesize() // 1024
+    except OSError:
+        return get_peak_rss_kb()
+
+
+def get_peak_rss_kb():
+    """Highest resident set size of the process so far. ru_maxrss is in kilobytes on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryProfiler:
+    """
+    Traces the allocations of a single event with tracemalloc. Records the traced peak and the RSS of
+    every stage and logs the lines which allocated the memory still held at the end of the event
+    """
+    def __init__(self):
+        self.usage_kb = {}
+        self.start_snapshot = None
+        self.started_tracing = False
+        # Highest traced memory of each open stage within its nested stages, which reset the peak
+        self.open_stage_peaks = []
+
+    def start(self):
+        self.usage_kb = {}
+        self.open_stage_peaks = []
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(TRACEBACK_FRAMES)
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.usage_kb["event_rss_start_kb"] = get_current_rss_kb()
+
+    @staticmethod
+    def _reset_peak():
+        # tracemalloc.reset_peak is new in python 3.9, before that the peaks of the stages are cumulative
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.open_stage_peaks:
+            self.open_stage_peaks[-1] = max(self.open_stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+        self.open_stage_peaks.append(0)
+        self._reset_peak()
+        try:
+            yield
+        finally:
+            stage_peak = max(tracemalloc.get_traced_memory()[1], self.open_stage_peaks.pop())
+            if self.open_stage_peaks:
+                self.open_stage_peaks[-1] = max(self.open_stage_peaks[-1], stage_peak)
+            traced_peak_name = f"{name}_traced_peak_kb"
+            self.usage_kb[traced_peak_name] = max(self.usage_kb.get(traced_peak_name, 0), stage_peak // 1024)
+            self.usage_kb[f"{name}_rss_peak_kb"] = get_peak_rss_kb()
+
+    def stop(self):
+        """
+        Stops tracing and logs where the memory retained by the event was allocated
+        :return: dict of the usage in kilobytes
+        """
+        if self.start_snapshot is None:
+            return self.usage_kb
+        # Figures are reference cycles, only what survives a collection is retained by the container
+        gc.collect()
+        end_snapshot = tracemalloc.take_snapshot()
+        retained_statistics = end_snapshot.compare_to(self.start_snapshot, "lineno")
+        self.usage_kb["event_traced_growth_kb"] = sum(stat.size_diff for stat in retained_statistics) // 1024
+        self.usage_kb["event_rss_end_kb"] = get_current_rss_kb()
+        self.usage_kb["event_rss_peak_kb"] = get_peak_rss_kb()
+        for stat in retained_statistics[:TOP_ALLOCATIONS]:
+            logger.info(f"Retained by the event: {stat}")
+        self.start_snapshot = None
+        if self.started_tracing:
+            tracemalloc.stop()
+        return self.usage_kb
@@ -0,0 +1,137 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import time
+
+from media.utils.memory_profile import MemoryProfiler
+
+logger = logging.getLogger(__name__)
+
+# A single, reusable no-op context manager keeps the disabled path down to one attribute check
+_DISABLED_STAGE = contextlib.nullcontext()
+
+
+class StageMetrics:
+    """
+    Collects the per-stage latencies and the cache counters of a single lambda event and
+    emits them as a CloudWatch embedded metric format (EMF) log line.
+    Enabled with the environment variable VC_METRICS_ENABLED=1 or per event with {"metrics": true}.
+    The memory profile of the stages is added with VC_MEMORY_PROFILE=1 or per event with {"memory_profile": true}
+    """
+    namespace = "VigilantCryptoMedia"
+
+    def __init__(self):
+        self.default_enabled = os.environ.get("VC_METRICS_ENABLED", "0") == "1"
+        self.default_profile_memory = os.environ.get("VC_MEMORY_PROFILE", "0") == "1"
+        self.enabled = self.default_enabled
+        self.memory_profiler = None
+        self.dimensions = {}
+        self.timings_ms = {}
+        self.counters = {}
+        self.memory_kb = {}
+        # [name, milliseconds spent in nested stages] of the stages open right now, innermost last
+        self.open_stages = []
+
+    def start_event(self, event_type, enabled=None, profile_memory=None):
+        """
+        Resets the collected values at the start of an event
+        :param event_type: type of the event, used as the dimension of the metrics
+        :param enabled: overrides the environment setting for this event if not None
+        :param profile_memory: overrides the environment setting of the memory profile if not None.
+        Profiling the memory enables the metrics as well
+        """
+        profile_memory = self.default_profile_memory if profile_memory is None else bool(profile_memory)
+        self.enabled = profile_memory or (self.default_enabled if enabled is None else bool(enabled))
+        self.dimensions = {"EventType": event_type}
+        self.timings_ms = {}
+        self.counters = {}
+        self.memory_kb = {}
+        self.open_stages = []
+        self.memory_profiler = MemoryProfiler() if profile_memory else None
+        if self.memory_profiler is not None:
+            self.memory_profiler.start()
+
+    def stage(self, name):
+        """
+        Context manager which times the stage. Repeated stages in the same event are summed up.
+        A stage only counts its own time: the time of the stages nested in it, eg. an upload within the render,
+        goes to the nested stage. A stage nested in a stage of the same name is not timed again
+        :param name: name of the stage, eg. credential_fetch, template_fetch, render
+        """
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        if any(open_name == name for open_name, _ in self.open_stages):
+            yield
+            return
+        open_stage = [name, 0.0]
+        self.open_stages.append(open_stage)
+        start = time.perf_counter()
+        try:
+            if self.memory_profiler is None:
+                yield
+            else:
+                with self.memory_profiler.stage(name):
+                    yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.open_stages.remove(open_stage)
+            self.timings_ms[name] = self.timings_ms.get(name, 0.0) + elapsed_ms - open_stage[1]
+            if self.open_stages:
+                self.open_stages[-1][1] += elapsed_ms
+
+    def increment(self, name, value=1):
+        """Increments a counter, eg. the hits and misses of a caching layer"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def build_emf_record(self):
+        """Builds the dict in the CloudWatch embedded metric format"""
+        metric_definitions = [{"Name": name, "Unit": "Milliseconds"} for name in self.timings_ms]
+        metric_definitions += [{"Name": name, "Unit": "Count"} for name in self.counters]
+        metric_definitions += [{"Name": name, "Unit": "Kilobytes"} for name in self.memory_kb]
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{"Namespace": self.namespace,
+                                       "Dimensions": [list(self.dimensions)],
+                                       "Metrics": metric_definitions}]
+            }
+        }
+        record.update(self.dimensions)
+        record.update({name: round(value, 3) for name, value in self.timings_ms.items()})
+        record.update(self.counters)
+        record.update(self.memory_kb)
+        return record
+
+    def flush(self):
+        """Emits the collected metrics on stdout, where the lambda runtime picks up EMF lines"""
+        if self.memory_profiler is not None:
+            self.memory_kb.update(self.memory_profiler.stop())
+            self.memory_profiler = None
+        if not self.enabled or not (self.timings_ms or self.counters or self.memory_kb):
+            return
+        print(json.dumps(self.build_emf_record()), flush=True)
+        logger.info(f"Emitted the metrics of the stages {list(self.timings_ms)}")
+        self.timings_ms = {}
+        self.counters = {}
+        self.memory_kb = {}
+
+
+def timed_stage(name):
+    """Decorator which times every call of the function as the stage `name`"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+metrics = StageMetrics()
@@ -0,0 +1,41 @@
+"""
+Points matplotlib to a writable config directory holding the shipped font cache and matplotlibrc.
+Has to be imported before matplotlib, so that the first figure of a fresh lambda container does not
+scan the fonts and build the cache. Disabled with VC_MPL_PREBUILT_CACHE=0 or an explicit MPLCONFIGDIR
+"""
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+SHIPPED_CONFIG_DIR = pathlib.Path(__file__).parents[1] / "resources" / "matplotlib"
+# /tmp is the only writable location on lambda
+RUNTIME_CONFIG_DIR = pathlib.Path(tempfile.gettempdir()) / "vigilant-matplotlib"
+
+
+def prepare_matplotlib_config_dir(shipped_dir=SHIPPED_CONFIG_DIR,
+                                  runtime_dir=RUNTIME_CONFIG_DIR):
+    """
+    Copies the shipped config into the runtime directory and sets MPLCONFIGDIR to it
+    :return: the config directory used by matplotlib, None if the shipped config is not used
+    """
+    if "MPLCONFIGDIR" in os.environ or os.environ.get("VC_MPL_PREBUILT_CACHE", "1") == "0":
+        return None
+    if not runtime_dir.exists():
+        staging_dir = pathlib.Path(tempfile.mkdtemp(dir=runtime_dir.parent))
+        for shipped_file in shipped_dir.iterdir():
+            shutil.copy(shipped_file, staging_dir / shipped_file.name)
+        try:
+            staging_dir.rename(runtime_dir)
+        except OSError:
+            # Another process of the container was faster
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    os.environ["MPLCONFIGDIR"] = str(runtime_dir)
+    logger.info(f"Using the shipped matplotlib config from {runtime_dir}")
+    return runtime_dir
+
+
+prepare_matplotlib_config_dir()
@@ -0,0 +1,54 @@
+import base64
+import json
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+# Typed arrays of plotly.js, the dtype codes follow numpy's array protocol
+TYPED_ARRAY_DTYPES = {"f8", "f4", "i4", "u4", "i2", "u2", "i1", "u1"}
+
+
+def encode_typed_array(array):
+    """
+    Encodes a numeric numpy array as a base64 typed array {"dtype": .., "bdata": ..}
+    :param array: numpy array
+    :return: dict of the typed array, or None if the dtype has no typed array counterpart
+    """
+    array = np.ascontiguousarray(array)
+    if array.dtype.kind == "i" and array.dtype.itemsize == 8:
+        # plotly.js has no 64-bit integer arrays, epoch milliseconds are exact as float64
+        array = array.astype("<f8")
+    dtype_code = f"{array.dtype.kind}{array.dtype.itemsize}"
+    if dtype_code not in TYPED_ARRAY_DTYPES:
+        return None
+    little_endian_array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+    return {"dtype": dtype_code,
+            "bdata": base64.b64encode(little_endian_array.tobytes()).decode("ascii")}
+
+
+def decode_typed_array(typed_array):
+    """Inverse of encode_typed_array"""
+    return np.frombuffer(base64.b64decode(typed_array["bdata"]), dtype=f"<{typed_array['dtype']}")
+
+
+def _encode_arrays(item):
+    if isinstance(item, np.ndarray):
+        encoded = encode_typed_array(item) if item.dtype.kind in "iuf" else None
+        return encoded if encoded is not None else item.tolist()
+    if isinstance(item, dict):
+        return {key: _encode_arrays(value) for key, value in item.items()}
+    if isinstance(item, (list, tuple)):
+        return [_encode_arrays(value) for value in item]
+    return item
+
+
+def figure_to_compact_json(figure):
+    """
+    Serializes the figure with the numeric numpy arrays of the traces as base64 typed arrays
+    :param figure: plotly.graph_objects.Figure
+    :return: str, JSON of {"data": .., "layout": ..}
+    """
+    figure_dict = figure.to_plotly_json()
+    compact_dict = {"data": _encode_arrays(figure_dict["data"]),
+                    "layout": figure_dict["layout"]}
+    return json.dumps(compact_dict, cls=PlotlyJSONEncoder, separators=(",", ":"))
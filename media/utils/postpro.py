@@ -1,4 +1,9 @@
 import datetime
+import math
+
+MILLISECONDS_PER_DAY = 24 * 3600 * 1000
+# Two-sided 95% bounds, the history has far too many points for the t-distribution to matter
+DEFAULT_Z_SCORE = 1.96
 
 
 class PredictionOperations:
@@ -33,3 +38,100 @@ class PredictionOperations:
         expected_change = starting_value + change_in_value * \
                           time_left_in_year.total_seconds() / time_since_simulation_began.total_seconds()
         return expected_change
+
+
+class Projection:
+    """Projected value with its lower and upper bounds"""
+    def __init__(self, value, lower, upper):
+        self.value = value
+        self.lower = lower
+        self.upper = upper
+
+    def __repr__(self):
+        return f"Projection({self.value:.4f}, [{self.lower:.4f}, {self.upper:.4f}])"
+
+
+class CompoundGrowthPredictor:
+    """
+    Fits value = exp(intercept + rate * days) to the history by least squares on log(value).
+    Keeps the running means and co-moments of (days, log value), so every new point updates the fit in O(1)
+    """
+    def __init__(self):
+        self.origin_ms = None
+        self.count = 0
+        self.mean_days = 0.0
+        self.mean_log = 0.0
+        self.moment_days = 0.0
+        self.moment_log = 0.0
+        self.co_moment = 0.0
+
+    def update(self, timestamp_ms, value):
+        """
+        Adds a point of the history
+        :param timestamp_ms: epoch time in milliseconds
+        :param value: positive value at that time, other values are left out of the fit
+        """
+        if value <= 0:
+            return
+        if self.origin_ms is None:
+            self.origin_ms = timestamp_ms
+        days = (timestamp_ms - self.origin_ms) / MILLISECONDS_PER_DAY
+        log_value = math.log(value)
+        # Welford's update, which does not lose precision like the raw sums of squares
+        self.count += 1
+        delta_days = days - self.mean_days
+        delta_log = log_value - self.mean_log
+        self.mean_days += delta_days / self.count
+        self.mean_log += delta_log / self.count
+        self.moment_days += delta_days * (days - self.mean_days)
+        self.moment_log += delta_log * (log_value - self.mean_log)
+        self.co_moment += delta_days * (log_value - self.mean_log)
+
+    @property
+    def can_fit(self):
+        return self.count >= 3 and self.moment_days > 0
+
+    @property
+    def daily_rate(self):
+        """Slope of the log value per day"""
+        return self.co_moment / self.moment_days
+
+    @property
+    def daily_growth_percentage(self):
+        return (math.exp(self.daily_rate) - 1) * 100
+
+    def project(self, target_time, z_score=DEFAULT_Z_SCORE):
+        """
+        Projects the value at the target time
+        :param target_time: datetime.datetime
+        :param z_score: width of the bounds in standard errors of the prediction
+        :return: Projection, None while there are too few points to fit
+        """
+        if not self.can_fit:
+            return None
+        target_days = (target_time.timestamp() * 1000 - self.origin_ms) / MILLISECONDS_PER_DAY
+        rate = self.daily_rate
+        log_projection = self.mean_log + rate * (target_days - self.mean_days)
+        residual_sum = max(self.moment_log - rate * self.co_moment, 0.0)
+        residual_variance = residual_sum / (self.count - 2)
+        standard_error = math.sqrt(residual_variance * (1 + 1 / self.count +
+                                                        (target_days - self.mean_days) ** 2 / self.moment_days))
+        return Projection(value=math.exp(log_projection),
+                          lower=math.exp(log_projection - z_score * standard_error),
+                          upper=math.exp(log_projection + z_score * standard_error))
+
+    def to_dict(self):
+        return {"origin_ms": self.origin_ms,
+                "count": self.count,
+                "mean_days": self.mean_days,
+                "mean_log": self.mean_log,
+                "moment_days": self.moment_days,
+                "moment_log": self.moment_log,
+                "co_moment": self.co_moment}
+
+    @classmethod
+    def from_dict(cls, content):
+        predictor = cls()
+        for name, value in content.items():
+            setattr(predictor, name, value)
+        return predictor
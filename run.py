@@ -1,7 +1,13 @@
 from media.utils.general import MediaEnum
 from media.image_ops import PyplotGraph
 from media.blog_writer import WebPageFactory
+from media.idempotency import IdempotencyStore, get_idempotency_key_of
+from media.portfolio_batch import PortfolioBatch
+from media.portfolios import get_portfolio_of
 from media.tweet_ops import build_tweet_text_image_and_post
+from media.tweet_queue import TweetSender, get_tweet_queue
+from media.utils.history import decode_event
+from media.utils.metrics import metrics
 
 
 def lambda_handler(event: dict,
@@ -9,7 +15,9 @@ def lambda_handler(event: dict,
     """
     AWS Lambda handler entry
     Args:
-        event: Dictionary with keys: lower, upper, reference
+        event: Dictionary with keys: lower, upper, reference. Retried deliveries of an event with an
+            "idempotency_key" return the result of the first one. The events of a portfolio other than the
+            default one carry its "portfolio_id" and optionally its "portfolio_config"
         context:
 
     Returns:
@@ -17,27 +25,78 @@ def lambda_handler(event: dict,
     """
     event_type = event["type"]
     assert event_type in MediaEnum.__members__, f"Event was {event}"
+    metrics.start_event(event_type, enabled=event.get("metrics"), profile_memory=event.get("memory_profile"))
+    try:
+        return _handle_idempotently(event, event_type, lambda: _decode_and_handle_event(event, event_type))
+    finally:
+        metrics.flush()
+
+
+def _handle_idempotently(event: dict,
+                         event_type: str,
+                         handler):
+    """Runs the handler once per "idempotency_key" of the event, or every time if the event has none"""
+    idempotency_key = get_idempotency_key_of(event, event_type)
+    if idempotency_key is None:
+        return handler()
+    return IdempotencyStore().run_once(idempotency_key, handler)
+
+
+def _decode_and_handle_event(event: dict,
+                             event_type: str):
+    with metrics.stage("decode"):
+        event = decode_event(event)
+    return _handle_event(event, event_type)
+
+
+def _handle_batched_event(event: dict,
+                          encoded_image):
+    """
+    Handles an event of a portfolio batch, which is already decoded and whose tweet image is rendered. The batch
+    claimed its idempotency key beforehand
+    """
+    return _handle_event(event, event["type"], encoded_image)
+
+
+def _handle_event(event: dict,
+                  event_type: str,
+                  encoded_image=None):
+    """Dispatches the event to the corresponding media path"""
     if MediaEnum.plotly_image_update == MediaEnum(event_type):
-        PyplotGraph.publish_image_overall(event["all_coin_history"],
-                                          event["eth_full_history"])
+        published_chart = PyplotGraph.publish_image_overall(event["all_coin_history"],
+                                                            event["eth_full_history"],
+                                                            export_mode=event.get("plotly_export_mode"))
+        if published_chart is not None:
+            return published_chart
     elif MediaEnum.blog_main_page == MediaEnum(event_type):
         webpage_factory_instance = WebPageFactory()
-        crypto_update_page = webpage_factory_instance.get_webpage_concrete("crypto_update_main")
+        crypto_update_page = webpage_factory_instance.get_webpage_concrete("crypto_update_main",
+                                                                           get_portfolio_of(event))
         crypto_update_page.publish_online(event["eth_full_history"])
     elif MediaEnum.blog_ind_page == MediaEnum(event_type):
         webpage_factory_instance = WebPageFactory()
-        crypto_update_page = webpage_factory_instance.get_webpage_concrete("crypto_update_blog")
+        crypto_update_page = webpage_factory_instance.get_webpage_concrete("crypto_update_blog",
+                                                                           get_portfolio_of(event))
         return crypto_update_page.publish_online(event["last_dict_of_coins"],
                                                  event["replaced_rows"],
                                                  event["eth_full_history"],
-                                                 event['new_rows']
+                                                 event['new_rows'],
+                                                 all_coin_history=event.get("all_coin_history")
                                                  )
     elif MediaEnum.tweet == MediaEnum(event_type):
-        tweet_info = build_tweet_text_image_and_post(event["replaced_rows"],
-                                                     event["new_rows"],
-                                                     event["eth_full_history"]
-                                                     )
-        return tweet_info.id
+        return build_tweet_text_image_and_post(event["replaced_rows"],
+                                               event["new_rows"],
+                                               event["eth_full_history"],
+                                               portfolio=get_portfolio_of(event),
+                                               encoded_image=encoded_image
+                                               )
+    elif MediaEnum.tweet_queue_drain == MediaEnum(event_type):
+        tweet_queue = get_tweet_queue()
+        if tweet_queue is None:
+            raise ValueError("tweet_queue_drain needs an outbound tweet queue, set VC_TWEET_QUEUE")
+        return TweetSender().drain(tweet_queue, max_messages=event.get("max_messages", 50))
+    elif MediaEnum.portfolio_batch == MediaEnum(event_type):
+        return PortfolioBatch(max_workers=event.get("max_workers")).run(event["portfolios"], _handle_batched_event)
     else:
         raise ValueError(f"Received {event_type} as the event type")
 
@@ -0,0 +1,92 @@
+"""
+Simulates concurrent invocations publishing a blog post on the same day. Every invocation lists the posts of
+the day and then waits for all the others before writing, which is the worst interleaving for the allocation
+of the path. Reports the posts lost to overwrites, with the create-if-absent allocation or, with
+--unconditional, with the previous unconditional upload.
+    python scripts/benchmarks/blog_post_race.py --invocations 16 --rounds 5
+    python scripts/benchmarks/blog_post_race.py --backend local --invocations 16
+"""
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[2]))
+
+from media.blog_writer import WebPage, WebPageFactory  # noqa: E402
+from media.storage_backends import (InMemoryStorageBackend, LocalStorageBackend, StorageBackend,  # noqa: E402
+                                    get_storage_backend, register_backend)
+
+_race_state = {"barrier": None}
+
+
+@register_backend("racing")
+class RacingStorageBackend(StorageBackend):
+    """Wraps the in-memory or the local backend and holds every listing until all invocations have listed"""
+    def __init__(self):
+        root = os.environ.get("VC_RACE_ROOT")
+        self.backend = InMemoryStorageBackend() if root is None else LocalStorageBackend(root)
+
+    def download_file(self, key, local_path):
+        self.backend.download_file(key, local_path)
+
+    def upload_file(self, local_path, key):
+        self.backend.upload_file(local_path, key)
+
+    def put_if_absent(self, content, key):
+        return self.backend.put_if_absent(content, key)
+
+    def list_files(self, prefix):
+        listed_objects = self.backend.list_files(prefix)
+        if _race_state["barrier"] is not None:
+            try:
+                _race_state["barrier"].wait(timeout=10)
+            except threading.BrokenBarrierError:
+                pass
+        return listed_objects
+
+
+def publish(post_number, unconditional):
+    blog_page = WebPageFactory().get_webpage_concrete("crypto_update_blog")
+    content = f"post {post_number}\n"
+    if unconditional:
+        return WebPage.write_rendered_content(blog_page, content)
+    return blog_page.write_rendered_content(content)
+
+
+def run_round(invocations, unconditional):
+    """
+    :return: the destinations the invocations reported
+    """
+    _race_state["barrier"] = threading.Barrier(invocations)
+    with ThreadPoolExecutor(max_workers=invocations) as pool:
+        destinations = list(pool.map(lambda number: publish(number, unconditional), range(invocations)))
+    _race_state["barrier"] = None
+    return destinations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invocations", type=int, default=8, help="concurrent invocations of each round")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, each one adds posts to the same day")
+    parser.add_argument("--backend", choices=("memory", "local"), default="memory")
+    parser.add_argument("--unconditional", action="store_true", help="use the unconditional upload")
+    arguments = parser.parse_args()
+
+    os.environ["VC_STORAGE_BACKEND"] = "racing"
+    if arguments.backend == "local":
+        os.environ["VC_RACE_ROOT"] = tempfile.mkdtemp()
+    blog_page = WebPageFactory().get_webpage_concrete("crypto_update_blog")
+    written = 0
+    for _ in range(arguments.rounds):
+        written += len(run_round(arguments.invocations, arguments.unconditional))
+    survived = len(get_storage_backend().list_files(blog_page.blog_post_dir))
+    print(f"{written} posts written, {survived} stored, {written - survived} lost to overwrites")
+    return 0 if written == survived else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
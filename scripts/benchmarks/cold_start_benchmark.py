@@ -0,0 +1,62 @@
+"""
+Measures the cold start of the tweet card: importing media.image_ops and rendering the first MatplotlibGraph
+in a fresh interpreter, with the shipped font cache and with an empty matplotlib config dir (font scan).
+    python scripts/benchmarks/cold_start_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = pathlib.Path(__file__).parents[2]
+
+COLD_START_SNIPPET = """
+import json, time
+start = time.perf_counter()
+from media.image_ops import MatplotlibGraph
+imported = time.perf_counter()
+graph = MatplotlibGraph()
+graph.main_axis.set_xlabel("Time")
+graph.fig.canvas.draw()
+drawn = time.perf_counter()
+graph.close()
+print(json.dumps({"import": imported - start, "first_figure": drawn - imported}))
+"""
+
+
+def run_cold_start(prebuilt):
+    """Runs one cold start in a subprocess with a pristine /tmp config directory"""
+    scratch_dir = tempfile.mkdtemp()
+    environment = dict(os.environ, TMPDIR=scratch_dir, PYTHONPATH=str(REPO_ROOT))
+    environment.pop("MPLCONFIGDIR", None)
+    if not prebuilt:
+        environment["VC_MPL_PREBUILT_CACHE"] = "0"
+        environment["MPLCONFIGDIR"] = scratch_dir
+    try:
+        output = subprocess.run([sys.executable, "-c", COLD_START_SNIPPET], env=environment, cwd=REPO_ROOT,
+                                check=True, capture_output=True, text=True).stdout
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+
+    for label, prebuilt in (("font scan", False), ("prebuilt cache", True)):
+        timings = [run_cold_start(prebuilt) for _ in range(arguments.repeat)]
+        median_import = statistics.median(item["import"] for item in timings)
+        median_figure = statistics.median(item["first_figure"] for item in timings)
+        print(f"{label:>15}: import {median_import * 1000:8.1f} ms, first figure {median_figure * 1000:8.1f} ms "
+              f"(median of {arguments.repeat})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Replays an event many times in one process, like a warm lambda container, and reports the memory growth
+per iteration. The tweet events are rendered and encoded without being posted, unless --post is given.
+With --one-off-figures every tweet image is drawn on a new figure, which is closed once encoded, instead of on
+the figure template of the container.
+The storage is the in-memory backend unless VC_STORAGE_BACKEND is set.
+    python scripts/benchmarks/memory_soak.py --event event.json --iterations 50
+    python scripts/benchmarks/memory_soak.py --event event.json --iterations 20 --profile-stages
+"""
+import argparse
+import gc
+import json
+import os
+import pathlib
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[2]))
+os.environ.setdefault("VC_STORAGE_BACKEND", "memory")
+
+import run  # noqa: E402
+from media import tweet_ops  # noqa: E402
+from media.utils.history import decode_event  # noqa: E402
+from media.utils.memory_profile import get_current_rss_kb, get_peak_rss_kb  # noqa: E402
+from media.utils.metrics import metrics  # noqa: E402
+
+
+def render_tweet_without_posting(event, one_off_figures=False):
+    """The tweet path up to the encoded image"""
+    event = decode_event(event)
+    if not one_off_figures:
+        tweet_ops.encode_the_image_for_twitter(event["eth_full_history"], event["new_rows"])
+        return
+    with tweet_ops.generate_the_image_for_twitter(event["eth_full_history"], event["new_rows"]) as graph:
+        graph.encode_image()
+
+
+def replay(event, post, one_off_figures=False):
+    if event["type"] == "tweet" and not post:
+        metrics.start_event(event["type"], enabled=event.get("metrics"), profile_memory=event.get("memory_profile"))
+        try:
+            render_tweet_without_posting(event, one_off_figures)
+        finally:
+            metrics.flush()
+    else:
+        run.lambda_handler(event, {})
+
+
+def get_growth_per_iteration(samples):
+    """Least-squares slope of the samples over the iterations"""
+    if len(samples) < 2:
+        return 0.0
+    mean_x = (len(samples) - 1) / 2
+    mean_y = sum(samples) / len(samples)
+    covariance = sum((index - mean_x) * (sample - mean_y) for index, sample in enumerate(samples))
+    variance = sum((index - mean_x) ** 2 for index in range(len(samples)))
+    return covariance / variance
+
+
+def soak(event, iterations, warmup, post=False, one_off_figures=False):
+    """
+    :return: dict with the samples of every iteration and the growth per iteration after the warmup
+    """
+    tracemalloc.start()
+    samples = []
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        replay(event, post, one_off_figures)
+        gc.collect()
+        samples.append({"iteration": iteration,
+                        "seconds": round(time.perf_counter() - start, 3),
+                        "rss_kb": get_current_rss_kb(),
+                        "traced_kb": tracemalloc.get_traced_memory()[0] // 1024,
+                        "gc_objects": len(gc.get_objects())})
+        print(json.dumps(samples[-1]), file=sys.stderr, flush=True)
+    tracemalloc.stop()
+    steady_samples = samples[warmup:]
+    return {"iterations": iterations,
+            "peak_rss_kb": get_peak_rss_kb(),
+            "rss_growth_kb_per_iteration": round(get_growth_per_iteration([s["rss_kb"] for s in steady_samples]), 1),
+            "traced_growth_kb_per_iteration": round(get_growth_per_iteration([s["traced_kb"]
+                                                                              for s in steady_samples]), 1),
+            "gc_objects_growth_per_iteration": round(get_growth_per_iteration([s["gc_objects"]
+                                                                               for s in steady_samples]), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--event", required=True, help="JSON file of the lambda event")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2, help="iterations left out of the growth")
+    parser.add_argument("--profile-stages", action="store_true", help="emit the memory profile of every stage")
+    parser.add_argument("--post", action="store_true", help="post the tweets instead of only rendering them")
+    parser.add_argument("--one-off-figures", action="store_true",
+                        help="draw every tweet image on a new figure instead of the figure template")
+    arguments = parser.parse_args()
+
+    with open(arguments.event, "r") as fp:
+        event = json.load(fp)
+    if arguments.profile_stages:
+        event["memory_profile"] = True
+    print(json.dumps(soak(event, arguments.iterations, arguments.warmup, arguments.post,
+                          arguments.one_off_figures), indent=2))
+
+
+if __name__ == "__main__":
+    main()
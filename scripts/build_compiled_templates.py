@@ -0,0 +1,47 @@
+"""
+Compiles the layouts of the web pages into the Python modules shipped in media/resources/compiled_templates.
+The layouts are fetched through the configured storage backend, or read from a checked-out site.
+The deploy workflow (.github/workflows/main.yml) runs it right before zipping the lambda package. Run it by hand,
+with the Jinja version of the lambda package, before any other deploy:
+    python scripts/build_compiled_templates.py
+    python scripts/build_compiled_templates.py --site-dir ../vikramaditya91.github.io
+"""
+import argparse
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1]))
+
+from media.blog_writer import WebPage, WebPageFactory  # noqa: E402
+from media.utils.compiled_templates import COMPILED_TEMPLATES_DIR, compile_templates  # noqa: E402
+
+
+def get_all_template_names():
+    """Templates of every registered web page"""
+    factory = WebPageFactory()
+    return sorted({factory.get_webpage_concrete(identifier).relative_template for identifier in factory._creators})
+
+
+def read_template_sources(site_dir=None):
+    sources = {}
+    for template_name in get_all_template_names():
+        if site_dir is None:
+            sources[template_name] = WebPage.get_template_source(template_name)
+        else:
+            sources[template_name] = (pathlib.Path(site_dir) / template_name).read_text()
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--site-dir", default=None, help="local checkout of the site holding the layouts")
+    parser.add_argument("--destination", default=str(COMPILED_TEMPLATES_DIR))
+    arguments = parser.parse_args()
+
+    sources = read_template_sources(arguments.site_dir)
+    manifest_path = compile_templates(sources, arguments.destination)
+    print(f"Compiled {sorted(sources)} with the manifest {manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
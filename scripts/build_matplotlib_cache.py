@@ -0,0 +1,37 @@
+"""
+Builds the matplotlib font cache shipped in media/resources/matplotlib.
+The cache only lists the fonts used by the tweet card (and the monospace fallback of the plotly layout),
+so a fresh lambda container loads it without scanning the system fonts.
+Run it with the matplotlib version of the lambda layer:
+    python scripts/build_matplotlib_cache.py
+"""
+import os
+import pathlib
+import tempfile
+
+REQUIRED_FONT_FAMILIES = {"DejaVu Sans", "DejaVu Sans Display", "DejaVu Sans Mono"}
+DESTINATION_DIR = pathlib.Path(__file__).parents[1] / "media" / "resources" / "matplotlib"
+
+
+def build_font_cache(destination_dir=DESTINATION_DIR):
+    # A scratch config dir so that neither an existing cache nor the shipped matplotlibrc are used
+    os.environ["MPLCONFIGDIR"] = tempfile.mkdtemp()
+    import matplotlib
+    from matplotlib import font_manager
+
+    font_manager_instance = font_manager.FontManager()
+    data_path = pathlib.Path(matplotlib.get_data_path())
+    # Only the fonts bundled with matplotlib are portable, their paths are stored relative to mpl-data
+    font_manager_instance.ttflist = [font for font in font_manager_instance.ttflist
+                                     if font.name in REQUIRED_FONT_FAMILIES and data_path in pathlib.Path(font.fname).parents]
+    font_manager_instance.afmlist = []
+
+    for stale_cache in destination_dir.glob("fontlist-v*.json"):
+        stale_cache.unlink()
+    destination = destination_dir / f"fontlist-v{font_manager.FontManager.__version__}.json"
+    font_manager.json_dump(font_manager_instance, destination)
+    print(f"Wrote {len(font_manager_instance.ttflist)} fonts of matplotlib {matplotlib.__version__} to {destination}")
+
+
+if __name__ == "__main__":
+    build_font_cache()
@@ -0,0 +1,76 @@
+"""
+Sets up the lifecycle rules of the site bucket which delete the objects the service leaves behind: the expired
+idempotency records and the images of the queued tweets which were never posted. The other rules of the bucket
+are kept. It is a one-off, run it again whenever VC_IDEMPOTENCY_TTL_HOURS or the rules change: start the "Bucket
+lifecycle" workflow by hand, or run it with credentials allowed to s3:GetLifecycleConfiguration and
+s3:PutLifecycleConfiguration:
+    python scripts/configure_bucket_lifecycle.py
+    python scripts/configure_bucket_lifecycle.py --bucket my-bucket --dry-run
+"""
+import argparse
+import json
+import math
+import os
+import pathlib
+import sys
+
+import boto3
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1]))
+
+from media.idempotency import IDEMPOTENCY_DIR  # noqa: E402
+from media.storage_backends import DEFAULT_BUCKET_NAME  # noqa: E402
+from media.tweet_queue import MEDIA_DIR  # noqa: E402
+
+RULE_ID_PREFIX = "vigilant-crypto-media-"
+# Longest retention of an SQS message, the image of an older queued tweet is never posted
+TWEET_MEDIA_EXPIRATION_DAYS = 14
+
+
+def get_service_rules(idempotency_ttl_hours):
+    """
+    :param idempotency_ttl_hours: validity of the idempotency records
+    :return: list of the lifecycle rules of the service
+    """
+    # The expiration counts whole days from the last write of the object, a valid record is never deleted
+    return [{"ID": f"{RULE_ID_PREFIX}expire-idempotency-records",
+             "Filter": {"Prefix": f"{IDEMPOTENCY_DIR}/"},
+             "Status": "Enabled",
+             "Expiration": {"Days": math.ceil(idempotency_ttl_hours / 24) + 1}},
+            {"ID": f"{RULE_ID_PREFIX}expire-tweet-media",
+             "Filter": {"Prefix": f"{MEDIA_DIR}/"},
+             "Status": "Enabled",
+             "Expiration": {"Days": TWEET_MEDIA_EXPIRATION_DAYS}}]
+
+
+def merge_rules(existing_rules, service_rules):
+    """Replaces the previous rules of the service and keeps every other rule of the bucket"""
+    return [rule for rule in existing_rules if not rule.get("ID", "").startswith(RULE_ID_PREFIX)] + service_rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=DEFAULT_BUCKET_NAME)
+    parser.add_argument("--idempotency-ttl-hours", type=float,
+                        default=float(os.environ.get("VC_IDEMPOTENCY_TTL_HOURS", "24")))
+    parser.add_argument("--dry-run", action="store_true", help="print the rules without applying them")
+    arguments = parser.parse_args()
+
+    client = boto3.client("s3")
+    try:
+        existing_rules = client.get_bucket_lifecycle_configuration(Bucket=arguments.bucket)["Rules"]
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
+        existing_rules = []
+    rules = merge_rules(existing_rules, get_service_rules(arguments.idempotency_ttl_hours))
+    if arguments.dry_run:
+        print(json.dumps(rules, indent=2))
+        return
+    client.put_bucket_lifecycle_configuration(Bucket=arguments.bucket, LifecycleConfiguration={"Rules": rules})
+    print(f"Applied {len(rules)} lifecycle rules to {arguments.bucket}")
+
+
+if __name__ == "__main__":
+    main()
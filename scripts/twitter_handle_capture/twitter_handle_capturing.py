@@ -1,12 +1,86 @@
 import re
+import time
+import argparse
 import twitter
 import pathlib
 import json
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from binance import client
 from googlesearch import search
 from collections import OrderedDict
 
+MAX_CONCURRENT_REQUESTS = 8
+MIN_SECONDS_BETWEEN_REQUESTS = 0.2
+FOLLOWER_CACHE_TTL_SECONDS = 7 * 24 * 3600
+FOLLOWER_URL = "https://cdn.syndication.twimg.com/widgets/followbutton/info.json?screen_names={}"
+FOLLOWERS_COUNT_PATTERN = re.compile(r'"followers_count":(.*?),')
+COIN_LIST_PATTERN = re.compile(r"^\| `(.*?)` \| (.*?) \|$", re.MULTILINE)
+
+
+class RateLimiter:
+    """Spaces out the requests of all the threads by a minimum interval"""
+    def __init__(self, min_interval=MIN_SECONDS_BETWEEN_REQUESTS):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_allowed = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            sleep_for = self.next_allowed - now
+            self.next_allowed = max(now, self.next_allowed) + self.min_interval
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+
+class FollowerCountCache:
+    """Follower counts persisted on disk so that reruns do not fetch them again before the TTL"""
+    def __init__(self, path=None, ttl_seconds=FOLLOWER_CACHE_TTL_SECONDS):
+        self.path = path or pathlib.Path(__file__).parent / ".follower_cache.json"
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, "r") as fp:
+                self.entries = json.load(fp)
+
+    def get(self, twitter_handle):
+        with self.lock:
+            entry = self.entries.get(twitter_handle.lower())
+        if entry is None or time.time() - entry["fetched_at"] > self.ttl_seconds:
+            return None
+        return entry["followers"]
+
+    def set(self, twitter_handle, num_followers):
+        with self.lock:
+            self.entries[twitter_handle.lower()] = {"followers": num_followers, "fetched_at": time.time()}
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as fp:
+                json.dump(self.entries, fp)
+            tmp_path.replace(self.path)
+
+
+def build_session(pool_size=MAX_CONCURRENT_REQUESTS):
+    """Pooled HTTP session which retries the throttled and failed requests with a backoff"""
+    session = requests.Session()
+    retries = Retry(total=4, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+
+session = build_session()
+rate_limiter = RateLimiter()
+follower_cache = FollowerCountCache()
+follower_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
 def get_all_base_assets():
     a = client.Client("", "")
     b = a.get_exchange_info()
@@ -17,13 +91,18 @@ def get_all_base_assets():
 
 
 def get_number_of_followers(twitter_handle):
-    response = requests.get(
-        f"https://cdn.syndication.twimg.com/widgets/followbutton/info.json?screen_names={twitter_handle}")
+    cached_followers = follower_cache.get(twitter_handle)
+    if cached_followers is not None:
+        return cached_followers
+    rate_limiter.wait()
     try:
-        num_followers = re.search(r'"followers_count":(.*?),', response.content.decode()).groups(0)[0]
+        response = session.get(FOLLOWER_URL.format(twitter_handle), timeout=10)
+        num_followers = FOLLOWERS_COUNT_PATTERN.search(response.content.decode()).groups(0)[0]
     except:
-        num_followers = 0
+        # Not cached, the lookup is retried on the next run
+        return 0
     num_followers = int(num_followers)
+    follower_cache.set(twitter_handle, num_followers)
     return num_followers
 
 
@@ -31,10 +110,11 @@ def get_handle_with_most_followers(list_of_handles, top=1):
     handle_followers_dict = OrderedDict()
     if len(list_of_handles) == 1:
         return list_of_handles[0]
-    for tweet_handle in list_of_handles:
-        if any(exchange_handle in tweet_handle for exchange_handle in ["binance", "coinbase", "kucoin", "bitfinex"]):
-            continue
-        num_followers = get_number_of_followers(tweet_handle)
+    handles_to_lookup = [tweet_handle for tweet_handle in OrderedDict.fromkeys(list_of_handles)
+                         if not any(exchange_handle in tweet_handle
+                                    for exchange_handle in ["binance", "coinbase", "kucoin", "bitfinex"])]
+    for tweet_handle, num_followers in zip(handles_to_lookup,
+                                           follower_executor.map(get_number_of_followers, handles_to_lookup)):
         handle_followers_dict[tweet_handle] = num_followers
     sorted_list = sorted(handle_followers_dict.items(), key=lambda x: x[1])
     required_items =  sorted_list[-min(top, len(sorted_list)):]
@@ -62,33 +142,117 @@ def get_destination_json():
 
 
 def load_coin_name():
-    coin_dict = {}
     # https://github.com/crypti/cryptocurrencies
     with open(pathlib.Path(pathlib.Path(__file__).parent/ "coin_list"), "r") as fp:
-        for item in fp.readlines():
-            matched = re.match("\| `(.*?)` \| (.*?) \|\\n", item)
-            coin_symbol = matched.group(1)
-            coin_string = matched.group(2)
-            coin_dict[coin_symbol] = coin_string
-    return coin_dict
+        coin_list_content = fp.read()
+    return {matched.group(1): matched.group(2) for matched in COIN_LIST_PATTERN.finditer(coin_list_content)}
 
 
-if __name__ == "__main__":
-    final_json = {}
-    all_coin_dict = load_coin_name()
+def get_checkpoint_path(destination_json):
+    return destination_json.with_name(f"{destination_json.stem}.checkpoint.json")
+
+
+def load_json_if_exists(path, default):
+    if not path.exists():
+        return default
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def write_json_atomically(path, content, **kwargs):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(content, fp, **kwargs)
+    tmp_path.replace(path)
+
+
+def select_assets_to_process(all_base_assets, existing_handles, processed_at, max_age_days=None):
+    """
+    Selects the assets missing from the existing handles, or processed longer than max_age_days ago
+    :param all_base_assets: all the assets on binance
+    :param existing_handles: dict of asset: handles from the existing json
+    :param processed_at: dict of asset: epoch seconds of the last processing, from the checkpoint
+    :param max_age_days: refresh the assets older than this. Never refreshed if None
+    """
+    now = time.time()
+    selected_assets = []
+    for asset in all_base_assets:
+        if asset not in processed_at:
+            if asset not in existing_handles or max_age_days is not None:
+                selected_assets.append(asset)
+        elif max_age_days is not None and now - processed_at[asset] > max_age_days * 24 * 3600:
+            selected_assets.append(asset)
+    return selected_assets
 
-    for asset in get_all_base_assets():
-        search_string = f"{asset} {all_coin_dict.get(asset, '')} coin twitter"
-        print(f"Searching for {search_string}")
-        a = search(search_string, num_results=15)
-        handle = get_handle_from_search_lists(a)
-        print(f"Handle for {asset} is {handle}")
-        if len(handle) > 0:
-            final_json[asset] = handle
 
-    with open(get_destination_json(), "w") as json_dest:
-        json.dump(final_json, json_dest, indent=2)
-    a = 1
+def find_handle_of_asset(asset, all_coin_dict):
+    search_string = f"{asset} {all_coin_dict.get(asset, '')} coin twitter"
+    print(f"Searching for {search_string}")
+    rate_limiter.wait()
+    search_results = list(search(search_string, num_results=15))
+    handle = get_handle_from_search_lists(search_results)
+    print(f"Handle for {asset} is {handle}")
+    return handle
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Captures the twitter handles of the binance base assets")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process the assets missing from the destination json or older than --max-age-days")
+    parser.add_argument("--max-age-days", type=float, default=None,
+                        help="refresh the handles processed longer ago than this")
+    parser.add_argument("--destination", type=pathlib.Path, default=get_destination_json(),
+                        help="the twitter_handle.json to write")
+    parser.add_argument("--restart", action="store_true",
+                        help="discard the checkpoint of an interrupted run instead of resuming it")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    destination_json = arguments.destination
+    checkpoint_path = get_checkpoint_path(destination_json)
+    all_coin_dict = load_coin_name()
+
+    # The checkpoint holds the handles and the processing time of every asset handled so far,
+    # so an interrupted run resumes from it unless --restart is given
+    empty_checkpoint = {"handles": {}, "processed_at": {}, "full_run_complete": True}
+    checkpoint = empty_checkpoint if arguments.restart else load_json_if_exists(checkpoint_path, empty_checkpoint)
+    all_base_assets = sorted(get_all_base_assets())
+    if arguments.incremental:
+        final_json = load_json_if_exists(destination_json, {})
+        final_json.update(checkpoint["handles"])
+        assets_to_process = select_assets_to_process(all_base_assets, final_json,
+                                                     checkpoint["processed_at"], arguments.max_age_days)
+    elif not checkpoint.get("full_run_complete", True):
+        # Resumes the interrupted full rebuild, the assets it processed are kept
+        final_json = dict(checkpoint["handles"])
+        assets_to_process = [asset for asset in all_base_assets if asset not in checkpoint["processed_at"]]
+        print(f"Resuming the full run, {len(checkpoint['processed_at'])} assets were processed before")
+    else:
+        final_json = {}
+        checkpoint = {"handles": {}, "processed_at": {}, "full_run_complete": False}
+        assets_to_process = all_base_assets
+    print(f"Processing {len(assets_to_process)} of {len(all_base_assets)} assets")
+
+    # The searches run concurrently, the follower lookups of each search share the follower_executor
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS // 2) as asset_executor:
+            future_to_asset = {asset_executor.submit(find_handle_of_asset, asset, all_coin_dict): asset
+                               for asset in assets_to_process}
+            for future in as_completed(future_to_asset):
+                asset = future_to_asset[future]
+                handle = future.result()
+                if len(handle) > 0:
+                    final_json[asset] = handle
+                    checkpoint["handles"][asset] = handle
+                checkpoint["processed_at"][asset] = time.time()
+                write_json_atomically(checkpoint_path, checkpoint)
+                # Saved with the checkpoint, a killed run keeps the follower counts it fetched
+                follower_cache.save()
+    finally:
+        follower_cache.save()
 
+    write_json_atomically(destination_json, dict(sorted(final_json.items())), indent=2)
+    checkpoint["full_run_complete"] = True
+    write_json_atomically(checkpoint_path, checkpoint)
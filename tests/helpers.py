@@ -0,0 +1,22 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from media.storage_backends import get_storage_backend
+
+
+class InMemoryStorageTestCase(unittest.TestCase):
+    """Runs the test against an empty InMemoryStorageBackend and an empty read cache"""
+    def setUp(self):
+        read_cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, read_cache_dir, ignore_errors=True)
+        environment = mock.patch.dict(os.environ, {"VC_STORAGE_BACKEND": "memory",
+                                                   "VC_READ_CACHE_DIR": read_cache_dir})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.backend = get_storage_backend()
+        with self.backend.lock:
+            self.backend.objects.clear()
+            self.backend.metadata.clear()
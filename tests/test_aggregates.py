@@ -0,0 +1,71 @@
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from media.utils.aggregates import AggregatesStore, HoldingAggregates
+from tests.helpers import InMemoryStorageTestCase
+
+HOUR_MS = 3600 * 1000
+START_MS = 1_600_000_000_000 // HOUR_MS * HOUR_MS
+
+
+def get_history(hours, value=10.0, step=0.1):
+    return [(START_MS + hour * HOUR_MS, value + hour * step) for hour in range(hours)]
+
+
+class HoldingAggregatesTest(unittest.TestCase):
+    def test_only_the_new_points_are_added(self):
+        aggregates = HoldingAggregates()
+        self.assertEqual(aggregates.extend(get_history(5)), 5)
+        self.assertEqual(aggregates.extend(get_history(7)), 2)
+        self.assertEqual((aggregates.count, aggregates.last_value), (7, 10.6))
+
+    def test_the_change_is_measured_against_the_closest_bucket(self):
+        aggregates = HoldingAggregates()
+        aggregates.extend([(START_MS, 10.0), (START_MS + 24 * HOUR_MS, 12.0)])
+        reference_time = datetime.datetime.fromtimestamp((START_MS + 24 * HOUR_MS) / 1000)
+        self.assertAlmostEqual(aggregates.percentage_change_over(datetime.timedelta(days=1), reference_time), 20.0)
+
+    def test_round_trips_through_its_dict(self):
+        aggregates = HoldingAggregates()
+        aggregates.extend(get_history(30))
+        self.assertEqual(HoldingAggregates.from_dict(json.loads(json.dumps(aggregates.to_dict()))).to_dict(),
+                         aggregates.to_dict())
+
+
+class AggregatesStoreTest(InMemoryStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        cached_aggregates = mock.patch.dict(AggregatesStore._aggregates, clear=True)
+        cached_aggregates.start()
+        self.addCleanup(cached_aggregates.stop)
+        self.file_name = "db/portfolios/test/eth_holding_aggregates.json"
+
+    def _persisted_count(self):
+        return json.loads(self.backend.download_bytes(self.file_name))["count"]
+
+    def test_persists_only_once_a_bucket_was_added(self):
+        store = AggregatesStore(self.file_name)
+        store.get_updated(get_history(3))
+        self.assertEqual(self._persisted_count(), 3)
+        history = get_history(3) + [(START_MS + 2 * HOUR_MS + 60_000, 11.0)]
+        with mock.patch.object(store, "_save") as save:
+            store.get_updated(history)
+        save.assert_not_called()
+
+    def test_the_aggregates_of_a_concurrent_event_are_not_overwritten(self):
+        AggregatesStore(self.file_name).get_updated(get_history(3))
+        # Another container persists newer aggregates in the meantime
+        other_container = HoldingAggregates()
+        other_container.extend(get_history(5, value=20.0))
+        self.backend.upload_bytes(json.dumps(other_container.to_dict()).encode("utf-8"), self.file_name)
+        aggregates = AggregatesStore(self.file_name).get_updated(get_history(6))
+        # The persisted aggregates were loaded again and only the sixth point was added to them
+        self.assertEqual(aggregates.count, 6)
+        self.assertAlmostEqual(aggregates.total, other_container.total + get_history(6)[-1][1])
+        self.assertEqual(self._persisted_count(), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from media.idempotency import (IN_PROGRESS_LEASE_SECONDS, STATUS_COMPLETED, STATUS_FAILED, STATUS_IN_PROGRESS,
+                               IdempotencyInProgressError, IdempotencyStore, get_idempotency_key_of)
+from tests.helpers import InMemoryStorageTestCase
+
+
+class IdempotencyStoreTest(InMemoryStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = IdempotencyStore()
+
+    def _stored_record(self, key):
+        return json.loads(self.backend.download_bytes(self.store.get_record_key_of(key)))
+
+    def test_runs_the_handler_once_and_returns_the_stored_result(self):
+        handler = mock.Mock(return_value={"status_id": 1})
+        self.assertEqual(self.store.run_once("tweet/1", handler), {"status_id": 1})
+        self.assertEqual(self.store.run_once("tweet/1", handler), {"status_id": 1})
+        handler.assert_called_once_with()
+        self.assertEqual(self._stored_record("tweet/1")["status"], STATUS_COMPLETED)
+
+    def test_a_failed_run_frees_the_key_for_the_retry(self):
+        with self.assertRaises(RuntimeError):
+            self.store.run_once("tweet/1", mock.Mock(side_effect=RuntimeError("twitter is down")))
+        self.assertEqual(self._stored_record("tweet/1")["status"], STATUS_FAILED)
+        self.assertEqual(self.store.run_once("tweet/1", lambda: 2), 2)
+
+    def test_a_claimed_key_is_not_handled_again_within_the_lease(self):
+        claimed_version, _ = self.store.claim("tweet/1")
+        self.assertIsNotNone(claimed_version)
+        handler = mock.Mock()
+        with self.assertRaises(IdempotencyInProgressError):
+            self.store.run_once("tweet/1", handler)
+        handler.assert_not_called()
+
+    def test_an_abandoned_claim_is_taken_over_after_the_lease(self):
+        self.store.claim("tweet/1")
+        with mock.patch("time.time", return_value=time.time() + IN_PROGRESS_LEASE_SECONDS + 1):
+            self.assertEqual(self.store.run_once("tweet/1", lambda: 3), 3)
+
+    def test_an_expired_record_is_handled_again(self):
+        store = IdempotencyStore(ttl_seconds=60)
+        store.run_once("tweet/1", lambda: 1)
+        with mock.patch("time.time", return_value=time.time() + 61):
+            self.assertIsNone(store.read_record("tweet/1"))
+            self.assertEqual(store.run_once("tweet/1", lambda: 2), 2)
+
+    def test_of_two_concurrent_claims_only_one_wins(self):
+        record, version = self.store._read_versioned("tweet/1")
+        self.assertIsNone(record)
+        self.store._claim("tweet/1", version)
+        with self.assertRaises(IdempotencyInProgressError):
+            self.store._claim("tweet/1", version)
+
+    def test_a_claim_taken_over_keeps_the_record_of_the_new_owner(self):
+        first_version, _ = self.store.claim("tweet/1")
+        with mock.patch("time.time", return_value=time.time() + IN_PROGRESS_LEASE_SECONDS + 1):
+            self.store.claim("tweet/1")
+        self.store.complete("tweet/1", first_version, "late result")
+        self.assertEqual(self._stored_record("tweet/1")["status"], STATUS_IN_PROGRESS)
+
+    def test_the_result_of_a_completed_key_is_returned_by_the_claim(self):
+        self.store.run_once("tweet/1", lambda: 5)
+        self.assertEqual(self.store.claim("tweet/1"), (None, 5))
+
+
+class IdempotencyKeyTest(unittest.TestCase):
+    def test_events_without_a_key_have_none(self):
+        self.assertIsNone(get_idempotency_key_of({"type": "tweet"}, "tweet"))
+
+    def test_the_key_contains_the_event_type_and_the_portfolio(self):
+        self.assertEqual(get_idempotency_key_of({"idempotency_key": "a"}, "tweet"), "tweet/a")
+        self.assertEqual(get_idempotency_key_of({"idempotency_key": "a", "portfolio_id": "momentum"}, "tweet"),
+                         "tweet/momentum/a")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from unittest import mock
+
+from media.utils.metrics import StageMetrics
+
+
+class StageMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = StageMetrics()
+        self.metrics.start_event("tweet", enabled=True, profile_memory=False)
+        clock = mock.patch("media.utils.metrics.time.perf_counter", side_effect=[float(tick) for tick in range(100)])
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_a_stage_only_counts_its_own_time(self):
+        with self.metrics.stage("render"):
+            with self.metrics.stage("upload"):
+                pass
+        # render: 0 -> 3 minus the upload: 1 -> 2
+        self.assertEqual(self.metrics.timings_ms, {"upload": 1000.0, "render": 2000.0})
+
+    def test_a_stage_nested_in_one_of_the_same_name_is_not_counted_twice(self):
+        with self.metrics.stage("render"):
+            with self.metrics.stage("render"):
+                pass
+        self.assertEqual(self.metrics.timings_ms, {"render": 1000.0})
+
+    def test_repeated_stages_are_summed_up(self):
+        for _ in range(3):
+            with self.metrics.stage("encode"):
+                pass
+        self.assertEqual(self.metrics.timings_ms, {"encode": 3000.0})
+
+    def test_nothing_is_collected_when_disabled(self):
+        self.metrics.start_event("tweet", enabled=False, profile_memory=False)
+        with self.metrics.stage("render"):
+            self.metrics.increment("hit")
+        self.assertEqual((self.metrics.timings_ms, self.metrics.counters), ({}, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import unittest
+
+from media.portfolios import (DEFAULT_PORTFOLIO_ID, PORTFOLIOS_FILE_NAME, PortfolioConfig, PortfolioRegistry,
+                              get_portfolio_of, is_below)
+from tests.helpers import InMemoryStorageTestCase
+
+
+class IsBelowTest(unittest.TestCase):
+    def test_paths_below_the_directory(self):
+        self.assertTrue(is_below("_posts/crypto/momentum", "_posts/crypto/momentum"))
+        self.assertTrue(is_below("_posts/crypto/momentum/2021", "_posts/crypto/momentum"))
+
+    def test_paths_escaping_or_only_sharing_the_prefix(self):
+        for path in ("_posts/crypto/momentum-fast", "_posts/crypto/momentum/../other", "_posts/crypto/momentum/",
+                     "_posts/crypto/momentum/./x", "_posts/crypto/momentum\\x", "/_posts/crypto/momentum"):
+            with self.subTest(path=path):
+                self.assertFalse(is_below(path, "_posts/crypto/momentum"))
+
+
+class PortfolioConfigTest(unittest.TestCase):
+    def test_the_paths_are_derived_from_the_id(self):
+        portfolio = PortfolioConfig("momentum")
+        self.assertEqual(portfolio.main_page_path, "crypto_update-momentum.md")
+        self.assertEqual(portfolio.blog_post_dir, "_posts/crypto/momentum")
+        self.assertEqual(portfolio.aggregates_file_name, "db/portfolios/momentum/eth_holding_aggregates.json")
+
+    def test_invalid_ids_are_rejected(self):
+        for portfolio_id in ("Momentum", "-momentum", "a/b", "", f"{DEFAULT_PORTFOLIO_ID}2"):
+            with self.subTest(portfolio_id=portfolio_id), self.assertRaises(ValueError):
+                PortfolioConfig(portfolio_id)
+
+    def test_paths_outside_of_the_prefixes_of_the_portfolio_are_rejected(self):
+        for key, path in (("main_page_path", "crypto_update.md"),
+                          ("main_page_path", "crypto_update-momentum-fast.md"),
+                          ("blog_post_dir", "_posts/crypto"),
+                          ("blog_post_dir", "_posts/crypto/other"),
+                          ("aggregates_file_name", "db/coin_prediction.db"),
+                          ("aggregates_file_name", "db/portfolios/momentum/../other/aggregates.json"),
+                          ("main_template", "db/coin_prediction.db"),
+                          ("blog_template", "_layouts/../db/template.md")):
+            with self.subTest(key=key, path=path), self.assertRaises(ValueError):
+                PortfolioConfig("momentum", **{key: path})
+
+    def test_paths_below_the_prefixes_are_accepted(self):
+        portfolio = PortfolioConfig("momentum", main_page_path="crypto_update-momentum/index.md",
+                                    aggregates_file_name="db/portfolios/momentum/v2.json",
+                                    blog_template="_layouts/momentum/blog.md")
+        self.assertEqual(portfolio.blog_template, "_layouts/momentum/blog.md")
+
+    def test_the_paths_of_the_default_portfolio_can_not_change(self):
+        with self.assertRaises(ValueError):
+            PortfolioConfig(DEFAULT_PORTFOLIO_ID, main_page_path="crypto_update-new.md",
+                            blog_post_dir="_posts/crypto", aggregates_file_name="db/eth_holding_aggregates.json")
+
+    def test_round_trips_through_its_dict(self):
+        portfolio = PortfolioConfig("momentum", starting_value=5, start_date="2021-03-01")
+        self.assertEqual(PortfolioConfig.from_dict(portfolio.to_dict()).to_dict(), portfolio.to_dict())
+
+
+class PortfolioRegistryTest(InMemoryStorageTestCase):
+    def _store_configs(self, configs):
+        self.backend.upload_bytes(json.dumps(configs).encode("utf-8"), PORTFOLIOS_FILE_NAME)
+
+    def test_only_the_defaults_are_known_without_the_file(self):
+        self.assertEqual(PortfolioRegistry().get_stored_configs(), {})
+        self.assertEqual(get_portfolio_of({}).portfolio_id, DEFAULT_PORTFOLIO_ID)
+
+    def test_a_changed_file_is_used_by_the_next_event(self):
+        self._store_configs({"momentum": {"starting_value": 5}})
+        self.assertEqual(get_portfolio_of({"portfolio_id": "momentum"}).starting_value, 5)
+        self._store_configs({"momentum": {"starting_value": 7}})
+        self.assertEqual(get_portfolio_of({"portfolio_id": "momentum"}).starting_value, 7)
+
+    def test_the_overrides_of_the_event_win(self):
+        self._store_configs({"momentum": {"starting_value": 5, "name": "Momentum"}})
+        portfolio = get_portfolio_of({"portfolio_id": "momentum", "portfolio_config": {"starting_value": 8}})
+        self.assertEqual((portfolio.name, portfolio.starting_value), ("Momentum", 8))
+
+    def test_a_stored_config_can_not_move_the_paths_of_a_portfolio(self):
+        self._store_configs({"momentum": {"aggregates_file_name": "db/coin_prediction.db"}})
+        with self.assertRaises(ValueError):
+            get_portfolio_of({"portfolio_id": "momentum"})
+
+
+if __name__ == "__main__":
+    unittest.main()
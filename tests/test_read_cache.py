@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from media.read_cache import ReadThroughCache
+from media.storage_backends import InMemoryStorageBackend
+
+
+class CountingBackend(InMemoryStorageBackend):
+    """Counts the requests, every HEAD request takes a while so concurrent readers overlap"""
+    def __init__(self, head_seconds=0.0):
+        super().__init__()
+        self.head_seconds = head_seconds
+        self.heads = 0
+        self.downloads = 0
+
+    def get_version(self, key):
+        time.sleep(self.head_seconds)
+        with self.lock:
+            self.heads += 1
+        return super().get_version(key)
+
+    def download_file(self, key, local_path):
+        with self.lock:
+            self.downloads += 1
+        super().download_file(key, local_path)
+
+
+class ReadThroughCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = ReadThroughCache(directory=directory)
+        self.backend = CountingBackend()
+        self.backend.upload_bytes(b"first", "db/object")
+
+    def _read(self, key="db/object"):
+        with self.cache.reading(self.backend, key) as cached_path:
+            return cached_path.read_bytes()
+
+    def test_an_unchanged_object_is_downloaded_once(self):
+        self.assertEqual([self._read(), self._read()], [b"first", b"first"])
+        self.assertEqual((self.backend.heads, self.backend.downloads), (2, 1))
+
+    def test_a_changed_object_is_downloaded_again(self):
+        self._read()
+        self.backend.upload_bytes(b"second", "db/object")
+        self.assertEqual(self._read(), b"second")
+        self.assertEqual(self.cache.get_cached_version(self.backend, "db/object"),
+                         self.backend.get_version("db/object"))
+
+    def test_a_missing_object_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            self._read("db/missing")
+
+    def test_a_nested_reading_of_the_same_object_does_not_block(self):
+        with self.cache.reading(self.backend, "db/object"):
+            self.assertEqual(self._read(), b"first")
+
+    def test_concurrent_readers_share_the_lock(self):
+        self._read()
+        self.backend.head_seconds = 0.3
+        readers = [threading.Thread(target=self._read) for _ in range(6)]
+        start = time.perf_counter()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        # Serialized readers would take 6 times the HEAD request
+        self.assertLess(time.perf_counter() - start, 1.2)
+        self.assertEqual(self.backend.downloads, 1)
+
+    def test_the_least_recently_used_copies_are_evicted(self):
+        self.cache.max_bytes = 10
+        self.backend.upload_bytes(b"x" * 8, "db/second")
+        self._read()
+        self._read("db/second")
+        self.assertIsNone(self.cache.get_cached_version(self.backend, "db/object"))
+        self.assertIsNotNone(self.cache.get_cached_version(self.backend, "db/second"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from twitter.error import TwitterError
+
+from media.tweet_queue import (DIRECT_MAX_WAIT_SECONDS, RATE_LIMIT_FILE_NAME, InMemoryRateLimit, OutboundTweet,
+                               RateLimitConflictError, RateLimitExceededError, RateLimitStore, TokenBucket,
+                               TweetSender, split_into_thread)
+from tests.helpers import InMemoryStorageTestCase
+
+
+class SplitIntoThreadTest(unittest.TestCase):
+    def test_short_announcements_fit_into_a_single_tweet(self):
+        self.assertEqual(split_into_thread(["Sold A. ", "Bought B. "], "#10ETHChallenge"),
+                         ["Sold A. Bought B. #10ETHChallenge"])
+
+    def test_announcements_are_never_split_and_the_footer_closes_the_last_tweet(self):
+        thread = split_into_thread(["a" * 150, "b" * 150, "c" * 10], "#tag", limit=200)
+        self.assertEqual(thread, ["a" * 150, "b" * 150 + "c" * 10 + "#tag"])
+        self.assertTrue(all(len(text) <= 200 for text in thread))
+
+    def test_an_announcement_longer_than_the_limit_is_cut(self):
+        self.assertEqual(split_into_thread(["a" * 300], "", limit=280), ["a" * 280])
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_takes_the_capacity_and_then_tells_the_wait(self):
+        with mock.patch("time.time", return_value=1000.0):
+            bucket = TokenBucket.from_rate("2/100")
+            self.assertEqual(bucket.try_acquire(), 0)
+            self.assertEqual(bucket.try_acquire(), 0)
+            self.assertAlmostEqual(bucket.try_acquire(), 50.0)
+
+    def test_refills_up_to_the_capacity(self):
+        bucket = TokenBucket(capacity=2, refill_per_second=1, tokens=0, updated_at=1000.0)
+        with mock.patch("time.time", return_value=1010.0):
+            self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.tokens, 1)
+
+
+@mock.patch.dict(os.environ, {"VC_TWEET_RATE": "3/3600"})
+class RateLimitStoreTest(InMemoryStorageTestCase):
+    def test_the_stored_bucket_holds_across_the_stores(self):
+        self.assertEqual([RateLimitStore().try_acquire() for _ in range(3)], [0, 0, 0])
+        self.assertGreater(RateLimitStore().try_acquire(), 0)
+        self.assertLess(json.loads(self.backend.download_bytes(RATE_LIMIT_FILE_NAME))["tokens"], 1)
+
+    def test_a_token_taken_concurrently_is_not_taken_again(self):
+        store = RateLimitStore()
+        load = store.load
+
+        def load_then_lose_the_race():
+            bucket, version = load()
+            # Another sender takes a token between the read and the write of this one
+            if version is not None and not getattr(load_then_lose_the_race, "raced", False):
+                load_then_lose_the_race.raced = True
+                RateLimitStore().try_acquire()
+            return bucket, version
+
+        RateLimitStore().try_acquire()
+        with mock.patch.object(store, "load", side_effect=load_then_lose_the_race):
+            self.assertEqual(store.try_acquire(), 0)
+        self.assertGreater(RateLimitStore().try_acquire(), 0)
+
+    def test_gives_up_when_the_bucket_keeps_changing(self):
+        store = RateLimitStore()
+        with mock.patch("media.s3_file_access.S3FileAccessAbstract.write_if_version", return_value=None):
+            with self.assertRaises(RateLimitConflictError):
+                store.try_acquire()
+
+
+class FakeStatus:
+    def __init__(self, status_id):
+        self.id = status_id
+
+
+class TweetSenderTest(InMemoryStorageTestCase):
+    def setUp(self):
+        super().setUp()
+        buckets = mock.patch.dict(InMemoryRateLimit._buckets, clear=True)
+        buckets.start()
+        self.addCleanup(buckets.stop)
+        self.twitter = mock.Mock()
+        self.twitter.tweet_status_eth_challenge.side_effect = [FakeStatus(status_id) for status_id in range(1, 10)]
+
+    def test_posts_the_thread_as_replies(self):
+        sender = TweetSender(self.twitter, rate_limit_store=InMemoryRateLimit(), remember_statuses=False)
+        self.assertEqual(sender.post(OutboundTweet(["first", "second"]), media="image"), 1)
+        calls = self.twitter.tweet_status_eth_challenge.call_args_list
+        self.assertEqual(calls[0], mock.call("first", media="image", in_reply_to_status_id=None))
+        self.assertEqual(calls[1], mock.call("second", media=None, in_reply_to_status_id=1))
+
+    def test_a_duplicate_gets_the_id_of_the_tweet_posted_before(self):
+        TweetSender(self.twitter, rate_limit_store=InMemoryRateLimit()).post(OutboundTweet(["first"]))
+        self.twitter.tweet_status_eth_challenge.side_effect = TwitterError([{"code": 187, "message": "Duplicate"}])
+        self.assertEqual(TweetSender(self.twitter, rate_limit_store=InMemoryRateLimit()).post(
+            OutboundTweet(["first"])), 1)
+
+    def test_a_long_wait_for_the_rate_limit_raises_instead_of_sleeping(self):
+        rate_limit = mock.Mock()
+        rate_limit.try_acquire.return_value = DIRECT_MAX_WAIT_SECONDS + 1
+        sender = TweetSender(self.twitter, rate_limit_store=rate_limit, remember_statuses=False)
+        with mock.patch("time.sleep") as sleep, self.assertRaises(RateLimitExceededError):
+            sender.post(OutboundTweet(["first"]))
+        sleep.assert_not_called()
+        self.twitter.tweet_status_eth_challenge.assert_not_called()
+
+    def test_the_direct_posts_write_nothing_to_the_storage(self):
+        sender = TweetSender(self.twitter, rate_limit_store=InMemoryRateLimit(), remember_statuses=False)
+        sender.post(OutboundTweet(["first", "second"]))
+        self.assertEqual(self.backend.objects, {})
+
+
+if __name__ == "__main__":
+    unittest.main()